@@ -3,6 +3,9 @@ from __future__ import absolute_import
 from .profextract import *
 from .miscellaneous import *
 from .data import *
+from .geometry import *
+from .regions import *
+from .cache import *
 from .models import *
 from .fitting import *
 from .deproject import *
@@ -10,4 +13,5 @@ from .power_spectrum import *
 from .emissivity import *
 from .hmc import *
 from .reload import *
+from .batch import *
 # from .radio import *
@@ -0,0 +1,162 @@
+import io
+import copy
+import warnings
+import contextlib
+import numpy as np
+from concurrent.futures import ProcessPoolExecutor
+from astropy.table import Table
+from .fitting import Fitter
+from .reload import Reload
+
+
+def _light_profile(prof):
+    """
+    Shallow copy of a profile without the data and the cached geometry, to be sent to a worker process
+    """
+    light = copy.copy(prof)
+    light.data = None
+    light.geometry = None
+    light.projections = {}
+    if prof.bands is not None:
+        light.bands = [_light_profile(band) for band in prof.bands]
+    return light
+
+
+def _fit_item(item, model, start, limits, method, fitlow, fithigh, band, fixed, emcee_kwargs):
+    """
+    Fit a single profile or saved profile file, capturing all the printed output, warnings and errors
+    """
+    res = {'success': False, 'error': '', 'valid': False}
+    log = io.StringIO()
+    try:
+        with contextlib.redirect_stdout(log), warnings.catch_warnings():
+            warnings.simplefilter('ignore')
+            if isinstance(item, str):
+                loaded = Reload(item)
+                if loaded is None or loaded[1] is None:
+                    raise IOError('No profile could be read from file ' + item)
+                prof = loaded[1]
+            else:
+                prof = item
+            mod = copy.deepcopy(model)
+            fitobj = Fitter(mod, prof, method=method, fitlow=fitlow, fithigh=fithigh, band=band, **start)
+            if not hasattr(fitobj, 'minuit'):
+                raise ValueError(log.getvalue().strip())
+            if limits is not None:
+                for name in limits:
+                    fitobj.minuit.limits[name] = limits[name]
+            fitobj.Migrad(fixed=fixed, verbose=False)
+            res['params'] = np.array(fitobj.params)
+            res['errors'] = np.array(fitobj.errors)
+            res['fval'] = fitobj.mlike
+            res['dof'] = fitobj.dof
+            res['nbin'] = fitobj.profile.nbin
+            res['valid'] = bool(fitobj.out.valid)
+            if emcee_kwargs is not None:
+                fitobj.Emcee(verbose=False, plot=False, **emcee_kwargs)
+                if fitobj.samples is None:
+                    raise RuntimeError(log.getvalue().strip())
+                res['percentiles'] = np.percentile(fitobj.samples, [16., 50., 84.], axis=0)
+        res['success'] = True
+    except Exception as e:
+        res['error'] = '%s: %s' % (type(e).__name__, e)
+    return res
+
+
+def FitBatch(profiles, model, start=None, limits=None, method='chi2', fitlow=None, fithigh=None, band=None, fixed=None,
+             emcee=False, emcee_kwargs=None, workers=1):
+    '''
+    Fit the same model to a list of surface brightness profiles, distributing the fits among a pool of processes. Each profile is fitted with :class:`pyproffit.fitting.Fitter` and the MIGRAD algorithm, and optionally sampled with emcee, without printing any output. Errors occurring while loading or fitting a profile are captured and reported in the output table instead of interrupting the batch.
+
+    Profiles can be given either as :class:`pyproffit.profextract.Profile` objects, in which case only the profile itself (and not the associated images) is sent to the worker processes, or as paths to FITS files saved with :meth:`pyproffit.profextract.Profile.Save`, which are reloaded with :func:`pyproffit.reload.Reload` within the worker processes.
+
+    >>> res = pyproffit.FitBatch(files, mod, start={'beta': 0.7, 'rc': 2., 'norm': -2., 'bkg': -4.}, workers=8)
+    >>> res[res['SUCCESS']]['beta']
+
+    :param profiles: List of :class:`pyproffit.profextract.Profile` objects and/or paths to saved profile files
+    :type profiles: list
+    :param model: Object of type :class:`pyproffit.models.Model` defining the model to be used. The model function must be defined at the top level of a module to be sent to the worker processes.
+    :type model: class:`pyproffit.models.Model`
+    :param start: Dictionary of starting values of the parameters passed to iminuit, or list of such dictionaries with one element per profile. If None, the parameter values of the input model are used. Defaults to None
+    :type start: dict or list
+    :param limits: Dictionary of (low, high) boundaries for the parameters. Defaults to None
+    :type limits: dict
+    :param method: Likelihood function to be optimized, 'chi2' or 'cstat'. Defaults to 'chi2'
+    :type method: str
+    :param fitlow: Lower boundary of the active fitting radial range. Defaults to None
+    :type fitlow: float
+    :param fithigh: Upper boundary of the active fitting radial range. Defaults to None
+    :type fithigh: float
+    :param band: In case the profiles were extracted from image cubes, index of the energy band to be fitted. Defaults to None
+    :type band: int
+    :param fixed: Boolean array setting which parameters are fixed while fitting. Defaults to None
+    :type fixed: class:`numpy.ndarray`
+    :param emcee: If True, sample the posterior distribution of each profile with :meth:`pyproffit.fitting.Fitter.Emcee` after the MIGRAD fit. Defaults to False
+    :type emcee: bool
+    :param emcee_kwargs: Dictionary of arguments passed to :meth:`pyproffit.fitting.Fitter.Emcee`. Defaults to None
+    :type emcee_kwargs: dict
+    :param workers: Number of worker processes. If 1, the fits are performed sequentially in the current process. Defaults to 1
+    :type workers: int
+    :return: Table with one row per input profile including the input index (INDEX) and file name (FILE), whether the fit could be performed (SUCCESS) and converged (VALID), the error message in case of failure (ERROR), the best-fit statistic (FVAL), number of degrees of freedom (DOF) and number of bins (NBIN), and the best-fit value and error of each parameter (parameter name and ERR_ followed by the parameter name). If emcee=True, the median and 16th and 84th percentiles of the posterior distribution of each parameter are given as well (MCMC_, MCMC_LO_ and MCMC_HI_ followed by the parameter name).
+    :rtype: class:`astropy.table.Table`
+    '''
+    nprof = len(profiles)
+    if start is None:
+        if model.params is None:
+            print('Error: no starting values provided and no parameters set in the input model')
+            return
+        start = dict(zip(model.parnames, model.params))
+    if isinstance(start, dict):
+        start = [start] * nprof
+    elif len(start) != nprof:
+        print('Error: the number of starting values (%d) does not match the number of profiles (%d)' % (len(start), nprof))
+        return
+    if emcee and emcee_kwargs is None:
+        emcee_kwargs = {}
+    if not emcee:
+        emcee_kwargs = None
+
+    items = [prof if isinstance(prof, str) else _light_profile(prof) for prof in profiles]
+    args = [(items[i], model, start[i], limits, method, fitlow, fithigh, band, fixed, emcee_kwargs) for i in range(nprof)]
+    if workers > 1:
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            futures = [pool.submit(_fit_item, *arg) for arg in args]
+            results = []
+            for future in futures:
+                try:
+                    results.append(future.result())
+                except Exception as e:
+                    # e.g. objects that cannot be sent to the worker processes
+                    results.append({'success': False, 'valid': False, 'error': '%s: %s' % (type(e).__name__, e)})
+    else:
+        results = [_fit_item(*arg) for arg in args]
+
+    parnames = list(model.parnames)
+    npar = len(parnames)
+    table = Table()
+    table['INDEX'] = np.arange(nprof)
+    table['FILE'] = [prof if isinstance(prof, str) else '' for prof in profiles]
+    table['SUCCESS'] = [res['success'] for res in results]
+    table['VALID'] = [res['valid'] for res in results]
+    table['ERROR'] = [res['error'] for res in results]
+    table['FVAL'] = [res['fval'] if res['success'] else np.nan for res in results]
+    table['DOF'] = [res['dof'] if res['success'] else -1 for res in results]
+    table['NBIN'] = [res['nbin'] if res['success'] else -1 for res in results]
+    values = np.full((nprof, npar), np.nan)
+    errors = np.full((nprof, npar), np.nan)
+    percentiles = np.full((nprof, 3, npar), np.nan)
+    for i, res in enumerate(results):
+        if res['success']:
+            values[i] = res['params']
+            errors[i] = res['errors']
+            if emcee:
+                percentiles[i] = res['percentiles']
+    for j, name in enumerate(parnames):
+        table[name] = values[:, j]
+        table['ERR_' + name] = errors[:, j]
+    if emcee:
+        for j, name in enumerate(parnames):
+            table['MCMC_' + name] = percentiles[:, 1, j]
+            table['MCMC_LO_' + name] = percentiles[:, 0, j]
+            table['MCMC_HI_' + name] = percentiles[:, 2, j]
+    return table
@@ -0,0 +1,148 @@
+import os
+import hashlib
+import tempfile
+import zipfile
+import numpy as np
+
+
+def cache_key(*items):
+    """
+    Compute a unique key identifying a set of inputs (strings, bytes, numbers or numpy arrays), to be used to store and retrieve products from a :class:`pyproffit.cache.DiskCache`
+
+    :param items: Inputs on which the cached product depends
+    :return: SHA1 hash of the inputs
+    :rtype: str
+    """
+    sha = hashlib.sha1()
+    for item in items:
+        if isinstance(item, np.ndarray):
+            sha.update(str((item.shape, item.dtype.str)).encode())
+            sha.update(np.ascontiguousarray(item).tobytes())
+        elif isinstance(item, bytes):
+            sha.update(item)
+        else:
+            sha.update(repr(item).encode())
+        sha.update(b'|')
+    return sha.hexdigest()
+
+
+class DiskCache(object):
+    """
+    Simple on-disk cache storing sets of numpy arrays in compressed npz files named after a key computed with :func:`pyproffit.cache.cache_key`. Files are written to a temporary file first and moved into place, such that several processes can share the same cache directory without reading incomplete files. Since the content of a file is entirely determined by its key, concurrent writers of the same key produce identical files and the last one to move its file into place wins.
+
+    If a maximum size is set, the least recently used files are removed after each write until the total size of the files with the given prefix falls below the limit. The modification time of a file is updated whenever it is read, and is used to order the files.
+
+    :param cachedir: Path to the cache directory. The directory is created if it does not exist
+    :type cachedir: str
+    :param prefix: Prefix added to the file names, to separate different kinds of products. Defaults to ''
+    :type prefix: str
+    :param maxsize: Maximum total size of the cached files in MB. If None, the size of the cache is not limited. Defaults to None
+    :type maxsize: float
+    """
+    def __init__(self, cachedir, prefix='', maxsize=None):
+        """
+        Constructor of class DiskCache
+        """
+        self.cachedir = cachedir
+        self.prefix = prefix
+        self.maxsize = maxsize
+        os.makedirs(cachedir, exist_ok=True)
+
+    def path(self, key):
+        """
+        Path to the file corresponding to a given key
+
+        :param key: Cache key
+        :type key: str
+        :return: File path
+        :rtype: str
+        """
+        return os.path.join(self.cachedir, self.prefix + key + '.npz')
+
+    def load(self, key):
+        """
+        Retrieve the arrays stored under a given key
+
+        :param key: Cache key
+        :type key: str
+        :return: Dictionary of arrays, or None if the key is not in the cache or the file cannot be read
+        :rtype: dict
+        """
+        path = self.path(key)
+        if not os.path.exists(path):
+            return None
+        try:
+            with np.load(path) as fin:
+                arrays = {name: fin[name] for name in fin.files}
+        except (OSError, ValueError, EOFError, zipfile.BadZipFile):
+            return None
+        try:
+            os.utime(path)
+        except OSError:
+            pass
+        return arrays
+
+    def save(self, key, **arrays):
+        """
+        Store a set of arrays under a given key
+
+        :param key: Cache key
+        :type key: str
+        :param arrays: Arrays to be stored, passed as keyword arguments
+        """
+        fd, tmpfile = tempfile.mkstemp(dir=self.cachedir, suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as fout:
+                np.savez_compressed(fout, **arrays)
+            os.replace(tmpfile, self.path(key))
+        except OSError:
+            if os.path.exists(tmpfile):
+                os.remove(tmpfile)
+            raise
+        if self.maxsize is not None:
+            self.evict(keep=key)
+
+    def files(self):
+        """
+        List the files stored in the cache, from the least to the most recently used
+
+        :return: List of tuples containing the path, the last access time and the size in bytes of each file
+        :rtype: list
+        """
+        entries = []
+        for name in os.listdir(self.cachedir):
+            if not name.startswith(self.prefix) or not name.endswith('.npz'):
+                continue
+            path = os.path.join(self.cachedir, name)
+            try:
+                stat = os.stat(path)
+            except OSError:
+                # Removed by another process in the meantime
+                continue
+            entries.append((path, stat.st_mtime, stat.st_size))
+        entries.sort(key=lambda entry: entry[1])
+        return entries
+
+    def evict(self, keep=None):
+        """
+        Remove the least recently used files until the total size of the cache is below maxsize
+
+        :param keep: Key of a file that should not be removed, e.g. the one that was just written. Defaults to None
+        :type keep: str
+        """
+        if self.maxsize is None:
+            return
+        entries = self.files()
+        total = sum(entry[2] for entry in entries)
+        keeppath = self.path(keep) if keep is not None else None
+        for path, mtime, size in entries:
+            if total <= self.maxsize * 1e6:
+                break
+            if path == keeppath:
+                continue
+            try:
+                os.remove(path)
+            except OSError:
+                # Already removed by another process
+                pass
+            total = total - size
@@ -3,6 +3,11 @@ from astropy.io import fits
 from astropy import wcs
 from scipy.ndimage.filters import gaussian_filter
 from scipy.interpolate import griddata
+from scipy.ndimage import label, find_objects
+from scipy.spatial import QhullError
+from concurrent.futures import ThreadPoolExecutor
+from .regions import read_regions, region_mask
+from .cache import DiskCache, cache_key
 
 def get_extnum(fitsfile):
     """
@@ -14,7 +19,7 @@ def get_extnum(fitsfile):
     :rtype: int
     """
     next = 0
-    if fitsfile[0].header['NAXIS'] == 2:
+    if fitsfile[0].header['NAXIS'] == 2 or fitsfile[0].header['NAXIS'] == 3:
         return 0
     else:
         print('Primary HDU is not an image, moving on')
@@ -37,6 +42,84 @@ def get_extnum(fitsfile):
         return next
 
 
+def fill_hole(img_smoothed, labels, nlab, slc, ring):
+    """
+    Interpolate a smoothed image into a masked region using the valid pixels located within a ring around the region
+
+    :param img_smoothed: Smoothed image, set to 0 in masked pixels
+    :type img_smoothed: class:`numpy.ndarray`
+    :param labels: Image of labels of the connected masked regions, as returned by scipy.ndimage.label
+    :type labels: class:`numpy.ndarray`
+    :param nlab: Label of the region
+    :type nlab: int
+    :param slc: Slices defining the bounding box of the region, as returned by scipy.ndimage.find_objects
+    :type slc: tuple
+    :param ring: Width of the ring in pixels
+    :type ring: int
+    :return:
+        - y: Y coordinates of the pixels of the region
+        - x: X coordinates of the pixels of the region
+        - vals: Interpolated values
+    """
+    ny, nx = img_smoothed.shape
+    ymin = max(slc[0].start - ring, 0)
+    ymax = min(slc[0].stop + ring, ny)
+    xmin = max(slc[1].start - ring, 0)
+    xmax = min(slc[1].stop + ring, nx)
+    win = img_smoothed[ymin:ymax, xmin:xmax]
+    y, x = np.mgrid[ymin:ymax, xmin:xmax]
+    inhole = labels[ymin:ymax, xmin:xmax] == nlab
+    nonz = win > 0.
+    if np.sum(nonz) < 4:
+        return y[inhole], x[inhole], np.zeros(np.sum(inhole))
+    p_ok = np.array([x[nonz], y[nonz]]).T
+    try:
+        vals = griddata(p_ok, win[nonz], (x[inhole], y[inhole]), method='cubic')
+    except (QhullError, ValueError):
+        # Degenerate configuration, e.g. all valid pixels aligned
+        vals = griddata(p_ok, win[nonz], (x[inhole], y[inhole]), method='nearest')
+    return y[inhole], x[inhole], np.nan_to_num(vals)
+
+
+def load_array(data, dtype=float, memmap=False):
+    """
+    Convert the data of a FITS HDU to a given data type. In memory-mapped mode, arrays whose type on disk already matches the requested type (irrespective of byte order) are returned as copy-on-write memory-mapped arrays, such that only the parts of the array that are accessed are read from disk and the file is never modified. Otherwise the array is read into memory and converted.
+
+    :param data: Data of the FITS HDU
+    :type data: class:`numpy.ndarray`
+    :param dtype: Requested data type. Defaults to float
+    :type dtype: type
+    :param memmap: Keep memory-mapped arrays if possible. Defaults to False
+    :type memmap: bool
+    :return: Converted array
+    :rtype: class:`numpy.ndarray`
+    """
+    dtype = np.dtype(dtype)
+    if memmap and data.dtype.kind == dtype.kind and data.dtype.itemsize == dtype.itemsize:
+        return data
+    return data.astype(dtype)
+
+
+def cube_header(head):
+    """
+    Create a 2D image header from the header of a data cube by removing the keywords describing the third axis
+
+    :param head: Header of the data cube
+    :type head: class:`astropy.io.fits.Header`
+    :return: 2D image header
+    :rtype: class:`astropy.io.fits.Header`
+    """
+    head = head.copy()
+    head['NAXIS'] = 2
+    for key in list(head.keys()):
+        if key in ('NAXIS3', 'CTYPE3', 'CRPIX3', 'CRVAL3', 'CDELT3', 'CUNIT3', 'CROTA3', 'CD3_3', 'PC3_3') or \
+                (len(key) == 5 and key[:2] in ('CD', 'PC') and '3' in key[2:]):
+            del head[key]
+    if 'WCSAXES' in head:
+        head['WCSAXES'] = 2
+    return head
+
+
 class Data(object):
     '''Class containing the data to be loaded and used by other pyproffit routines
 
@@ -50,8 +133,23 @@ class Data(object):
     :type voronoi: bool , optional
     :param rmsmap: Path to error map if the data is not Poisson distributed
     :type rmsmap: str , optional
+    :param memmap: If True, memory-map the input FITS files instead of reading them into memory. Maps stored on disk with the requested data type are then only read when they are accessed, which strongly reduces the memory footprint when working with large mosaics. Defaults to False
+    :type memmap: bool , optional
+    :param dtype: Data type of the exposure, background and error maps, e.g. numpy.float32 to halve memory usage. Defaults to float
+    :type dtype: type , optional
+    :param img_dtype: Data type of the image, e.g. numpy.int32 for count images. If None, use dtype. Defaults to None
+    :type img_dtype: type , optional
+    :param cutout_ra: Right ascension (in degrees) of the center of a cutout to which all the maps are cropped at load time, see :meth:`pyproffit.data.Data.cutout`. Defaults to None
+    :type cutout_ra: float , optional
+    :param cutout_dec: Declination (in degrees) of the center of the cutout. Defaults to None
+    :type cutout_dec: float , optional
+    :param cutout_radius: Half-size of the cutout in arcmin. If None, no cutout is made. Defaults to None
+    :type cutout_radius: float , optional
+
+    The input image can also be a data cube of dimension (band, y, x) containing images in several energy bands. In this case the individual bands are stored in the cube attribute and img contains the sum of all bands. The exposure and background maps can be either cubes with the same dimensions or 2D maps; in the latter case the exposure is assumed to be the same in all bands and the background of individual bands is set to zero. The exposure of the summed image is the average of the band exposures. Per-band profiles are extracted by :meth:`pyproffit.profextract.Profile.SBprofile`.
     '''
-    def __init__(self, imglink, explink=None, bkglink=None, voronoi=False, rmsmap=None):
+    def __init__(self, imglink, explink=None, bkglink=None, voronoi=False, rmsmap=None, memmap=False, dtype=float,
+                 img_dtype=None, cutout_ra=None, cutout_dec=None, cutout_radius=None):
         '''
         Constructor of class Data
 
@@ -59,15 +157,30 @@ class Data(object):
         if imglink is None:
             print('Error: Image file not provided')
             return
-        fimg = fits.open(imglink)
+        if img_dtype is None:
+            img_dtype = dtype
+        self.memmap = memmap
+        self.dtype = dtype
+        fimg = fits.open(imglink, memmap=memmap)
         next = get_extnum(fimg)
-        self.img = fimg[next].data.astype(float)
+        img = load_array(fimg[next].data, img_dtype, memmap)
+        head = fimg[next].header
+        if img.ndim == 3:
+            self.cube = img
+            self.nband = img.shape[0]
+            self.img = np.sum(img, axis=0)
+            head = cube_header(head)
+        else:
+            self.cube = None
+            self.nband = 1
+            self.img = img
+        self.cubeexp = None
+        self.cubebkg = None
         self.imglink = imglink
         self.explink = explink
         self.bkglink = bkglink
         self.voronoi = voronoi
         self.rmsmap = rmsmap
-        head = fimg[next].header
         self.header = head
         self.wcs_inp = wcs.WCS(head, relax=False)
         if 'CDELT2' in head:
@@ -79,36 +192,51 @@ class Data(object):
             self.pixsize = 2.5 / 60.
         self.axes = self.img.shape
         if voronoi:
-            self.errmap = fimg[1].data.astype(float)
+            self.errmap = load_array(fimg[1].data, dtype, memmap)
         fimg.close()
         if explink is None:
-            self.exposure = np.ones(self.axes)
+            self.exposure = np.ones(self.axes, dtype=dtype)
         else:
-            fexp = fits.open(explink)
+            fexp = fits.open(explink, memmap=memmap)
             next = get_extnum(fexp)
-            expo = fexp[next].data.astype(float)
+            expo = load_array(fexp[next].data, dtype, memmap)
+            if expo.ndim == 3:
+                if self.cube is None or expo.shape != self.cube.shape:
+                    print('Error: Image and exposure cube sizes do not match')
+                    return
+                self.cubeexp = expo
+                expo = np.mean(expo, axis=0).astype(dtype)
             if expo.shape != self.axes:
                 print('Error: Image and exposure map sizes do not match')
                 return
             self.exposure = expo
-            self.defaultexpo = np.copy(expo)
             fexp.close()
+        # The exposure map is never modified in place (region() works on a copy), so the original map can be shared
+        self.defaultexpo = self.exposure
 
         if bkglink is None:
-            self.bkg = np.zeros(self.axes)
+            self.bkg = np.zeros(self.axes, dtype=dtype)
         else:
-            fbkg = fits.open(bkglink)
+            fbkg = fits.open(bkglink, memmap=memmap)
             next = get_extnum(fbkg)
-            bkg = fbkg[next].data.astype(float)
+            bkg = load_array(fbkg[next].data, dtype, memmap)
+            if bkg.ndim == 3:
+                if self.cube is None or bkg.shape != self.cube.shape:
+                    print('Error: Image and background cube sizes do not match')
+                    return
+                self.cubebkg = bkg
+                bkg = np.sum(bkg, axis=0)
+            elif self.cube is not None:
+                print('2D background map provided with an image cube, the background of individual bands will be set to zero')
             if bkg.shape != self.axes:
                 print('Error: Image and background map sizes do not match')
                 return
             self.bkg = bkg
             fbkg.close()
         if rmsmap is not None:
-            frms = fits.open(rmsmap)
+            frms = fits.open(rmsmap, memmap=memmap)
             next = get_extnum(frms)
-            rms = frms[next].data.astype(float)
+            rms = load_array(frms[next].data, dtype, memmap)
             if rms.shape != self.axes:
                 print('Error: Image and RMS map sizes do not match')
                 return
@@ -117,114 +245,131 @@ class Data(object):
         else:
             self.rmsmap = None
         self.filth = None
+        self.offset = np.zeros(2, dtype=int)
+        self.parent_axes = self.axes
+        self.cutout_ra = None
+        self.cutout_dec = None
+        self.cutout_radius = None
+        if cutout_radius is not None:
+            if cutout_ra is None or cutout_dec is None:
+                print('Error: cutout center not provided, keeping the full image')
+            else:
+                self.cutout(cutout_ra, cutout_dec, cutout_radius)
+
+    def cutout(self, ra, dec, radius):
+        '''
+        Crop the image and all the associated maps to a square box around a given sky position. The WCS and the header are adjusted accordingly, and the LTV1 and LTV2 keywords are set such that physical coordinates refer to the original image. The position of the lower-left corner of the cutout in the original image is stored in the offset attribute, i.e. pixel (x, y) of the cutout corresponds to pixel (x + offset[0], y + offset[1]) of the original image.
+
+        :param ra: Right ascension of the center of the cutout in degrees
+        :type ra: float
+        :param dec: Declination of the center of the cutout in degrees
+        :type dec: float
+        :param radius: Half-size of the box in arcmin
+        :type radius: float
+        '''
+        pixcrd = self.wcs_inp.wcs_world2pix(np.array([[ra, dec]]), 0)
+        xc, yc = pixcrd[0]
+        rpix = radius / self.pixsize
+        ny, nx = self.axes
+        x0 = max(int(np.floor(xc - rpix)), 0)
+        x1 = min(int(np.ceil(xc + rpix)) + 1, nx)
+        y0 = max(int(np.floor(yc - rpix)), 0)
+        y1 = min(int(np.ceil(yc + rpix)) + 1, ny)
+        if x0 >= x1 or y0 >= y1:
+            print('Error: cutout does not overlap with the image')
+            return
 
-    def region(self, regfile):
+        share_expo = self.defaultexpo is self.exposure
+        for name in ['img', 'exposure', 'defaultexpo', 'bkg', 'rmsmap', 'errmap', 'filth']:
+            arr = getattr(self, name, None)
+            if arr is not None:
+                setattr(self, name, arr[y0:y1, x0:x1])
+        for name in ['cube', 'cubeexp', 'cubebkg']:
+            arr = getattr(self, name)
+            if arr is not None:
+                setattr(self, name, arr[:, y0:y1, x0:x1])
+        if share_expo:
+            self.defaultexpo = self.exposure
+
+        self.wcs_inp = self.wcs_inp[y0:y1, x0:x1]
+        head = self.header.copy()
+        head['NAXIS1'] = x1 - x0
+        head['NAXIS2'] = y1 - y0
+        if 'CRPIX1' in head:
+            head['CRPIX1'] = head['CRPIX1'] - x0
+            head['CRPIX2'] = head['CRPIX2'] - y0
+        head['LTV1'] = head.get('LTV1', 0.) - x0
+        head['LTV2'] = head.get('LTV2', 0.) - y0
+        self.header = head
+        self.axes = self.img.shape
+        self.offset = self.offset + np.array([x0, y0])
+        self.cutout_ra = ra
+        self.cutout_dec = dec
+        self.cutout_radius = radius
+        print('Image cropped to %d x %d pixels, offset (%d, %d) with respect to the original image' % (x1 - x0, y1 - y0, self.offset[0], self.offset[1]))
+
+    def band(self, band):
         '''
-        Filter out regions provided in an input DS9 region file
+        Return the image, exposure and background maps of a given energy band of an image cube. The exposure map includes the regions excluded from the summed exposure map, e.g. through :meth:`pyproffit.data.Data.region`.
+
+        :param band: Index of the energy band
+        :type band: int
+        :return:
+            - img: image of the band
+            - exposure: exposure map of the band
+            - bkg: background map of the band
+        '''
+        if self.cube is None:
+            print('Error: No image cube loaded')
+            return
+        if band < 0 or band >= self.nband:
+            print('Error: band index must be between 0 and %d' % (self.nband - 1))
+            return
+        img = self.cube[band]
+        if self.cubeexp is not None:
+            exposure = self.cubeexp[band] * (self.exposure > 0.)
+        else:
+            exposure = self.exposure
+        if self.cubebkg is not None:
+            bkg = self.cubebkg[band]
+        else:
+            bkg = np.zeros(self.axes, dtype=self.bkg.dtype)
+        return img, exposure, bkg
+
+    def region(self, regfile, cachedir=None):
+        '''
+        Filter out regions provided in an input DS9 region file. Circle, ellipse, box, polygon and annulus shapes are supported, and shapes preceded by a '-' sign are removed from the mask, e.g. to keep the central part of a larger excluded region. See :func:`pyproffit.regions.region_mask` for details.
 
         :param regfile: Path to region file. Accepted region file formats are fk5 and image.
         :type regfile: str
+        :param cachedir: If not None, path to a directory where the computed mask is stored. Subsequent calls with the same region file and image WCS read the mask from disk instead of recomputing it. Defaults to None
+        :type cachedir: str , optional
         '''
-        freg = open(regfile)
-        lreg = freg.readlines()
-        freg.close()
-        nsrc = 0
-        nreg = len(lreg)
         if self.exposure is None:
             print('No exposure given')
             return
-        expo = np.copy(self.exposure)
-        y, x = np.indices(self.axes)
-        regtype = None
-        for i in range(nreg):
-            if 'fk5' in lreg[i]:
-                regtype = 'fk5'
-            elif 'image' in lreg[i]:
-                regtype = 'image'
-        if regtype is None:
-            print('Error: invalid format')
-            return
-        for i in range(nreg):
-            if 'circle' in lreg[i]:
-                vals = lreg[i].split('(')[1].split(')')[0]
-                if regtype == 'fk5':
-                    xsrc = float(vals.split(',')[0])
-                    ysrc = float(vals.split(',')[1])
-                    rad = vals.split(',')[2]
-                    if '"' in rad:
-                        rad = float(rad.split('"')[0]) / self.pixsize / 60.
-                    elif '\'' in rad:
-                        rad = float(rad.split('\'')[0]) / self.pixsize
-                    else:
-                        rad = float(rad) / self.pixsize * 60.
-                    wc = np.array([[xsrc, ysrc]])
-                    pixcrd = self.wcs_inp.wcs_world2pix(wc, 1)
-                    xsrc = pixcrd[0][0] - 1.
-                    ysrc = pixcrd[0][1] - 1.
-                else:
-                    xsrc = float(vals.split(',')[0])
-                    ysrc = float(vals.split(',')[1])
-                    rad = float(vals.split(',')[2])
-
-                # Define box around source to spped up calculation
-                boxsize = np.round(rad + 0.5).astype(int)
-                intcx = np.round(xsrc).astype(int)
-                intcy = np.round(ysrc).astype(int)
-                xmin = np.max([intcx-boxsize, 0])
-                xmax = np.min([intcx+boxsize + 1, self.axes[1]])
-                ymin = np.max([intcy-boxsize, 0])
-                ymax = np.min([intcy+boxsize + 1, self.axes[0]])
-                rbox = np.hypot(x[ymin:ymax,xmin:xmax] - xsrc,y[ymin:ymax,xmin:xmax] - ysrc)
-                # Mask source
-                src = np.where(rbox < rad)
-                expo[ymin:ymax,xmin:xmax][src] = 0.0
-                nsrc = nsrc + 1
-            elif 'ellipse' in lreg[i]:
-                vals = lreg[i].split('(')[1].split(')')[0]
-                if regtype == 'fk5':
-                    xsrc = float(vals.split(',')[0])
-                    ysrc = float(vals.split(',')[1])
-                    rad1 = vals.split(',')[2]
-                    rad2 = vals.split(',')[3]
-                    angle = float(vals.split(',')[4])
-                    if '"' in rad1:
-                        rad1 = float(rad1.split('"')[0]) / self.pixsize / 60.
-                        rad2 = float(rad2.split('"')[0]) / self.pixsize / 60.
-                    elif '\'' in rad1:
-                        rad1 = float(rad1.split('\'')[0]) / self.pixsize
-                        rad2 = float(rad2.split('\'')[0]) / self.pixsize
-                    else:
-                        rad1 = float(rad1) / self.pixsize * 60.
-                        rad2 = float(rad2) / self.pixsize * 60.
-                    wc = np.array([[xsrc, ysrc]])
-                    pixcrd = self.wcs_inp.wcs_world2pix(wc, 1)
-                    xsrc = pixcrd[0][0] - 1.
-                    ysrc = pixcrd[0][1] - 1.
-                else:
-                    xsrc = float(vals.split(',')[0])
-                    ysrc = float(vals.split(',')[1])
-                    rad1 = float(vals.split(',')[2])
-                    rad2 = float(vals.split(',')[3])
-                    angle = float(vals.split(',')[2])
-                ellang = angle * np.pi / 180. + np.pi / 2.
-                aoverb = rad1/rad2
-                # Define box around source to spped up calculation
-                boxsize = np.round(np.max([rad1, rad2]) + 0.5).astype(int)
-                intcx = np.round(xsrc).astype(int)
-                intcy = np.round(ysrc).astype(int)
-                xmin = np.max([intcx-boxsize, 0])
-                xmax = np.min([intcx+boxsize + 1, self.axes[1]])
-                ymin = np.max([intcy-boxsize, 0])
-                ymax = np.min([intcy+boxsize + 1, self.axes[0]])
-                xtil = np.cos(ellang)*(x[ymin:ymax,xmin:xmax]-xsrc) + np.sin(ellang)*(y[ymin:ymax,xmin:xmax]-ysrc)
-                ytil = -np.sin(ellang)*(x[ymin:ymax,xmin:xmax]-xsrc) + np.cos(ellang)*(y[ymin:ymax,xmin:xmax]-ysrc)
-                rbox = aoverb * np.hypot(xtil, ytil / aoverb)
-                # Mask source
-                src = np.where(rbox < rad1)
-                expo[ymin:ymax,xmin:xmax][src] = 0.0
-                nsrc = nsrc + 1
+        cache = None
+        stored = None
+        if cachedir is not None:
+            cache = DiskCache(cachedir, prefix='region_')
+            freg = open(regfile, 'rb')
+            key = cache_key(freg.read(), self.wcs_inp.to_header_string(), self.axes, self.pixsize)
+            freg.close()
+            stored = cache.load(key)
+        if stored is not None:
+            mask = np.unpackbits(stored['mask'], count=self.axes[0] * self.axes[1]).reshape(self.axes).astype(bool)
+            nsrc = int(stored['nsrc'])
+        else:
+            regions = read_regions(regfile)
+            if regions is None:
+                return
+            mask, nsrc = region_mask(regions, self.axes, self.wcs_inp, self.pixsize)
+            if cache is not None:
+                cache.save(key, mask=np.packbits(mask), nsrc=nsrc)
 
         print('Excluded %d sources' % (nsrc))
+        expo = np.copy(self.exposure)
+        expo[mask] = 0.0
         self.exposure = expo
 
     def reset_exposure(self):
@@ -234,14 +379,22 @@ class Data(object):
         """
         self.exposure = self.defaultexpo
 
-    def dmfilth(self, outfile=None, smoothing_scale=8):
+    def dmfilth(self, outfile=None, smoothing_scale=8, local=False, ring=None, workers=1, seed=None):
         '''
-        Mask the regions provided in a region file and fill in the holes by interpolating the smoothed image into the gaps and generating a Poisson realization
+        Mask the regions provided in a region file and fill in the holes by interpolating the smoothed image into the gaps and generating a Poisson realization. Masked pixels outside of the field of view are set to 0.
 
         :param outfile: If outfile is not None, file name to output the dmfilth image into a FITS file
         :type outfile: str , optional
         :param smoothing_scale: Size of smoothing scale (in pixel) to estimate the surface brightness distribution outside of the masked areas
         :type smoothing_scale: int
+        :param local: If True, identify the connected masked regions and interpolate the smoothed image into each of them using only the valid pixels located within a ring around the region, instead of interpolating over the entire image at once. The computing time then scales with the masked area instead of the size of the image. Defaults to False
+        :type local: bool
+        :param ring: In local mode, width in pixels of the ring of valid pixels around each masked region used for the interpolation. If None, the smoothing scale is used. Defaults to None
+        :type ring: int
+        :param workers: In local mode, number of threads used to process the masked regions in parallel. Defaults to 1
+        :type workers: int
+        :param seed: Seed of the random number generator used to draw the Poisson realization. If None, the global numpy random state is used. Defaults to None
+        :type seed: int
         '''
         if self.img is None:
             print('No data given')
@@ -259,19 +412,62 @@ class Data(object):
         img_smoothed = np.nan_to_num(np.divide(gsb, gsexp))
         img_smoothed[chimg] = 0.
 
-        # Interpolate
-        print('Interpolating in the masked regions')
-        y, x = np.indices(self.axes)
-        nonz = np.where(img_smoothed > 0.)
-        p_ok = np.array([x[nonz], y[nonz]]).T
-        vals = img_smoothed[nonz]
-        int_vals = np.nan_to_num(griddata(p_ok, vals, (x, y), method='cubic'))
-
-        # Fill holes
-        print('Filling holes')
-        area_to_fill = np.where(np.logical_and(int_vals > 0., self.exposure == 0))
+        # Without a seed, the global state of numpy's random number generator is used such that np.random.seed applies
+        rng = np.random.default_rng(seed) if seed is not None else np.random
+        if not local:
+            # Interpolate
+            print('Interpolating in the masked regions')
+            y, x = np.indices(self.axes)
+            nonz = np.where(img_smoothed > 0.)
+            p_ok = np.array([x[nonz], y[nonz]]).T
+            vals = img_smoothed[nonz]
+            int_vals = np.nan_to_num(griddata(p_ok, vals, (x, y), method='cubic'))
+
+            # Fill holes
+            print('Filling holes')
+            # Masked pixels outside of the field of view are set to 0 also when they lie outside of the interpolation domain
+            outfov = self.defaultexpo == 0.
+            area_to_fill = np.where(np.logical_and(np.logical_or(int_vals > 0., outfov), self.exposure == 0))
+            fill_vals = np.where(outfov, 0., int_vals)[area_to_fill]
+        else:
+            if ring is None:
+                ring = smoothing_scale
+            # Pixels outside of the field of view are never filled, so only the holes within it are interpolated
+            holes = np.logical_and(self.exposure == 0., self.defaultexpo > 0.)
+            labels, nhole = label(holes, structure=np.ones((3, 3)))
+            slices = find_objects(labels)
+            print('Interpolating locally in %d masked regions' % (nhole))
+            batches = [range(i, min(i + 64, nhole)) for i in range(0, nhole, 64)]
+
+            def fill_batch(batch):
+                return [fill_hole(img_smoothed, labels, n + 1, slices[n], ring) for n in batch]
+
+            if workers > 1 and len(batches) > 1:
+                with ThreadPoolExecutor(max_workers=workers) as pool:
+                    results = list(pool.map(fill_batch, batches))
+            else:
+                results = [fill_batch(batch) for batch in batches]
+
+            # Fill holes
+            print('Filling holes')
+            ally, allx, allv = [], [], []
+            for res in results:
+                for yh, xh, vh in res:
+                    ally.append(yh)
+                    allx.append(xh)
+                    allv.append(vh)
+            if nhole > 0:
+                ally, allx, allv = np.concatenate(ally), np.concatenate(allx), np.concatenate(allv)
+            else:
+                ally, allx, allv = np.zeros(0, dtype=int), np.zeros(0, dtype=int), np.zeros(0)
+            pos = allv > 0.
+            # Masked pixels outside of the field of view are set to 0, with the same rule as in the global mode
+            outy, outx = np.where(np.logical_and(self.exposure == 0., self.defaultexpo == 0.))
+            area_to_fill = (np.concatenate((ally[pos], outy)), np.concatenate((allx[pos], outx)))
+            fill_vals = np.concatenate((allv[pos], np.zeros(len(outy))))
+
         dmfilth = np.copy(self.img)
-        dmfilth[area_to_fill] = np.random.poisson(int_vals[area_to_fill] * self.defaultexpo[area_to_fill])
+        dmfilth[area_to_fill] = rng.poisson(fill_vals * self.defaultexpo[area_to_fill])
 
         self.filth = dmfilth
 
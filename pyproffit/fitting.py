@@ -1,6 +1,10 @@
+import os
+import copy
 import numpy as np
 import iminuit
 import matplotlib.pyplot as plt
+from .models import eval_batch
+from .cache import DiskCache
 
 # Generic class to fit data with chi-square
 class ChiSquared:
@@ -29,16 +33,22 @@ class ChiSquared:
     :type fitlow: float , optional
     :param fithigh: Upper fitting boundary in arcmin. If fithigh=None the entire radial range is used, default to None
     :type fithigh: float , optional
+    :param grad: Function returning the derivatives of the model with respect to its parameters, see :class:`pyproffit.models.Model`. Defaults to None
+    :type grad: function , optional
+    :param vectorized: Whether the model can be evaluated for several parameter sets at once, see :func:`pyproffit.models.eval_batch`. Defaults to False
+    :type vectorized: bool , optional
     """
 
     errordef = iminuit.Minuit.LEAST_SQUARES
 
-    def __init__(self, model, x , dx, y, dy, psfmat=None, fitlow=None, fithigh=None):
+    def __init__(self, model, x , dx, y, dy, psfmat=None, fitlow=None, fithigh=None, grad=None, vectorized=False):
         """
         Constructor of class ChiSquared
 
         """
         self.model = model  # model predicts y for given x
+        self.grad = grad
+        self.vectorized = vectorized
         self.x = x
         self.dx = dx
         self.y = y
@@ -56,6 +66,14 @@ class ChiSquared:
         else:
             self.psfmat = None
         self.func_code = iminuit.util.make_func_code(iminuit.util.describe(self.model)[1:])
+        # Bins entering the likelihood, with the corresponding data and rows of the PSF matrix stored contiguously
+        self.sel = self.region[0][self.nonz]
+        self.ysel = np.ascontiguousarray(self.y[self.sel])
+        self.wsel = 1. / np.ascontiguousarray(self.dy[self.sel]) ** 2
+        if self.psfmat is not None:
+            self.psfsel = np.ascontiguousarray(self.psfmat[self.sel])
+        else:
+            self.psfsel = None
 
     def __call__(self, *par):  # par are a variable number of model parameters
         """
@@ -66,14 +84,50 @@ class ChiSquared:
         :rtype: float
         """
         ym = self.model(self.x, *par)
-        if self.psfmat is not None:
-            ym = np.dot(self.psfmat, ym)
+        if self.psfsel is not None:
+            ym = np.dot(self.psfsel, ym)
+        else:
+            ym = ym[self.sel]
 
-        reg = self.region
-        nonz = self.nonz
-        chi2 = np.sum((self.y[reg][nonz] - ym[reg][nonz])**2/self.dy[reg][nonz]**2)
+        chi2 = np.sum((self.ysel - ym)**2 * self.wsel)
         return chi2
 
+    def batch(self, pars):
+        """
+        Compute the chi-squared for several parameter sets at once. The model is evaluated for all parameter sets with :func:`pyproffit.models.eval_batch`, at once if it is vectorized, and the PSF convolution is performed as a single matrix product.
+
+        :param pars: Array of shape (nset, npar) containing the parameter sets
+        :type pars: numpy.ndarray
+        :return: chi-squared value for each parameter set
+        :rtype: numpy.ndarray
+        """
+        ym = eval_batch(self.model, self.x, pars, vectorized=self.vectorized)
+        if self.psfsel is not None:
+            ym = np.dot(ym, self.psfsel.T)
+        else:
+            ym = ym[:, self.sel]
+
+        return np.sum((self.ysel - ym)**2 * self.wsel, axis=1)
+
+    def gradient(self, *par):
+        """
+        Analytic gradient of the chi-squared with respect to the model parameters, obtained from the derivatives of the model convolved with the PSF
+
+        :param par: Parameter set to be passed to the model
+        :return: Derivatives of the chi-squared with respect to each parameter
+        :rtype: numpy.ndarray
+        """
+        ym = self.model(self.x, *par)
+        dym = self.grad(self.x, *par)
+        if self.psfsel is not None:
+            ym = np.dot(self.psfsel, ym)
+            dym = np.dot(dym, self.psfsel.T)
+        else:
+            ym = ym[self.sel]
+            dym = dym[:, self.sel]
+
+        return np.dot(dym, -2. * (self.ysel - ym) * self.wsel)
+
 # Generic class to fit data with C-stat
 class Cstat:
     """
@@ -105,16 +159,22 @@ class Cstat:
     :type fitlow: float
     :param fithigh: Upper fitting boundary in arcmin. If fithigh=None (default) the entire radial range is used
     :type fithigh: float
+    :param grad: Function returning the derivatives of the model with respect to its parameters, see :class:`pyproffit.models.Model`. Defaults to None
+    :type grad: function
+    :param vectorized: Whether the model can be evaluated for several parameter sets at once, see :func:`pyproffit.models.eval_batch`. Defaults to False
+    :type vectorized: bool
     """
 
     errordef = iminuit.Minuit.LEAST_SQUARES
 
-    def __init__(self, model, x, dx, counts, area, effexp, bkgc, psfmat=None, fitlow=None, fithigh=None):
+    def __init__(self, model, x, dx, counts, area, effexp, bkgc, psfmat=None, fitlow=None, fithigh=None, grad=None, vectorized=False):
         """
         Constructor of class Cstat
 
         """
         self.model = model  # model predicts y for given x
+        self.grad = grad
+        self.vectorized = vectorized
         self.x = x
         self.dx = dx
         self.c = counts
@@ -135,6 +195,23 @@ class Cstat:
         else:
             self.psfmat = None
         self.func_code = iminuit.util.make_func_code(iminuit.util.describe(self.model)[1:])
+        # Bins entering the likelihood, bins with counts first, with the corresponding data stored contiguously
+        reg = self.region[0]
+        self.sel = np.concatenate((reg[self.nonz], reg[self.isz]))
+        self.nsel = len(reg[self.nonz])
+        csel = np.asarray(counts[self.sel[:self.nsel]], dtype=float)
+        self.csel = csel
+        self.cconst = np.sum(-csel + csel * np.log(csel))
+        self.expsel = np.ascontiguousarray(area[self.sel] * effexp[self.sel])
+        self.bkgsel = np.ascontiguousarray(bkgc[self.sel])
+        if self.psfmat is not None:
+            # Mixing of the flux of the annuli, the model being expressed in surface brightness
+            rminus = self.x - self.dx
+            rplus = self.x + self.dx
+            areatot = np.pi * (rplus ** 2 - rminus ** 2)
+            self.psfsel = np.ascontiguousarray(self.psfmat[self.sel] * areatot / areatot[self.sel, np.newaxis])
+        else:
+            self.psfsel = None
 
     def __call__(self, *par):
         """
@@ -145,22 +222,139 @@ class Cstat:
         :rtype: float
         """
         ym = self.model(self.x, *par)
-        if self.psfmat is not None:
-            rminus = self.x - self.dx
-            rplus = self.x + self.dx
-            areatot = np.pi * (rplus ** 2 - rminus ** 2)
-            ym = np.dot(self.psfmat, ym * areatot) / areatot
-
-        modcounts = ym*self.area*self.effexp
-        mm = modcounts + self.bkgc # model counts
-        reg = self.region
-        nc = self.c
-        nonz = self.nonz
-        cstat = 2.*np.sum(mm[reg][nonz]-nc[reg][nonz]*np.log(mm[reg][nonz])-nc[reg][nonz]+nc[reg][nonz]*np.log(nc[reg][nonz])) # normalized C-statistic
-        isz = self.isz
-        cstat = cstat + 2.*np.sum(mm[reg][isz])
+        if self.psfsel is not None:
+            ym = np.dot(self.psfsel, ym)
+        else:
+            ym = ym[self.sel]
+
+        mm = ym * self.expsel + self.bkgsel # model counts
+        cstat = 2. * (np.sum(mm) - np.sum(self.csel * np.log(mm[:self.nsel])) + self.cconst) # normalized C-statistic
         return cstat
 
+    def batch(self, pars):
+        """
+        Compute the C-statistic for several parameter sets at once. The model is evaluated for all parameter sets with :func:`pyproffit.models.eval_batch`, at once if it is vectorized, and the PSF convolution is performed as a single matrix product.
+
+        :param pars: Array of shape (nset, npar) containing the parameter sets
+        :type pars: numpy.ndarray
+        :return: C-stat value for each parameter set
+        :rtype: numpy.ndarray
+        """
+        ym = eval_batch(self.model, self.x, pars, vectorized=self.vectorized)
+        if self.psfsel is not None:
+            ym = np.dot(ym, self.psfsel.T)
+        else:
+            ym = ym[:, self.sel]
+
+        mm = ym * self.expsel + self.bkgsel
+        return 2. * (np.sum(mm, axis=1) - np.dot(np.log(mm[:, :self.nsel]), self.csel) + self.cconst)
+
+    def gradient(self, *par):
+        """
+        Analytic gradient of the C-statistic with respect to the model parameters, obtained from the derivatives of the model convolved with the PSF
+
+        :param par: Parameter set to be passed to the model
+        :return: Derivatives of the C-statistic with respect to each parameter
+        :rtype: numpy.ndarray
+        """
+        ym = self.model(self.x, *par)
+        dym = self.grad(self.x, *par)
+        if self.psfsel is not None:
+            ym = np.dot(self.psfsel, ym)
+            dym = np.dot(dym, self.psfsel.T)
+        else:
+            ym = ym[self.sel]
+            dym = dym[:, self.sel]
+
+        mm = ym * self.expsel + self.bkgsel
+        dstat = np.ones(len(mm))
+        dstat[:self.nsel] = 1. - self.csel / mm[:self.nsel]
+        return 2. * np.dot(dym, dstat * self.expsel)
+
+
+class LogPosterior:
+    """
+    Log posterior probability of a set of walkers used by :meth:`pyproffit.fitting.Fitter.Emcee`, defined as a class such that it can be sent to worker processes. The likelihood of all the walkers is computed at once with the batch method of the likelihood object, optionally splitting the walkers into groups evaluated in parallel through a pool.
+
+    :param loglike: Likelihood object of type :class:`pyproffit.fitting.ChiSquared` or :class:`pyproffit.fitting.Cstat`
+    :param start: Starting parameter values, used for the fixed parameters and as center of the default prior
+    :type start: numpy.ndarray
+    :param fixed: Boolean array setting which parameters are fixed
+    :type fixed: numpy.ndarray
+    :param prior: Function returning the log prior probability of a parameter set. If None, a Gaussian prior centered on start with standard deviation sigma is used. Defaults to None
+    :type prior: function
+    :param sigma: Standard deviation of the default Gaussian prior. Defaults to None
+    :type sigma: numpy.ndarray
+    :param pool: Pool object with a map method used to evaluate groups of walkers in parallel. Defaults to None
+    :param nsplit: Number of groups into which the walkers are split when a pool is used. Defaults to 1
+    :type nsplit: int
+    """
+    def __init__(self, loglike, start, fixed, prior=None, sigma=None, pool=None, nsplit=1):
+        """
+        Constructor of class LogPosterior
+        """
+        self.loglike = loglike
+        self.start = np.asarray(start, dtype=float)
+        self.fixed = np.asarray(fixed, dtype=bool)
+        self.prior = prior
+        self.sigma = sigma
+        self.pool = pool
+        self.nsplit = nsplit
+
+    def __getstate__(self):
+        # The pool itself is never sent to the workers
+        state = self.__dict__.copy()
+        state['pool'] = None
+        return state
+
+    def __call__(self, pars):
+        """
+        Compute the log posterior probability of a set of walkers
+
+        :param pars: Array of shape (nwalkers, npar) containing the parameters of the walkers. The values of the fixed parameters are reset to their starting values.
+        :type pars: numpy.ndarray
+        :return: Log posterior probability of each walker
+        :rtype: numpy.ndarray
+        """
+        if self.prior is None:
+            log_prior = - 0.5 * np.sum((pars - self.start) ** 2 / self.sigma ** 2, axis=1)
+        else:
+            log_prior = np.array([self.prior(par) for par in pars])
+
+        pars[:, self.fixed] = self.start[self.fixed]
+
+        if self.pool is None:
+            stat = self.loglike.batch(pars)
+        else:
+            groups = np.array_split(pars, min(self.nsplit, len(pars)))
+            stat = np.concatenate(list(self.pool.map(self.loglike.batch, groups)))
+
+        return -0.5 * stat + log_prior
+
+    def gradient(self, par):
+        """
+        Gradient of the log posterior probability of a single parameter set, e.g. for gradient-based samplers. The gradient of the likelihood is computed analytically, which requires the model gradient to be available, and the gradient of a user-defined prior is computed numerically by central differences. The derivatives with respect to the fixed parameters are set to 0.
+
+        :param par: Parameter values
+        :type par: numpy.ndarray
+        :return: Derivatives of the log posterior probability with respect to each parameter
+        :rtype: numpy.ndarray
+        """
+        par = np.array(par, dtype=float)
+        par[self.fixed] = self.start[self.fixed]
+        grad = -0.5 * self.loglike.gradient(*par)
+        if self.prior is None:
+            grad = grad - (par - self.start) / self.sigma ** 2
+        else:
+            for i in range(len(par)):
+                step = 1e-6 * max(abs(par[i]), 1.)
+                parp, parm = par.copy(), par.copy()
+                parp[i] = par[i] + step
+                parm[i] = par[i] - step
+                grad[i] = grad[i] + (self.prior(parp) - self.prior(parm)) / (2. * step)
+        grad[self.fixed] = 0.
+        return grad
+
 
 # Class including fitting tool
 class Fitter:
@@ -177,25 +371,44 @@ class Fitter:
     :type fitlow: float
     :param fithigh: Upper boundary of the active fitting radial range. If fithigh=None the entire range is used. Defaults to None
     :type fithigh: float
+    :param band: In case the profile was extracted from an image cube, index of the energy band to be fitted. If None, the profile extracted from the sum of all bands is fitted. Defaults to None
+    :type band: int
     :param kwargs: List of arguments to be passed to the iminuit library. For instance, setting parameter boundaries, optimization options or fixing parameters.
         See the iminuit documentation: https://iminuit.readthedocs.io/en/stable/index.html
     """
 
-    def __init__(self, model, profile, method='chi2', fitlow=None, fithigh=None, **kwargs):
+    def __init__(self, model, profile, method='chi2', fitlow=None, fithigh=None, band=None, **kwargs):
         """
         Constructor of class Fitter
         """
         self.mod = model
-        self.profile = profile
         if profile is None:
             print('Error: No valid profile exists in provided object')
             return
 
+        if band is not None:
+            if profile.bands is None:
+                print('Error: No band profiles exist in provided object')
+                return
+            if band < 0 or band >= len(profile.bands):
+                print('Error: band index must be between 0 and %d' % (len(profile.bands) - 1))
+                return
+            psfmat = profile.psfmat
+            # Shallow copy, such that the PSF of the parent profile is not attached to the band profile itself
+            profile = copy.copy(profile.bands[band])
+            profile.psfmat = psfmat
+
+        self.profile = profile
+
         if profile.psfmat is not None:
             psfmat = np.transpose(profile.psfmat)
         else:
             psfmat = None
 
+        # Analytic gradient of the model, if available
+        grad = getattr(model, 'grad', None)
+        vectorized = getattr(model, 'vectorized', False)
+
         loglike = None
         if method == 'chi2':
             # Define the fitting algorithm
@@ -206,7 +419,9 @@ class Fitter:
                               dy=profile.eprof,
                               psfmat=psfmat,
                               fitlow=fitlow,
-                              fithigh=fithigh)
+                              fithigh=fithigh,
+                              grad=grad,
+                              vectorized=vectorized)
 
         elif method == 'cstat':
             if profile.counts is None:
@@ -222,13 +437,18 @@ class Fitter:
                           bkgc=profile.bkgcounts,
                           psfmat=psfmat,
                           fitlow=fitlow,
-                          fithigh=fithigh)
+                          fithigh=fithigh,
+                          grad=grad,
+                          vectorized=vectorized)
         else:
             print('Unknown method ', method)
             return
 
-        # Construct iminuit object
-        minuit = iminuit.Minuit(loglike, **kwargs)
+        # Construct iminuit object, providing the analytic gradient of the likelihood if the model gradient is known
+        if grad is not None:
+            minuit = iminuit.Minuit(loglike, grad=loglike.gradient, **kwargs)
+        else:
+            minuit = iminuit.Minuit(loglike, **kwargs)
 
         self.minuit = minuit
         self.loglike = loglike
@@ -240,13 +460,18 @@ class Fitter:
         self.fixed = np.zeros(self.npar, dtype=bool)
         self.method = method
         self.samples = None
+        self.dof = None
+        self.tau = None
+        self.converged = None
 
-    def Migrad(self, fixed=None):
+    def Migrad(self, fixed=None, verbose=True):
         """
         Perform maximum-likelihood optimization of the model using the MIGRAD routine from the MINUIT library.
 
         :param fixed: A boolean array setting up whether parameters are fixed (True) or left free (False) while fitting. If None, all parameters are fitted. Defaults to None.
         :type fixed: class:`numpy.ndarray`
+        :param verbose: If True, print the MINUIT output and the best-fit statistic. Defaults to True
+        :type verbose: bool
         """
         minuit = self.minuit
 
@@ -259,18 +484,20 @@ class Fitter:
                 minuit.fixed[i] = True
 
         out = minuit.migrad()
-        print(out)
         reg = self.loglike.region
         freepars = self.mod.npar - len(np.where(minuit.fixed)[0])
         dof = len(self.profile.profile[reg]) - freepars
         self.mlike = out.fval
+        self.dof = dof
 
-        if self.method == 'chi2':
-            print('Best fit chi-squared: %g for %d bins and %d d.o.f' % (out.fval, self.profile.nbin, dof))
-            print('Reduced chi-squared: %g' % (out.fval / dof))
-        else:
-            print('Best fit C-statistic: %g for %d bins and %d d.o.f' % (out.fval, self.profile.nbin, dof))
-            print('Reduced C-statistic: %g' % (out.fval / dof))
+        if verbose:
+            print(out)
+            if self.method == 'chi2':
+                print('Best fit chi-squared: %g for %d bins and %d d.o.f' % (out.fval, self.profile.nbin, dof))
+                print('Reduced chi-squared: %g' % (out.fval / dof))
+            else:
+                print('Best fit C-statistic: %g for %d bins and %d d.o.f' % (out.fval, self.profile.nbin, dof))
+                print('Reduced C-statistic: %g' % (out.fval / dof))
 
         npar = len(minuit.values)
         outval = np.empty(npar)
@@ -286,22 +513,50 @@ class Fitter:
         self.minuit = minuit
         self.out = out
 
-    def Emcee(self, nmcmc=5000, burnin=100, start=None, prior=None, walkers=32, thin=15):
+    def Emcee(self, nmcmc=5000, burnin=100, start=None, prior=None, walkers=32, thin=15, verbose=True, workers=1, pool=None,
+              checkpoint=None, checkpoint_every=500, resume=True, plot=True, autocorr=False, ntau=50, tau_tol=0.01, check_every=100):
         '''
         Run a Markov Chain Monte Carlo optimization using the affine-invariant ensemble sampler emcee. See https://emcee.readthedocs.io/en/stable/ for details.
 
+        The likelihood of all the walkers is evaluated at once at each step. If workers > 1 or a pool is provided, the walkers are split into groups that are evaluated in parallel, which is worthwhile for models that are expensive to compute. In that case the model function and the prior must be defined at the top level of a module such that they can be sent to the worker processes.
+
+        With autocorr=True, the integrated autocorrelation time tau of the chains is estimated every check_every steps and the sampling stops as soon as the chains are longer than ntau times tau and the estimate of tau changed by less than a fraction tau_tol since the previous estimate, nmcmc being the maximum number of steps. The burn-in and thinning are then set to 2 times the largest and half the smallest autocorrelation times, respectively, and the autocorrelation times and the convergence flag are stored in the tau and converged attributes. A warning is printed if the chains did not converge within nmcmc steps.
+
+        If a checkpoint directory is provided, the chain is written to disk every checkpoint_every steps together with the state of the sampler, and only the thinned samples are kept in memory. An interrupted run can then be resumed by calling the method again with the same checkpoint directory.
+
         :param nmcmc: Number of MCMC samples. Defaults to 5000
         :type nmcmc: int
         :param burnin: Size of the burn-in phase that will eventually be ignored. Defaults to 100
         :type burnin: int
         :param start: Array of input parameter values. If None, the code will look for the results of a previous Migrad optimization and use the corresponding parameters as starting values. Defaults to None
         :type start: class:`numpy.ndarray`
-        :param prior: Function defining the priors on the parameters. The function should take the parameter set as input and return the log prior probability. If None, the code will search for the results of a previous Migrad optimization and set up broad Gaussian priors on each parameter with sigma set to 5 times the Migrad errors. Defaults to None.
+        :param prior: Function defining the priors on the parameters. The function should take the parameter set as input and return the log prior probability. The prior is evaluated for each walker in turn. If None, the code will search for the results of a previous Migrad optimization and set up broad Gaussian priors on each parameter with sigma set to 5 times the Migrad errors. Defaults to None.
         :type prior: function
         :param walkers: Number of emcee walkers. Defaults to 32.
         :type walkers: int
         :param thin: Thinning number for the output samples. The total number of sample values will be nmcmc*walkers/thin. Defaults to 15.
         :type thin: int
+        :param verbose: If True, display a progress bar. Defaults to True
+        :type verbose: bool
+        :param workers: Number of processes among which the walkers are distributed. If a pool is provided, number of groups into which the walkers are split, one group per walker being used if workers=1. Defaults to 1
+        :type workers: int
+        :param pool: Pool object with a map method, e.g. :class:`multiprocessing.pool.Pool` or an MPI pool, used to evaluate the walkers in parallel. If None and workers > 1, a :class:`multiprocessing.pool.Pool` is created. Defaults to None
+        :param checkpoint: Path to a directory where the chain and the state of the sampler are stored. Defaults to None
+        :type checkpoint: str
+        :param checkpoint_every: Number of steps between two checkpoints. Defaults to 500
+        :type checkpoint_every: int
+        :param resume: If True and the checkpoint directory contains a previous run with the same number of walkers and parameters, continue that run until nmcmc steps are reached. If False, any previous run is discarded. Defaults to True
+        :type resume: bool
+        :param plot: If True, plot the chains of all parameters. Defaults to True
+        :type plot: bool
+        :param autocorr: If True, stop the sampling once the chains are converged according to their autocorrelation time and set the burn-in and thinning from the autocorrelation time, ignoring the burnin and thin arguments. Defaults to False
+        :type autocorr: bool
+        :param ntau: Minimum length of the chains in units of the autocorrelation time. Defaults to 50
+        :type ntau: float
+        :param tau_tol: Maximum relative change of the autocorrelation time between two estimates. Defaults to 0.01
+        :type tau_tol: float
+        :param check_every: Number of steps between two estimates of the autocorrelation time. Defaults to 100
+        :type check_every: int
         '''
         try:
             import emcee
@@ -325,7 +580,9 @@ class Fitter:
             for i in range(npar):
                 start[i] = self.params[i]
 
-        is_fixed = np.where(self.fixed)
+        is_fixed = np.asarray(self.fixed, dtype=bool)
+
+        sigma = None
 
         if prior is None:
 
@@ -334,56 +591,142 @@ class Fitter:
                 print('No prior provided and no available errors, please provide a custom prior or run a maximum likelihood fit first')
                 return
 
-            def prior(pars):
-
-                errors = np.empty(npar)
-
-                for i in range(npar):
+            errors = np.empty(npar)
 
-                    if not self.fixed[i]:
-                        errors[i] = self.errors[i]
-
-                    else:
-                        errors[i] = 1.
-
-                # Gaussian prior with width +/- 5 sigma
-
-                tot_prior = - 0.5 * np.sum( (pars - start)**2 / (5.*errors)**2)
-
-                return tot_prior
-
-        def log_like(pars):
-
-            log_prior = prior(pars)
+            for i in range(npar):
 
-            pars[is_fixed] = start[is_fixed]
+                if not is_fixed[i]:
+                    errors[i] = self.errors[i]
 
-            loglike = -0.5 * self.loglike(*pars)
+                else:
+                    errors[i] = 1.
 
-            return loglike + log_prior
+            # Gaussian prior with width +/- 5 sigma
+            sigma = 5. * errors
 
-        pos = start + 1e-4 * np.random.randn(walkers, npar)
+        own_pool = None
+        if pool is None and workers > 1:
+            from multiprocessing import Pool
+            own_pool = Pool(workers)
+            pool = own_pool
+        nsplit = walkers
+        if workers > 1:
+            nsplit = workers
+        log_like = LogPosterior(self.loglike, start, is_fixed, prior=prior, sigma=sigma, pool=pool, nsplit=nsplit)
 
-        nwalkers, ndim = pos.shape
+        state = start + 1e-4 * np.random.randn(walkers, npar)
+        nwalkers, ndim = state.shape
 
         sampler = emcee.EnsembleSampler(
-            nwalkers, ndim, log_like
+            nwalkers, ndim, log_like, vectorize=True
         )
-        sampler.run_mcmc(pos, nmcmc, progress=True)
-
-        samples = sampler.get_chain(discard=burnin, thin=thin, flat=True)
 
-        fig, axes = plt.subplots(npar, figsize=(10, 7), sharex=True)
-        samp_plot = sampler.get_chain()
-        labels = self.mod.parnames
-        for i in range(ndim):
-            ax = axes[i]
-            ax.plot(samp_plot[:, :, i], "k", alpha=0.3)
-            ax.set_xlim(0, len(samp_plot))
-            ax.set_ylabel(labels[i])
-            ax.yaxis.set_label_coords(-0.1, 0.5)
+        done = 0
+        store = None
+        if checkpoint is not None:
+            store = DiskCache(checkpoint)
+            stored = store.load('state')
+            if stored is not None and resume and stored['coords'].shape == (nwalkers, ndim):
+                done = int(stored['nstep'])
+                rstate = ('MT19937', stored['rs_key'], int(stored['rs_pos']), int(stored['rs_has_gauss']), float(stored['rs_gauss']))
+                state = emcee.State(stored['coords'], log_prob=stored['log_prob'], random_state=rstate)
+                print('Resuming from step %d' % done)
+            # Remove chunks from a discarded run or written after the last saved state
+            for name in os.listdir(checkpoint):
+                if name.startswith('chain_') and name.endswith('.npz') and int(name[6:-4]) >= done:
+                    os.remove(os.path.join(checkpoint, name))
+
+        def read_chunks():
+            names = sorted(name for name in os.listdir(checkpoint) if name.startswith('chain_') and name.endswith('.npz'))
+            return [(int(name[6:-4]), store.load(name[:-4])['chain']) for name in names]
+
+        def chain_tau():
+            if store is not None:
+                chain = np.concatenate([chunk[1] for chunk in read_chunks()])
+            else:
+                chain = sampler.get_chain()
+            return emcee.autocorr.integrated_time(chain[:, :, np.logical_not(is_fixed)], tol=0)
+
+        # Length of the runs between two checkpoints or convergence tests
+        segment = nmcmc
+        if store is not None:
+            segment = checkpoint_every
+        if autocorr:
+            segment = min(segment, check_every)
+        free = np.logical_not(is_fixed)
+        tau = None
+        oldtau = np.inf
+        converged = False
 
-        axes[-1].set_xlabel("step number")
+        try:
+            while done < nmcmc:
+                nstep = min(segment, nmcmc - done)
+                state = sampler.run_mcmc(state, nstep, progress=verbose)
+                if store is not None:
+                    store.save('chain_%08d' % done, chain=sampler.get_chain())
+                    rs = state.random_state
+                    store.save('state', coords=state.coords, log_prob=state.log_prob, nstep=done + nstep, rs_key=rs[1], rs_pos=rs[2],
+                               rs_has_gauss=rs[3], rs_gauss=rs[4])
+                    sampler.reset()
+                done = done + nstep
+                if autocorr:
+                    tau = chain_tau()
+                    # The chain must be ntau autocorrelation times long and the estimate of tau must be stable
+                    converged = np.all(ntau * tau < done) and np.all(np.abs(oldtau - tau) / tau < tau_tol)
+                    oldtau = tau
+                    if converged:
+                        break
+        finally:
+            if own_pool is not None:
+                own_pool.close()
+                own_pool.join()
+
+        if autocorr:
+            if tau is None:
+                # Resumed from a chain that was already complete
+                tau = chain_tau()
+                converged = np.all(ntau * tau < done)
+            self.tau = np.full(npar, np.nan)
+            self.tau[free] = tau
+            self.converged = converged
+            if converged:
+                print('Chain converged after %d steps, maximum autocorrelation time %g steps' % (done, np.max(tau)))
+            else:
+                print('Warning: the chain was stopped after %d steps and is not converged, the maximum autocorrelation time is %g steps' % (done, np.max(tau)))
+            burnin = int(2. * np.max(tau))
+            thin = max(int(0.5 * np.min(tau)), 1)
+
+        if store is None:
+            samples = sampler.get_chain(discard=burnin, thin=thin, flat=True)
+            samp_plot = None
+            if plot:
+                samp_plot = sampler.get_chain()
+        else:
+            # Read back the thinned samples from the chunks of the chain
+            samples, chunks = [], []
+            for first, chain in read_chunks():
+                # Same selection as emcee's get_chain(discard=burnin, thin=thin)
+                keep = np.arange(first, first + len(chain)) - (burnin + thin - 1)
+                keep = (keep >= 0) & (keep % thin == 0)
+                samples.append(chain[keep].reshape(-1, ndim))
+                if plot:
+                    chunks.append(chain)
+            samples = np.concatenate(samples)
+            samp_plot = None
+            if plot:
+                samp_plot = np.concatenate(chunks)
+
+        if plot:
+            fig, axes = plt.subplots(npar, figsize=(10, 7), sharex=True)
+            labels = self.mod.parnames
+            for i in range(ndim):
+                ax = axes[i]
+                ax.plot(samp_plot[:, :, i], "k", alpha=0.3)
+                ax.set_xlim(0, len(samp_plot))
+                ax.set_ylabel(labels[i])
+                ax.yaxis.set_label_coords(-0.1, 0.5)
+
+            axes[-1].set_xlabel("step number")
 
         self.samples = samples
 
@@ -0,0 +1,336 @@
+import numpy as np
+from scipy.sparse import csr_matrix
+
+
+class PixelGeometry(object):
+    """
+    Cache of the pixel geometry maps used to extract profiles around a given center: distance to the center, position angles, rotated coordinates and elliptical radii. Maps are computed on first use and reused until the center, pixel size or image size change. The elliptical maps are stored for the last requested ellipse configuration only.
+
+    :param shape: Shape of the image
+    :type shape: tuple
+    :param cx: X coordinate of the center in image pixels (0-based)
+    :type cx: float
+    :param cy: Y coordinate of the center in image pixels (0-based)
+    :type cy: float
+    :param pixsize: Pixel size in arcmin
+    :type pixsize: float
+    """
+    def __init__(self, shape, cx, cy, pixsize):
+        """
+        Constructor of class PixelGeometry
+        """
+        self.shape = tuple(shape)
+        self.cx = cx
+        self.cy = cy
+        self.pixsize = pixsize
+        self.ellkey = None
+        self.maps = {}
+        self.ellmaps = {}
+
+    def matches(self, shape, cx, cy, pixsize):
+        """
+        Check whether the cached maps are valid for a given image shape, center and pixel size
+
+        :param shape: Shape of the image
+        :type shape: tuple
+        :param cx: X coordinate of the center in image pixels
+        :type cx: float
+        :param cy: Y coordinate of the center in image pixels
+        :type cy: float
+        :param pixsize: Pixel size in arcmin
+        :type pixsize: float
+        :return: True if the cache can be used
+        :rtype: bool
+        """
+        return self.shape == tuple(shape) and self.cx == cx and self.cy == cy and self.pixsize == pixsize
+
+    def offsets(self):
+        """
+        Offsets of pixel rows and columns from the center, in pixels, with shapes (ny, 1) and (1, nx) such that they broadcast to the image shape
+
+        :return: Y and X offsets
+        :rtype: class:`numpy.ndarray`
+        """
+        dy = (np.arange(self.shape[0]) - self.cy).reshape(-1, 1)
+        dx = (np.arange(self.shape[1]) - self.cx).reshape(1, -1)
+        return dy, dx
+
+    def supersample(self, subpix, row_start=0, row_end=None):
+        """
+        Geometry of a block of image rows in which each pixel is split into subpix x subpix sub-pixels. All the maps of the returned object are evaluated at the center of the sub-pixels, with sub-pixel (j, i) belonging to pixel (row_start + j // subpix, i // subpix) of the original image.
+
+        :param subpix: Number of sub-pixels along each axis
+        :type subpix: int
+        :param row_start: First row of the block. Defaults to 0
+        :type row_start: int
+        :param row_end: Last row of the block (excluded). If None, go to the end of the image. Defaults to None
+        :type row_end: int
+        :return: Supersampled geometry
+        :rtype: class:`pyproffit.geometry.PixelGeometry`
+        """
+        if row_end is None:
+            row_end = self.shape[0]
+        shape = ((row_end - row_start) * subpix, self.shape[1] * subpix)
+        cx = (self.cx + 0.5) * subpix - 0.5
+        cy = (self.cy - row_start + 0.5) * subpix - 0.5
+        return PixelGeometry(shape, cx, cy, self.pixsize / subpix)
+
+    def rcirc(self):
+        """
+        Circular distance of each pixel to the center, in arcmin
+
+        :return: Distance map
+        :rtype: class:`numpy.ndarray`
+        """
+        if 'rcirc' not in self.maps:
+            dy, dx = self.offsets()
+            self.maps['rcirc'] = np.hypot(dx, dy) * self.pixsize
+        return self.maps['rcirc']
+
+    def angles(self):
+        """
+        Position angle of each pixel with respect to the center, counted from the X axis and set between 0 and 2pi
+
+        :return: Angle map in radians
+        :rtype: class:`numpy.ndarray`
+        """
+        if 'angles' not in self.maps:
+            dy, dx = self.offsets()
+            angles = np.arctan2(dy, dx)
+            aneg = np.where(angles < 0.)
+            angles[aneg] = angles[aneg] + 2. * np.pi
+            self.maps['angles'] = angles
+        return self.maps['angles']
+
+    def sector_angles(self, anglow):
+        """
+        Position angle of each pixel relative to a lower angle anglow, set between 0 and 2pi
+
+        :param anglow: Lower angle in radians
+        :type anglow: float
+        :return: Angle map in radians
+        :rtype: class:`numpy.ndarray`
+        """
+        angles = self.angles()
+        if anglow == 0.:
+            return angles
+        return np.where(angles < anglow, angles + 2. * np.pi - anglow, angles - anglow)
+
+    def _ellipse(self, ellipse_ratio, rotation_angle):
+        key = (ellipse_ratio, rotation_angle)
+        if self.ellkey != key:
+            self.ellmaps = {}
+            self.ellkey = key
+        return self.ellmaps
+
+    def xtil(self, ellipse_ratio=1.0, rotation_angle=0.0):
+        """
+        Coordinate of each pixel along the major axis of the ellipse, in arcmin
+
+        :param ellipse_ratio: Ratio a/b of major to minor axis. Defaults to 1.0
+        :type ellipse_ratio: float
+        :param rotation_angle: Rotation angle of the ellipse respective to the R.A. axis in degrees. Defaults to 0
+        :type rotation_angle: float
+        :return: Coordinate map
+        :rtype: class:`numpy.ndarray`
+        """
+        ellmaps = self._ellipse(ellipse_ratio, rotation_angle)
+        if 'xtil' not in ellmaps:
+            ellang = (rotation_angle - 90.) * np.pi / 180.
+            dy, dx = self.offsets()
+            ellmaps['xtil'] = np.cos(ellang) * dx * self.pixsize + np.sin(ellang) * dy * self.pixsize
+        return ellmaps['xtil']
+
+    def ytil(self, ellipse_ratio=1.0, rotation_angle=0.0):
+        """
+        Coordinate of each pixel along the minor axis of the ellipse, in arcmin
+
+        :param ellipse_ratio: Ratio a/b of major to minor axis. Defaults to 1.0
+        :type ellipse_ratio: float
+        :param rotation_angle: Rotation angle of the ellipse respective to the R.A. axis in degrees. Defaults to 0
+        :type rotation_angle: float
+        :return: Coordinate map
+        :rtype: class:`numpy.ndarray`
+        """
+        ellmaps = self._ellipse(ellipse_ratio, rotation_angle)
+        if 'ytil' not in ellmaps:
+            ellang = (rotation_angle - 90.) * np.pi / 180.
+            dy, dx = self.offsets()
+            ellmaps['ytil'] = -np.sin(ellang) * dx * self.pixsize + np.cos(ellang) * dy * self.pixsize
+        return ellmaps['ytil']
+
+    def rads(self, ellipse_ratio=1.0, rotation_angle=0.0):
+        """
+        Elliptical radius of each pixel, in arcmin
+
+        :param ellipse_ratio: Ratio a/b of major to minor axis. Defaults to 1.0
+        :type ellipse_ratio: float
+        :param rotation_angle: Rotation angle of the ellipse respective to the R.A. axis in degrees. Defaults to 0
+        :type rotation_angle: float
+        :return: Radius map
+        :rtype: class:`numpy.ndarray`
+        """
+        ellmaps = self._ellipse(ellipse_ratio, rotation_angle)
+        if 'rads' not in ellmaps:
+            xtil = self.xtil(ellipse_ratio, rotation_angle)
+            ytil = self.ytil(ellipse_ratio, rotation_angle)
+            ellmaps['rads'] = ellipse_ratio * np.hypot(xtil, ytil / ellipse_ratio)
+        return ellmaps['rads']
+
+    @property
+    def nbytes(self):
+        """
+        Total memory used by the cached maps, in bytes
+        """
+        return sum(arr.nbytes for arr in self.maps.values()) + sum(arr.nbytes for arr in self.ellmaps.values())
+
+    def clear(self):
+        """
+        Free all cached maps
+        """
+        self.maps = {}
+        self.ellmaps = {}
+        self.ellkey = None
+
+    def info(self):
+        """
+        Print the content and memory footprint of the cache
+        """
+        print('Pixel geometry cache for center (%g, %g) on a %d x %d image' % (self.cx + 1, self.cy + 1, self.shape[1], self.shape[0]))
+        for name, arr in list(self.maps.items()) + list(self.ellmaps.items()):
+            print('  %s: %.1f MB' % (name, arr.nbytes / 1024. ** 2))
+        print('Total memory: %.1f MB' % (self.nbytes / 1024. ** 2))
+
+
+class ProjectionOperator(object):
+    """
+    Sparse operator projecting images onto a set of radial bins. The operator is stored as a CSR matrix of shape (nbin, npix) acting on the values of the npix pixels that belong to at least one bin, such that the sum of an image within each bin is obtained with a single sparse matrix product. Once built for a given center, binning and mask, the operator can be applied to any number of images of the same size (energy bands, background maps, simulations...).
+
+    :param matrix: Sparse matrix of shape (nbin, npix) containing the weight of each pixel in each bin
+    :type matrix: class:`scipy.sparse.csr_matrix`
+    :param pixels: Flat indices of the npix pixels in the image
+    :type pixels: class:`numpy.ndarray`
+    :param shape: Shape of the image
+    :type shape: tuple
+    """
+    def __init__(self, matrix, pixels, shape):
+        """
+        Constructor of class ProjectionOperator
+        """
+        self.matrix = matrix.tocsr()
+        self.pixels = pixels
+        self.shape = tuple(shape)
+        self.nbin = matrix.shape[0]
+        self.npix = np.asarray(self.matrix.sum(axis=1)).ravel()
+
+    @classmethod
+    def from_labels(cls, labels, nbin):
+        """
+        Build a projection operator from an array of pixel labels, as returned by :func:`pyproffit.miscellaneous.sort_pixels`
+
+        :param labels: Array containing the bin index of each pixel, -1 for pixels outside of the binning
+        :type labels: class:`numpy.ndarray`
+        :param nbin: Number of bins
+        :type nbin: int
+        :return: Projection operator
+        :rtype: class:`pyproffit.geometry.ProjectionOperator`
+        """
+        flat = labels.ravel()
+        pixels = np.flatnonzero(flat >= 0)
+        npt = len(pixels)
+        matrix = csr_matrix((np.ones(npt), (flat[pixels], np.arange(npt))), shape=(nbin, npt))
+        return cls(matrix, pixels, labels.shape)
+
+    @classmethod
+    def from_weights(cls, matrix, shape):
+        """
+        Build a projection operator from a sparse matrix of shape (nbin, ny*nx) giving the weight of every pixel of the image in each bin, e.g. the fraction of the pixel area overlapping with each annulus. Pixels with no weight in any bin are dropped.
+
+        :param matrix: Sparse weight matrix
+        :type matrix: class:`scipy.sparse.spmatrix`
+        :param shape: Shape of the image
+        :type shape: tuple
+        :return: Projection operator
+        :rtype: class:`pyproffit.geometry.ProjectionOperator`
+        """
+        matrix = csr_matrix(matrix)
+        matrix.sum_duplicates()
+        matrix.eliminate_zeros()
+        pixels = np.unique(matrix.indices)
+        return cls(matrix[:, pixels], pixels, shape)
+
+    @property
+    def sqmatrix(self):
+        """
+        Matrix containing the squared pixel weights, used to propagate the variance of the pixel values. Identical to the projection matrix when all weights are equal to one.
+        """
+        if not hasattr(self, '_sqmatrix'):
+            if np.all(self.matrix.data == 1.):
+                self._sqmatrix = self.matrix
+            else:
+                self._sqmatrix = self.matrix.power(2)
+        return self._sqmatrix
+
+    def values(self, image):
+        """
+        Extract the values of the pixels on which the operator acts
+
+        :param image: Image or stack of images with the last two dimensions matching the shape of the operator
+        :type image: class:`numpy.ndarray`
+        :return: Pixel values, with shape (npix,) or (nimg, npix)
+        :rtype: class:`numpy.ndarray`
+        """
+        image = np.asarray(image)
+        if image.ndim == 2:
+            return np.take(image, self.pixels)
+        return np.take(image.reshape(-1, self.shape[0] * self.shape[1]), self.pixels, axis=1)
+
+    def project(self, image):
+        """
+        Sum an image or a stack of images within each bin
+
+        :param image: Image of the same shape as the operator or stack of images of shape (nimg, ny, nx)
+        :type image: class:`numpy.ndarray`
+        :return: Sum of the image in each bin, with shape (nbin,) or (nimg, nbin)
+        :rtype: class:`numpy.ndarray`
+        """
+        vals = self.values(image)
+        if vals.ndim == 1:
+            return self.matrix.dot(vals)
+        return self.matrix.dot(vals.T).T
+
+    def __call__(self, image):
+        return self.project(image)
+
+    def bin_pixels(self, n):
+        """
+        Flat indices of the pixels belonging to a given bin
+
+        :param n: Bin number
+        :type n: int
+        :return: Pixel indices
+        :rtype: class:`numpy.ndarray`
+        """
+        matrix = self.matrix
+        return self.pixels[matrix.indices[matrix.indptr[n]:matrix.indptr[n + 1]]]
+
+    def labels(self):
+        """
+        Image containing the bin index of each pixel, -1 for pixels that do not belong to any bin. For operators with fractional pixel weights, pixels shared between several bins are assigned to the last of them.
+
+        :return: Label image
+        :rtype: class:`numpy.ndarray`
+        """
+        matrix = self.matrix
+        labels = np.full(self.shape[0] * self.shape[1], -1, dtype=int)
+        rows = np.repeat(np.arange(self.nbin), np.diff(matrix.indptr))
+        labels[self.pixels[matrix.indices]] = rows
+        return labels.reshape(self.shape)
+
+    @property
+    def nbytes(self):
+        """
+        Memory used by the operator, in bytes
+        """
+        matrix = self.matrix
+        return matrix.data.nbytes + matrix.indices.nbytes + matrix.indptr.nbytes + self.pixels.nbytes
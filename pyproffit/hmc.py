@@ -1,7 +1,9 @@
 import pymc as pm
+import pytensor.tensor as pt
+from pytensor.ifelse import ifelse
 import numpy as np
 import time
-from .models import IntFunc
+import math
 
 def BetaModelPM(x, beta, rc, norm, bkg):
     """
@@ -49,20 +51,58 @@ def VikhlininPM(x,beta,rc,alpha,rs,epsilon,gamma,norm,bkg):
 
 def IntFuncPM(omega,rf,alpha,xmin,xmax):
     """
+    Closed-form line-of-sight integral of :func:`pyproffit.models.IntFunc` for a symbolic :math:`\\alpha` parameter, differentiable with respect to :math:`\\alpha`. The integral is obtained by integration by parts from the one at :math:`\\alpha+1`, which is expressed with the regularized incomplete beta function. Since this expression is singular at :math:`\\alpha=1/2`, for :math:`|\\alpha-1/2|<0.05` the integral is computed instead from its Taylor expansion around :math:`\\alpha=1/2`, whose coefficients are integrated numerically. For :math:`-1/2 < \\alpha \\leq 5` the integral agrees with :func:`pyproffit.models.IntFunc` to better than :math:`2\\times 10^{-7}` and the derivative with respect to :math:`\\alpha` to better than :math:`3\\times 10^{-4}`, the accuracy being limited by that of the incomplete beta function and its derivatives in pytensor.
+
+    :param omega: Projected radius
+    :type omega: numpy.ndarray
+    :param rf: rf parameter
+    :type rf: float
+    :param alpha: :math:`\\alpha` parameter
+    :type alpha: class:`pytensor.tensor`
+    :param xmin: xmin parameter
+    :type xmin: numpy.ndarray
+    :param xmax: xmax parameter
+    :type xmax: numpy.ndarray
+    :return: Line-of-sight integral
+    :rtype: class:`pytensor.tensor`
     """
-    nb = 100
-    logmin = pm.math.log(xmin) / pm.math.log(10.)
-    logmax = pm.math.log(xmax) / pm.math.log(10.)
-    intot = 0.
-    for i in range(nb):
-        basex_low = (logmin + i / nb * (logmax - logmin))
-        basex_high = (logmin + (i+1) / nb * (logmax - logmin))
-        z = (10 ** basex_low + 10 ** basex_high) / 2.
-        width = 10 ** basex_high - 10 ** basex_low
-        term1 = (omega**2 + z**2) / rf**2
-        term2 = term1 ** (-alpha)
-        intot = intot + term2 * width
-    return intot
+    om2 = (omega / rf) ** 2
+    lmin = xmin / rf
+    lmax = xmax / rf
+
+    # Taylor expansion around alpha=1/2, the coefficients being integrated with Gauss-Legendre quadrature in u = asinh(l / omega)
+    half_width, norder = 0.05, 12
+    nodes, weights = np.polynomial.legendre.leggauss(64)
+    umin = np.arcsinh(lmin / np.sqrt(om2))
+    umax = np.arcsinh(lmax / np.sqrt(om2))
+    u = 0.5 * (umax - umin)[:, np.newaxis] * (nodes + 1.) + umin[:, np.newaxis]
+    loglos = - np.log(om2[:, np.newaxis] * np.cosh(u) ** 2)
+    taylor = 0.
+    for n in range(norder + 1):
+        coef = 0.5 * (umax - umin) * np.sum(weights * loglos ** n, axis=1) / math.factorial(n)
+        taylor = taylor + coef * (alpha - 0.5) ** n
+
+    # Away from alpha=1/2, integral at alpha+1 as a difference of incomplete beta functions of t = l^2 / (omega^2 + l^2), or of 1-t when t is close to 1
+    near = pt.lt(pt.abs(alpha - 0.5), half_width)
+    alpha_far = pt.switch(near, 1., alpha)
+    q = alpha_far + 0.5
+    tmin = lmin ** 2 / (om2 + lmin ** 2)
+    tmax = lmax ** 2 / (om2 + lmax ** 2)
+    smin = om2 / (om2 + lmin ** 2)
+    smax = om2 / (om2 + lmax ** 2)
+    comp = np.where(tmin >= 0.5)[0]
+    direct = np.where(tmin < 0.5)[0]
+    order = np.argsort(np.concatenate((direct, comp)))
+    # The parameter is broadcast explicitly to the shape of each subset, which avoids failures of the graph rewrites of the gradient
+    qdir = pt.alloc(q, len(direct))
+    qcomp = pt.alloc(q, len(comp))
+    diff = pt.concatenate([pt.betainc(0.5, qdir, tmax[direct]) - pt.betainc(0.5, qdir, tmin[direct]),
+                           pt.betainc(qcomp, 0.5, smin[comp]) - pt.betainc(qcomp, 0.5, smax[comp])])[order]
+    intnext = 0.5 * om2 ** (-alpha_far - 0.5) * pt.exp(pt.special.betaln(0.5, q)) * diff
+    bound = lmax * (om2 + lmax ** 2) ** (-alpha_far) - lmin * (om2 + lmin ** 2) ** (-alpha_far)
+    far = (bound - 2. * alpha_far * om2 * intnext) / (1. - 2. * alpha_far)
+
+    return rf * ifelse(near, taylor, far)
 
 def BknPowPM(x, alpha1, alpha2, norm, jump, bkg, rf=3.0):
     """
@@ -99,13 +139,14 @@ def BknPowPM(x, alpha1, alpha2, norm, jump, bkg, rf=3.0):
     A1 = 10. ** norm
     A2 = A1 / (jump ** 2)
     inreg = np.where(x < rf)
-    term1 = IntFunc(x[inreg], rf, alpha1, 0.01 * np.ones(len(x[inreg])), np.sqrt(rf ** 2 - x[inreg] ** 2))
-    term2 = IntFunc(x[inreg], rf, alpha2, np.sqrt(rf ** 2 - x[inreg] ** 2), 1e3 * np.ones(len(x[inreg])))
+    term1 = IntFuncPM(x[inreg], rf, alpha1, 0.01 * np.ones(len(x[inreg])), np.sqrt(rf ** 2 - x[inreg] ** 2))
+    term2 = IntFuncPM(x[inreg], rf, alpha2, np.sqrt(rf ** 2 - x[inreg] ** 2), 1e3 * np.ones(len(x[inreg])))
     inside = A1 * term1 + A2 * term2
     outreg = np.where(x >= rf)
-    term = IntFunc(x[outreg], rf, alpha2, 0.01 * np.ones(len(x[outreg])), 1e3 * np.ones(len(x[outreg])))
+    term = IntFuncPM(x[outreg], rf, alpha2, 0.01 * np.ones(len(x[outreg])), 1e3 * np.ones(len(x[outreg])))
     outside = A2 * term
-    out = pm.math.stack([inside, outside])
+    # The radii are sorted, such that the bins inside rf come first
+    out = pm.math.concatenate([inside, outside])
     c2 = 10. ** bkg
     return out + c2
 
@@ -2,6 +2,11 @@ import numpy as np
 from scipy.spatial.distance import  cdist
 from scipy.stats import poisson
 import  copy
+from .geometry import ProjectionOperator
+from scipy.sparse import csr_matrix
+from scipy.sparse.csgraph import connected_components
+from concurrent.futures import ThreadPoolExecutor
+from scipy.fft import rfft2, irfft2, next_fast_len
 
 def logbinning(binsize,maxrad):
     """
@@ -51,10 +56,374 @@ def logbinning(binsize,maxrad):
     return bn,ebn
 
 
-def median_all_cov(dat, bins, ebins, rads, nsim=1000, fitter=None, thin=10):
+def bin_edges(bins, ebins, tol=0.5e-5):
+    """
+    Compute the boundaries of a radial binning scheme as they are used to sort pixels into bins. The boundaries are rounded to 5 decimals and shifted by a small tolerance, the first bin starting at 0.
+
+    :param bins: Central value of radial binning
+    :type bins: class:`numpy.ndarray`
+    :param ebins: Half-width of radial binning
+    :type ebins: class:`numpy.ndarray`
+    :param tol: Tolerance added to the rounded boundaries. Defaults to 0.5e-5
+    :type tol: float
+    :return:
+        - Lower boundary of each bin
+        - Upper boundary of each bin
+    :rtype: class:`numpy.ndarray`
+    """
+    lo = np.round(bins - ebins, 5) + tol
+    hi = np.round(bins + ebins, 5) + tol
+    lo[0] = 0.
+    return lo, hi
+
+
+def sort_pixels(rads, bins, ebins, mask=None, tol=0.5e-5):
+    """
+    Assign each pixel of an image to a radial bin in a single pass. Pixel i is attributed to bin n if lo[n] <= rads[i] < hi[n], with lo and hi the bin boundaries returned by :func:`pyproffit.miscellaneous.bin_edges`.
+
+    :param rads: Array containing the distance to the center, in arcmin, for each pixel
+    :type rads: class:`numpy.ndarray`
+    :param bins: Central value of radial binning
+    :type bins: class:`numpy.ndarray`
+    :param ebins: Half-width of radial binning
+    :type ebins: class:`numpy.ndarray`
+    :param mask: Boolean array of the same shape as rads setting which pixels can be used. If None, all pixels are used. Defaults to None
+    :type mask: class:`numpy.ndarray` , optional
+    :param tol: Tolerance added to the rounded bin boundaries. Defaults to 0.5e-5
+    :type tol: float
+    :return: Array of the same shape as rads containing the bin index of each pixel, or -1 for pixels outside of the binning
+    :rtype: class:`numpy.ndarray`
+    """
+    nbin = len(bins)
+    lo, hi = bin_edges(bins, ebins, tol=tol)
+    labels = np.searchsorted(hi, rads, side='right')
+    inbin = labels < nbin
+    inbin[inbin] = rads[inbin] >= lo[labels[inbin]]
+    if mask is not None:
+        inbin = np.logical_and(inbin, mask)
+    labels[np.logical_not(inbin)] = -1
+    return labels
+
+
+def sector_limits(angle_low, angle_high):
+    """
+    Convert the position angles of a sector into the lower angle of the sector and the angular extent of the sector, both in radians between 0 and 2pi. A sector then includes all the pixels with a position angle relative to the lower angle between 0 and the angular extent.
+
+    :param angle_low: Lower position angle of the sector in degrees
+    :type angle_low: float
+    :param angle_high: Upper position angle of the sector in degrees
+    :type angle_high: float
+    :return:
+        - Lower angle in radians
+        - Angular extent in radians
+    :rtype: float
+    """
+    # Convert degree to radian and rescale to 0-2pi
+    if angle_low != 0.0 or angle_high != 360.:
+        if angle_low < 0.0:
+            anglow = np.deg2rad(np.fmod(angle_low, 360.) + 360.)
+        else:
+            anglow = np.deg2rad(np.fmod(angle_low, 360.))
+        if angle_high < 0.0:
+            anghigh = np.deg2rad(np.fmod(angle_high, 360.) + 360.)
+        else:
+            anghigh = np.deg2rad(np.fmod(angle_high, 360.))
+    else:
+        anglow = 0.
+        anghigh = 2. * np.pi
+    # Set angles relative to anglow
+    if anghigh<anglow: #We cross the zero
+        anghigh = anghigh + 2.*np.pi - anglow
+    else:
+        anghigh = anghigh - anglow
+    return anglow, anghigh
+
+
+def bin_sums(idx, nbin, *vals):
+    """
+    Sum pixel values within radial bins given the bin index of each pixel, as returned by :func:`pyproffit.miscellaneous.sort_pixels`
+
+    :param idx: Bin index of each selected pixel
+    :type idx: class:`numpy.ndarray`
+    :param nbin: Number of bins
+    :type nbin: int
+    :param vals: Arrays of the same length as idx containing the values to be summed
+    :return:
+        - Number of pixels in each bin
+        - List containing the sum of each input array in each bin
+    :rtype: class:`numpy.ndarray`
+    """
+    npix = np.bincount(idx, minlength=nbin)
+    sums = [np.bincount(idx, weights=tv, minlength=nbin) for tv in vals]
+    return npix, sums
+
+
+def psf_mixing_matrix(labels, nbin, kernel, weights=None, workers=1):
+    """
+    Compute a PSF mixing matrix by convolving the image of each radial bin with a PSF kernel and summing the convolved image within each bin. Each bin image is convolved within a window covering the bin and the support of the kernel only, using real FFTs whose size is rounded up to a small set of values such that the Fourier transform of the kernel is computed once for each window size and reused across bins. The result is the same as convolving the full image with scipy.signal.convolve(mode='same').
+
+    :param labels: Image containing the bin index of each pixel, -1 for pixels outside of the bins
+    :type labels: class:`numpy.ndarray`
+    :param nbin: Number of bins
+    :type nbin: int
+    :param kernel: Normalized PSF kernel
+    :type kernel: class:`numpy.ndarray`
+    :param weights: Image of the surface brightness distribution within the bins. If None, a flat distribution is assumed. Defaults to None
+    :type weights: class:`numpy.ndarray`
+    :param workers: Number of threads among which the bins are distributed. Defaults to 1
+    :type workers: int
+    :return: Mixing matrix of shape (nbin, nbin), with element (i, j) the fraction of the flux of bin i falling into bin j
+    :rtype: class:`numpy.ndarray`
+    """
+    ny, nx = labels.shape
+    ky, kx = kernel.shape
+    # Offset of the 'same' convolution within the full convolution
+    oy, ox = (ky - 1) // 2, (kx - 1) // 2
+    flat = labels.ravel()
+    pix = np.flatnonzero(flat >= 0)
+    order = np.argsort(flat[pix], kind='stable')
+    starts = np.concatenate(([0], np.cumsum(np.bincount(flat[pix], minlength=nbin))))
+    kffts = {}
+    psfout = np.zeros((nbin, nbin))
+
+    def fft_size(n):
+        return next_fast_len(int(32 * np.ceil(n / 32.)), True)
+
+    def convolve_bin(n):
+        region = pix[order[starts[n]:starts[n + 1]]]
+        npt = len(region)
+        if npt == 0:
+            return
+        yr, xr = np.divmod(region, nx)
+        y0, y1, x0, x1 = yr.min(), yr.max() + 1, xr.min(), xr.max() + 1
+        imgt = np.zeros((y1 - y0, x1 - x0))
+        if weights is None:
+            imgt[yr - y0, xr - x0] = 1. / npt
+        else:
+            wreg = weights.flat[region]
+            imgt[yr - y0, xr - x0] = wreg / np.sum(wreg)
+        fshape = (fft_size(y1 - y0 + ky - 1), fft_size(x1 - x0 + kx - 1))
+        kfft = kffts.get(fshape)
+        if kfft is None:
+            kfft = rfft2(kernel, fshape)
+            kffts[fshape] = kfft
+        full = irfft2(rfft2(imgt, fshape) * kfft, fshape)
+        # Part of the image reached by the convolved bin
+        i0, i1 = max(y0 - oy, 0), min(y1 + ky - 1 - oy, ny)
+        j0, j1 = max(x0 - ox, 0), min(x1 + kx - 1 - ox, nx)
+        blurred = full[i0 + oy - y0:i1 + oy - y0, j0 + ox - x0:j1 + ox - x0]
+        blurred = np.where(blurred < 1e-15, 0., blurred)
+        lab = labels[i0:i1, j0:j1]
+        inbins = lab >= 0
+        psfout[n] = np.bincount(lab[inbins], weights=blurred[inbins], minlength=nbin)
+
+    if workers > 1:
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            list(pool.map(convolve_bin, range(nbin)))
+    else:
+        for n in range(nbin):
+            convolve_bin(n)
+    return psfout
+
+
+def disk_overlap(a, r, s):
+    """
+    Area of the intersection of two disks of radii a and r whose centers are separated by a distance s
+
+    :param a: Radius of the first disk
+    :type a: class:`numpy.ndarray`
+    :param r: Radius of the second disk
+    :type r: class:`numpy.ndarray`
+    :param s: Distance between the centers, strictly positive
+    :type s: class:`numpy.ndarray`
+    :return: Overlap area
+    :rtype: class:`numpy.ndarray`
+    """
+    cosa = np.clip((s ** 2 + a ** 2 - r ** 2) / (2. * s * a), -1., 1.)
+    cosr = np.clip((s ** 2 + r ** 2 - a ** 2) / (2. * s * r), -1., 1.)
+    tri = (-s + a + r) * (s + a - r) * (s - a + r) * (s + a + r)
+    return a ** 2 * np.arccos(cosa) + r ** 2 * np.arccos(cosr) - 0.5 * np.sqrt(np.maximum(tri, 0.))
+
+
+def psf_radial_matrix(bins, ebins, psffunc, rmax, coverage=None, sourcemodel=None, nsub=8, ns=512, maxsize=4000000):
+    """
+    Compute a PSF mixing matrix for circular annuli and an azimuthally symmetric PSF without going through images. The flux of a disk of radius a convolved with the PSF falling within a disk of radius r is
+
+    .. math::
+
+        O(a, r) = \\int_0^{r_{max}} P(s) A(a, r, s) 2 \\pi s ds
+
+    with P the normalized PSF and A(a, r, s) the overlap area of two disks of radii a and r separated by a distance s. The fraction of the flux of annulus i falling into annulus j then follows from the values of O at the bin edges. In case a surface brightness model is provided, each bin is split into nsub rings weighted by the model at their center.
+
+    The edges of the image and masked pixels are accounted for only through per-bin correction factors applied to the fraction of the flux received by each bin, which are expected to be the ratio of the area covered by the pixels of each bin to the area of the full annulus.
+
+    :param bins: Central value of radial bins (in arcmin). The boundaries of the annuli are computed with :func:`pyproffit.miscellaneous.bin_edges`
+    :type bins: class:`numpy.ndarray`
+    :param ebins: Half-size of radial bins (in arcmin)
+    :type ebins: class:`numpy.ndarray`
+    :param psffunc: Function describing the radial shape of the PSF, with the radius in arcmin
+    :type psffunc: function
+    :param rmax: Truncation radius of the PSF in arcmin
+    :type rmax: float
+    :param coverage: Fraction of the area of each annulus covered by the image. If None, the annuli are assumed to be complete. Defaults to None
+    :type coverage: class:`numpy.ndarray`
+    :param sourcemodel: Object of type :class:`pyproffit.models.Model` describing the surface brightness distribution across the bins. If None, a flat distribution is assumed. Defaults to None
+    :type sourcemodel: class:`pyproffit.models.Model`
+    :param nsub: Number of rings into which each bin is split when sourcemodel is provided. Defaults to 8
+    :type nsub: int
+    :param ns: Number of logarithmically spaced points between 1e-4 rmax and rmax used to integrate over the PSF. Defaults to 512
+    :type ns: int
+    :param maxsize: Maximum number of overlap areas computed at once. Defaults to 4e6
+    :type maxsize: int
+    :return: Mixing matrix of shape (nbin, nbin), with element (i, j) the fraction of the flux of bin i falling into bin j
+    :rtype: class:`numpy.ndarray`
+    """
+    nbin = len(bins)
+    inner, outer = bin_edges(bins, ebins)
+    if sourcemodel is None or sourcemodel.params is None:
+        nsub = 1
+    frac = np.linspace(0., 1., nsub + 1)
+    subedges = inner[:, np.newaxis] + (outer - inner)[:, np.newaxis] * frac
+    if nsub > 1:
+        mid = 0.5 * (subedges[:, 1:] + subedges[:, :-1])
+        subw = sourcemodel.model(mid, *sourcemodel.params) * (subedges[:, 1:] ** 2 - subedges[:, :-1] ** 2)
+        subw = subw / np.sum(subw, axis=1)[:, np.newaxis]
+    else:
+        subw = np.ones((nbin, 1))
+    srcedges, srcind = np.unique(subedges, return_inverse=True)
+    srcind = srcind.reshape(subedges.shape)
+    tgtedges, tgtind = np.unique(np.append(inner, outer), return_inverse=True)
+
+    # PSF integration weights on a logarithmic grid, normalized such that the PSF integrates to 1 within rmax
+    sedges = rmax * np.logspace(-4., 0., ns + 1)
+    sedges[0] = 0.
+    svals = 0.5 * (sedges[1:] + sedges[:-1])
+    wpsf = psffunc(svals) * (sedges[1:] ** 2 - sedges[:-1] ** 2)
+    wpsf = wpsf / np.sum(wpsf)
+
+    # For separations smaller than |a - r| the smaller disk is fully contained in the larger one, and for separations
+    # larger than a + r the disks do not overlap, such that the overlap area needs to be computed only in between
+    a, r = np.meshgrid(srcedges, tgtedges, indexing='ij')
+    encpsf = np.append(0., np.cumsum(wpsf))
+    overlap = np.pi * np.minimum(a, r) ** 2 * encpsf[np.searchsorted(svals, np.abs(a - r), side='right')]
+    sel = (a > 0.) & (r > 0.)
+    if nsub == 1:
+        # O is symmetric
+        sel = sel & (a <= r)
+    ia, ir = np.nonzero(sel)
+    nchunk = max(1, int(maxsize / ns))
+    for i in range(0, len(ia), nchunk):
+        ca, cr = ia[i:i + nchunk], ir[i:i + nchunk]
+        pair, snode = np.nonzero((svals > np.abs(srcedges[ca] - tgtedges[cr])[:, np.newaxis]) &
+                                 (svals < (srcedges[ca] + tgtedges[cr])[:, np.newaxis]))
+        area = disk_overlap(srcedges[ca[pair]], tgtedges[cr[pair]], svals[snode])
+        overlap[ca, cr] += np.bincount(pair, weights=area * wpsf[snode], minlength=len(ca))
+    if nsub == 1:
+        overlap = np.where(a <= r, overlap, overlap.T)
+
+    # Fraction of the flux of each ring falling within each target radius, combined over the rings of each bin
+    ringflux = (overlap[srcind[:, 1:]] - overlap[srcind[:, :-1]]) / (np.pi * (subedges[:, 1:] ** 2 - subedges[:, :-1] ** 2))[:, :, np.newaxis]
+    encl = np.einsum('ik,ikj->ij', subw, ringflux)
+    psfout = encl[:, tgtind[nbin:]] - encl[:, tgtind[:nbin]]
+    if coverage is not None:
+        psfout = psfout * coverage
+    return psfout
+
+
+def weighted_median(vals, weights):
+    """
+    Median of a set of values with integer multiplicities along the last axis of an array. The result is identical to the median of the array in which each value is repeated the corresponding number of times.
+
+    :param vals: Array of values of shape (m, n), the median being computed over the n values of each of the m rows
+    :type vals: class:`numpy.ndarray`
+    :param weights: Integer multiplicity of each of the n values
+    :type weights: class:`numpy.ndarray`
+    :return: Median of each row
+    :rtype: class:`numpy.ndarray`
+    """
+    order = np.argsort(vals, axis=1)
+    svals = np.take_along_axis(vals, order, axis=1)
+    cumw = np.cumsum(weights[order], axis=1)
+    ntot = cumw[:, -1:]
+    # Positions of the central element(s) in the expanded sorted array
+    i1 = np.argmax(cumw > (ntot - 1) // 2, axis=1)
+    i2 = np.argmax(cumw > ntot // 2, axis=1)
+    rows = np.arange(vals.shape[0])
+    return 0.5 * (svals[rows, i1] + svals[rows, i2])
+
+
+def voronoi_cells(proj, img, errmap, maxmem=200.):
+    """
+    Identify the cells of a Voronoi image as the connected regions of pixels sharing the same value and error, among the pixels on which a projection operator acts. Pixels are connected to their four direct neighbours, such that distinct cells with identical values and errors are kept separate unless they share an edge. The pixels are labelled in stripes of image rows whose size is set by the memory budget maxmem, and the labels of the stripes are then merged, such that the memory used does not scale with the size of the image.
+
+    :param proj: Projection operator defining the pixels to be considered
+    :type proj: class:`pyproffit.geometry.ProjectionOperator`
+    :param img: Voronoi image
+    :type img: class:`numpy.ndarray`
+    :param errmap: Error map
+    :type errmap: class:`numpy.ndarray`
+    :param maxmem: Approximate memory budget in MB. Defaults to 200
+    :type maxmem: float
+    :return:
+        - Index of the cell of each pixel of the operator
+        - Array of shape (ncell, 2) containing the value and error of each cell
+    :rtype: class:`numpy.ndarray`
+    """
+    nx = proj.shape[1]
+    pixels = proj.pixels
+    npt = len(pixels)
+    imgf, errf = img.ravel(), errmap.ravel()
+    cellid = np.empty(npt, dtype=np.int32)
+    # About 150 bytes per pixel are used while labelling a stripe
+    chunk = max(int(maxmem * 1024. ** 2 / 150.), 1)
+    nrow = max(chunk // nx, 1)
+    rowstart = np.searchsorted(pixels, np.arange(0, proj.shape[0] + nrow, nrow) * nx)
+    ncell = 0
+    cross_rows, cross_cols, reps = [], [], []
+    for i0, i1 in zip(rowstart[:-1], rowstart[1:]):
+        if i1 == i0:
+            continue
+        pix = pixels[i0:i1]
+        vals, errs = imgf[pix], errf[pix]
+        rows, cols = [], []
+        for step, valid in ((1, pix % nx < nx - 1), (nx, np.ones(len(pix), dtype=bool))):
+            # Position of the right or lower neighbour of each pixel among all the pixels of the operator
+            neigh = np.minimum(np.searchsorted(pixels, pix + step), npt - 1)
+            link = np.flatnonzero(valid & (pixels[neigh] == pix + step))
+            link = link[(imgf[pixels[neigh[link]]] == vals[link]) & (errf[pixels[neigh[link]]] == errs[link])]
+            inside = neigh[link] < i1
+            rows.append(link[inside])
+            cols.append(neigh[link[inside]] - i0)
+            # Links with the next stripe are resolved once all the stripes are labelled
+            cross_rows.append(link[~inside] + i0)
+            cross_cols.append(neigh[link[~inside]])
+        rows, cols = np.concatenate(rows), np.concatenate(cols)
+        graph = csr_matrix((np.ones(len(rows), dtype=np.int8), (rows, cols)), shape=(len(pix), len(pix)))
+        nlab, labels = connected_components(graph, directed=False)
+        cellid[i0:i1] = labels + ncell
+        # Pixel representing each cell of the stripe
+        rep = np.empty(nlab, dtype=pix.dtype)
+        rep[labels] = pix
+        reps.append(rep)
+        ncell += nlab
+    # Merge the cells of the stripes that are connected across the stripe boundaries
+    cross_rows, cross_cols = cellid[np.concatenate(cross_rows)], cellid[np.concatenate(cross_cols)]
+    graph = csr_matrix((np.ones(len(cross_rows), dtype=np.int8), (cross_rows, cross_cols)), shape=(ncell, ncell))
+    ncell, merged = connected_components(graph, directed=False)
+    merged = merged.astype(np.int32)
+    cellid = merged[cellid]
+    rep = np.empty(ncell, dtype=pixels.dtype)
+    rep[merged] = np.concatenate(reps)
+    cells = np.column_stack((imgf[rep], errf[rep]))
+    return cellid, cells
+
+
+def median_all_cov(dat, bins, ebins, rads, nsim=1000, fitter=None, thin=10, proj=None, maxmem=200., workers=1, seed=None):
     """
     Generate Monte Carlo simulations of a Voronoi image and compute the median profile for each of them. The function returns an array of size (nbin, nsim) with nbin the number of bins in the profile and nsim the number of Monte Carlo simulations.
 
+    Only the pixels located within the bins are used. Since all the pixels of a Voronoi cell share the same value and error, the cells are identified with :func:`pyproffit.miscellaneous.voronoi_cells` and a single random realization is drawn for each cell, the median of each bin being computed over the cells weighted by their number of pixels in the bin. The simulations are performed in blocks whose size is set by the memory budget maxmem, which is also used to identify the cells in stripes of the image.
+
     :param dat:  A :class:`pyproffit.data.Data` object containing the input Voronoi image and error map
     :type dat: class:`pyproffit.data.Data`
     :param bins: Central value of radial binning
@@ -67,8 +436,16 @@ def median_all_cov(dat, bins, ebins, rads, nsim=1000, fitter=None, thin=10):
     :type nsim: int
     :param fitter: A :class:`pyproffit.fitter.Fitter` object containing the result of a fit to the background region, for subtraction of the background to the resulting profile
     :type fitter: class:`pyproffit.fitter.Fitter`
-    :param thin: Number of blocks into which the calculation of the bootstrap will be divided. Increasing thin reduces memory usage drastically, at the cost of a modest increase in computation time.
+    :param thin: Minimum number of blocks into which the calculation of the bootstrap will be divided. More blocks are used if needed to satisfy the memory budget.
     :type thin: int
+    :param proj: A :class:`pyproffit.geometry.ProjectionOperator` object sorting the pixels into bins. If None, it is computed from rads. Defaults to None
+    :type proj: class:`pyproffit.geometry.ProjectionOperator`
+    :param maxmem: Approximate memory budget of the simulations in MB. Defaults to 200
+    :type maxmem: float
+    :param workers: Number of threads among which the blocks of simulations are distributed. Defaults to 1
+    :type workers: int
+    :param seed: Seed used to initialize the random number generators. Each block of simulations uses its own generator spawned from a :class:`numpy.random.SeedSequence`, such that the results are reproducible for a given seed, number of simulations and number of workers. If None, the root seed is drawn from the global numpy random state, such that numpy.random.seed also makes the results reproducible. Defaults to None
+    :type seed: int
     :return:
         - Samples of median profiles
         - Area of each bin
@@ -81,56 +458,63 @@ def median_all_cov(dat, bins, ebins, rads, nsim=1000, fitter=None, thin=10):
     img, errmap = dat.img, dat.errmap
     expo = dat.exposure
 
-    rad = bins
-    erad = ebins
-    nbin = len(rad)
-
-    tol = 0.5e-5
-    sort_list = []
-    for n in range(nbin):
-        if n == 0:
-            sort_list.append(np.where(
-                np.logical_and(np.logical_and(
-                    np.logical_and(rads >= 0, rads < np.round(rad[n] + erad[n], 5) + tol), errmap > 0.0), expo > 0.0)))
-        else:
-            sort_list.append(np.where(np.logical_and(np.logical_and(np.logical_and(
-                rads >= np.round(rad[n] - erad[n], 5) + tol,
-                rads < np.round(rad[n] + erad[n], 5) + tol), errmap > 0.0), expo > 0.0)))
-
-    nsimthin = int(nsim / thin)
-
-    shape = (dat.axes[0], dat.axes[1], nsimthin)
-
-    imgmul = np.repeat(img, nsimthin).reshape(shape)
-    errmul = np.repeat(errmap, nsimthin).reshape(shape)
+    nbin = len(bins)
+
+    if proj is None:
+        labels = sort_pixels(rads, bins, ebins, mask=np.logical_and(errmap > 0.0, expo > 0.0))
+        proj = ProjectionOperator.from_labels(labels, nbin)
+
+    # Identify the Voronoi cells as the connected regions of pixels sharing the same value and error, and count the pixels of each cell in each bin
+    cellid, cells = voronoi_cells(proj, img, errmap, maxmem=maxmem)
+    ncell = len(cells)
+    npt = len(cellid)
+    # Weight of each cell in each bin, replacing the pixel indices of the projection matrix by the cell indices and summing the duplicates in a copy, since the operator may be cached
+    binmat = csr_matrix((proj.matrix.data, cellid[proj.matrix.indices], proj.matrix.indptr), shape=(nbin, ncell), copy=True)
+    binmat.sum_duplicates()
+    bincells = [binmat.indices[binmat.indptr[i]:binmat.indptr[i + 1]] for i in range(nbin)]
+    binweights = [np.round(binmat.data[binmat.indptr[i]:binmat.indptr[i + 1]]).astype(int) for i in range(nbin)]
+
+    # Number of simulations per block: one realization of all cells plus sorting work arrays for the largest bin
+    maxcells = max([len(bc) for bc in bincells] + [1])
+    nperblock = max(1, int(maxmem / max(workers, 1) * 1024. ** 2 / 8. / (ncell + 4 * maxcells)))
+    nsimthin = min(int(np.ceil(nsim / thin)), nperblock)
+    blocks = [(nth1, min(nth1 + nsimthin, nsim)) for nth1 in range(0, nsim, nsimthin)]
+    if seed is None:
+        seed = np.random.randint(2 ** 63, dtype=np.int64)
+    rngs = [np.random.default_rng(ss) for ss in np.random.SeedSequence(seed).spawn(len(blocks))]
 
     if fitter is not None:
         bkg = np.power(10., fitter.minuit.values['bkg'])
     else:
         bkg = 0.
 
+    # Each block writes its own columns of the output array
     all_prof = np.empty((nbin, nsim))
 
-    area = np.empty(nbin)
+    def run_block(nblock):
 
-    for th in range(thin):
+        nth1, nth2 = blocks[nblock]
 
-        gen_img = imgmul + errmul * np.random.randn(shape[0], shape[1], shape[2])
+        gen_cells = cells[:, 0] + cells[:, 1] * rngs[nblock].standard_normal((nth2 - nth1, ncell))
 
-        nth1 = th * nsimthin
+        for i in range(nbin):
 
-        nth2 = (th + 1) * nsimthin
+            if len(bincells[i]) == 0:
 
-        for i in range(nbin):
-            tid = sort_list[i]
+                all_prof[i, nth1:nth2] = np.nan
 
-            gen_bin = gen_img[tid]
+                continue
 
-            all_prof[i, nth1:nth2] = np.median(gen_bin, axis=0) - bkg
+            all_prof[i, nth1:nth2] = weighted_median(gen_cells[:, bincells[i]], binweights[i]) - bkg
 
-            if th == 0:
+    if workers > 1 and len(blocks) > 1:
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            list(pool.map(run_block, range(len(blocks))))
+    else:
+        for nblock in range(len(blocks)):
+            run_block(nblock)
 
-                area[i] = len(img[tid]) * dat.pixsize ** 2
+    area = proj.npix * dat.pixsize ** 2
 
     return all_prof, area
 
@@ -200,7 +584,7 @@ def dist_eval(coords2d,index=None,x_c=None,y_c=None,metric='euclidean',selected=
     
     return d
 
-def get_bary(x,y,x_c=None,y_c=None,weight=None, wdist=False):
+def get_bary(x,y,x_c=None,y_c=None,weight=None, wdist=False, counts=None):
     """
     Compute centroid position and ellipse parameters from a set of points using principle component analysis
 
@@ -216,6 +600,8 @@ def get_bary(x,y,x_c=None,y_c=None,weight=None, wdist=False):
     :type weight: class:`numpy.ndarray` , optional
     :param wdist: Switch to apply the weights. Defaults to False
     :type wdist: bool
+    :param counts: Integer number of occurrences of each point, e.g. the number of counts in each pixel when x and y are pixel coordinates. The results are the same as when each point is repeated counts times, without the corresponding memory cost. If None, each point is counted once. Defaults to None
+    :type counts: class:`numpy.ndarray` , optional
     :return:
             - x_c_w (float): Centroid X coordinate
             - y_c_w (float): Centroid Y coordinate
@@ -227,30 +613,30 @@ def get_bary(x,y,x_c=None,y_c=None,weight=None, wdist=False):
     """
     xy=np.column_stack((x,y))
     _w_tot=None
+    if counts is None:
+        _w_freq=np.ones(x.shape)
+    else:
+        _w_freq=counts
     if weight is None:
-        if y_c is None:
-            y_c_ave= y.mean()
-        
-        if x_c is None:
-            x_c_ave= x.mean()
+        _w_ave=_w_freq
     else:
-        if y_c is None:
-            y_c_ave=np.average( y,weights=weight)
-        
-        if x_c is None:
-            x_c_ave=np.average( x,weights=weight)
+        _w_ave=_w_freq*weight
+    y_c_ave=y_c
+    x_c_ave=x_c
+    if y_c is None:
+        y_c_ave=np.average( y,weights=_w_ave)
+
+    if x_c is None:
+        x_c_ave=np.average( x,weights=_w_ave)
 
     cdist= dist_eval(xy,x_c=x_c_ave,y_c=y_c_ave)
     cdist[cdist==0]=1
     if wdist == True:
         _w_pos= 1.0/(cdist)
     else:
-        _w_pos=np.ones(x.shape,dtype=x.dtype)
-    
-    if weight is not None:
-        _w_tot=_w_pos*weight
-    else:
-        _w_tot=_w_pos
+        _w_pos=np.ones(x.shape)
+
+    _w_tot=_w_pos*_w_ave
     y_c_w=np.average( y,weights=_w_tot)
     x_c_w=np.average( x,weights=_w_tot)
     pos_err=1.0/np.sqrt(_w_tot.sum())
@@ -259,7 +645,7 @@ def get_bary(x,y,x_c=None,y_c=None,weight=None, wdist=False):
     #x_c_ave,y_c_ave
     #x_c_w,y_c_w
     ########################################
-    cova= np.cov(xy,rowvar=0,aweights=weight)
+    cova= np.cov(xy,rowvar=0,fweights=counts,aweights=weight)
     eigvec, eigval, V = np.linalg.svd(cova, full_matrices=True)
     ind=np.argsort(eigval)[::-1]
     eigval=eigval[ind]
@@ -275,6 +661,48 @@ def get_bary(x,y,x_c=None,y_c=None,weight=None, wdist=False):
     r_cluster= np.sqrt(sig_x*sig_x+sig_y*sig_y)
     return x_c_w,y_c_w,sig_x,sig_y,r_cluster,semi_major_angle,pos_err
 
+
+def iterative_bary(x, y, counts, x_c, y_c, radius, weight=None, wdist=False, niter=1, shrink=0.8, tol=0.1):
+    """
+    Compute centroid position and ellipse parameters with :func:`pyproffit.miscellaneous.get_bary` within a circular aperture, iteratively moving the aperture to the new centroid and shrinking its radius until the centroid moves by less than tol or niter iterations are reached
+
+    :param x: Array of pixel positions on the X axis
+    :type x: class:`numpy.ndarray`
+    :param y: Array of pixel positions on the Y axis
+    :type y: class:`numpy.ndarray`
+    :param counts: Number of counts in each pixel
+    :type counts: class:`numpy.ndarray`
+    :param x_c: Initial X coordinate of the center of the aperture
+    :type x_c: float
+    :param y_c: Initial Y coordinate of the center of the aperture
+    :type y_c: float
+    :param radius: Initial radius of the aperture in pixels
+    :type radius: float
+    :param weight: Weights of each pixel, passed to :func:`pyproffit.miscellaneous.get_bary`
+    :type weight: class:`numpy.ndarray` , optional
+    :param wdist: Switch to apply the weights, passed to :func:`pyproffit.miscellaneous.get_bary`. Defaults to False
+    :type wdist: bool
+    :param niter: Maximum number of iterations. Defaults to 1, i.e. a single centroid computation within the initial aperture
+    :type niter: int
+    :param shrink: Factor by which the radius of the aperture is multiplied at each iteration. Defaults to 0.8
+    :type shrink: float
+    :param tol: Convergence criterion on the centroid shift in pixels. Defaults to 0.1
+    :type tol: float
+    :return: Same as :func:`pyproffit.miscellaneous.get_bary`
+    """
+    for i in range(niter):
+        inap = np.hypot(x_c - x, y_c - y) < radius
+        if weight is None:
+            out = get_bary(x[inap], y[inap], counts=counts[inap])
+        else:
+            out = get_bary(x[inap], y[inap], weight=weight[inap], wdist=wdist, counts=counts[inap])
+        shift = np.hypot(out[0] - x_c, out[1] - y_c)
+        x_c, y_c = out[0], out[1]
+        radius = radius * shrink
+        if i > 0 and shift < tol:
+            break
+    return out
+
 def heaviside(x):
     """
     Heavyside theta function
@@ -311,32 +739,58 @@ def bkg_smooth(data,smoothing_scale=25):
     bkgsmoothed = np.nan_to_num(np.divide(gsb,gsexp))*expo
     return  bkgsmoothed
 
-from scipy.ndimage import generic_filter
 
-def clean_bkg(img,bkg):
+def box_sum(img, size):
     """
-    Subtract statistically the background from a Poisson image
+    Sum of an image over a square box of a given size around each pixel, computed with a summed-area table. Pixels outside the image are set to 0. The box covers the same pixels as the footprint np.ones((size, size)) in scipy.ndimage filters, i.e. offsets from -size//2 to size - size//2 - 1. For integer images the result is exact.
 
     :param img: Input image
     :type img: class:`numpy.ndarray`
-    :param bkg: Background map
-    :type bkg: class:`numpy.ndarray`
+    :param size: Size of the box in pixels
+    :type size: int
+    :return: Box-summed image
+    :rtype: class:`numpy.ndarray`
+    """
+    lo = size // 2
+    hi = size - lo - 1
+    out = img
+    for axis in range(2):
+        pad = [(0, 0), (0, 0)]
+        pad[axis] = (lo + 1, hi)
+        sat = np.cumsum(np.pad(out, pad, mode='constant'), axis=axis)
+        npix = out.shape[axis]
+        out = np.take(sat, np.arange(size, npix + size), axis=axis) - np.take(sat, np.arange(npix), axis=axis)
+    return out
+
+
+def clean_bkg(img, bkg, rng=None, nsm=10):
+    """
+    Subtract statistically the background from a Poisson image. For each pixel, the number of counts within a box of nsm x nsm pixels is compared with the expected number of background counts, and the pixel is removed with a probability given by the Poisson probability that the background exceeds the observed counts.
+
+    :param img: Input image. The image is modified in place
+    :type img: class:`numpy.ndarray`
+    :param bkg: Background level per pixel
+    :type bkg: float
+    :param rng: Random number generator, or seed to initialize one. If None, the global numpy random state is used. Defaults to None
+    :type rng: class:`numpy.random.Generator` , int
+    :param nsm: Size of the box in pixels. Defaults to 10
+    :type nsm: int
     :return: Background subtracted Poisson image
     :rtype: class:`numpy.ndarray`
     """
+    if rng is None:
+        rng = np.random
+    else:
+        rng = np.random.default_rng(rng)
     id=np.where(img>0.0)
-    yp, xp = np.indices(img.shape)
-    y=yp[id]
-    x=xp[id]
-    npt=len(img[id])
-    nsm=10
-    ons=np.ones((nsm,nsm))
-    timg=generic_filter(img,heaviside,footprint=ons,mode='constant')
-    tbkg=generic_filter(np.ones(img.shape)*bkg,heaviside,footprint=ons,mode='constant',cval=0,origin=0)
-    prob=1.-poisson.cdf(timg[id],tbkg[id])
-    vals=np.random.rand(npt)
+    timg=box_sum(img,nsm)
+    # The background is constant, such that its box sum is the background level times the number of pixels in the box
+    ny, nx = img.shape
+    tbkg=bkg*box_sum(np.ones((ny, 1), dtype=int), nsm)*box_sum(np.ones((1, nx), dtype=int), nsm)
+    prob=poisson.sf(timg[id],tbkg[id])
+    vals=rng.random(len(prob))
     remove=np.where(vals<prob)
-    img[y[remove],x[remove]]=0
+    img[id[0][remove],id[1][remove]]=0
     return img
 
 
@@ -375,9 +829,76 @@ def model_from_samples(x, model, samples, psfmat=None):
 import copy
 
 
-def Rebin(prof, minc=None, snr=None):
+def bayesian_blocks(counts, exposure, p0=0.05):
+    """
+    Optimal partition of a binned count profile into blocks of constant count rate using the dynamic programming algorithm of Scargle et al. (2013) with the Poisson likelihood of binned event data. The computation scales as the square of the number of input bins.
+
+    :param counts: Number of counts in each bin
+    :type counts: class:`numpy.ndarray`
+    :param exposure: Exposure of each bin, e.g. area times exposure time, such that counts / exposure is the count rate
+    :type exposure: class:`numpy.ndarray`
+    :param p0: False positive rate used to compute the prior on the number of blocks (Scargle et al. 2013, Eq. 21). Defaults to 0.05
+    :type p0: float
+    :return: Index of the first bin of each block
+    :rtype: class:`numpy.ndarray`
+    """
+    nbin = len(counts)
+    ncp_prior = 4. - np.log(73.53 * p0 * nbin ** (-0.478))
+    ccounts = np.append(0., np.cumsum(counts))
+    cexp = np.append(0., np.cumsum(exposure))
+    best = np.zeros(nbin)
+    last = np.zeros(nbin, dtype=int)
+    for r in range(nbin):
+        # Fitness of the blocks covering bins k to r for all k <= r
+        nk = ccounts[r + 1] - ccounts[:r + 1]
+        tk = cexp[r + 1] - cexp[:r + 1]
+        with np.errstate(divide='ignore', invalid='ignore'):
+            fit = np.where(nk > 0., nk * (np.log(nk) - np.log(tk)), 0.)
+        total = fit - ncp_prior + np.append(0., best[:r])
+        last[r] = np.argmax(total)
+        best[r] = total[last[r]]
+    starts = []
+    ind = nbin
+    while ind > 0:
+        ind = last[ind - 1]
+        starts.append(ind)
+    return np.array(starts[::-1])
+
+
+def _group_bins(prof, starts, skybkg, eskybkg):
+    """
+    Merge groups of consecutive bins of a profile starting at the provided indices. Bins left alone keep their original values.
+    """
+    nbin = prof.nbin
+    size = np.diff(np.append(starts, nbin))
+    single = size == 1
+    tcounts, tarea, tbkgc = [np.add.reduceat(np.asarray(arr[:nbin], dtype=float), starts) for arr in (prof.counts, prof.area, prof.bkgcounts)]
+    # Exposure of the group averaged over the area of the bins
+    ten = np.add.reduceat(prof.area[:nbin] * prof.effexp[:nbin], starts) / tarea
+    bin_low = prof.bins[starts] - prof.ebins[starts]
+    bin_high = prof.bins[starts + size - 1] + prof.ebins[starts + size - 1]
+    res = {}
+    res['bins'] = (bin_low + bin_high) / 2.
+    res['ebins'] = (bin_high - bin_low) / 2.
+    res['counts'] = tcounts
+    res['area'] = tarea
+    res['bkgcounts'] = tbkgc
+    res['effexp'] = ten
+    res['profile'] = (tcounts - tbkgc) / tarea / ten - skybkg
+    res['bkgprof'] = tbkgc / tarea / ten
+    res['eprof'] = np.sqrt(tcounts / (ten * tarea) ** 2 + eskybkg ** 2)
+    orig = {'bins': prof.bins, 'ebins': prof.ebins, 'profile': prof.profile, 'eprof': prof.eprof, 'bkgprof': prof.bkgprof,
+            'area': prof.area, 'effexp': prof.effexp, 'bkgcounts': prof.bkgcounts, 'counts': prof.counts}
+    for key in res:
+        res[key] = np.where(single, orig[key][starts], res[key])
+    return res
+
+
+def Rebin(prof, minc=None, snr=None, blocks=False, p0=0.05):
     '''
-    Rebin an existing surface brightness profile to reach a given target number of counts per bin (minc) or a minimum S/N (snr).
+    Rebin an existing surface brightness profile to reach a given target number of counts per bin (minc) or a minimum S/N (snr), or to group the bins into optimal blocks of constant count rate (blocks=True).
+
+    In the minc and snr modes, starting from the center, bins that do not reach the target are merged with the following ones until the target is reached. With blocks=True the bins are grouped into Bayesian blocks computed with :func:`pyproffit.miscellaneous.bayesian_blocks`, with area times effective exposure as the exposure of each bin. The exposure of a group of bins is the area-weighted mean of the effective exposure of the bins. If a PSF mixing matrix is loaded, it is rebinned as well assuming a flat surface brightness across each group, i.e. weighting the bins of a group by the number of pixels in each annulus, and the profiles of individual bands are rebinned using the same groups.
 
     :param prof: A :class:`pyproffit.profextract.Profile` object including the current profile to be rebinned
     :type prof: :class:`pyproffit.profextract.Profile`
@@ -385,30 +906,35 @@ def Rebin(prof, minc=None, snr=None):
     :type minc: int
     :param snr: Minimum signal-to-noise ratio of the output profile. If None, a minimum number of counts is used. Defaults to None.
     :type snr: float
+    :param blocks: If True, group the bins into Bayesian blocks instead of using minc or snr. Defaults to False
+    :type blocks: bool
+    :param p0: False positive rate used to set the prior on the number of Bayesian blocks. Defaults to 0.05
+    :type p0: float
     :return: A new :class:`pyproffit.profextract.Profile` object with the rebinned surface brightness profile.
     :rtype: :class:`pyproffit.profextract.Profile`
     '''
 
-    is_minc = True
-    if minc is None and snr is None:
+    nmode = int(minc is not None) + int(snr is not None) + int(blocks)
+    if nmode == 0:
         print('No target number of counts or S/N provided, aborting')
         return
 
-    if minc is not None and snr is not None:
+    if nmode > 1:
         print('Both a target number of counts and a target S/N provided, just pick one')
         return
 
+    if prof.counts is None:
+        print('Rebinning requires a profile extracted from a count image, aborting')
+        return
+
     if minc is not None:
         print('We will rebin the profile to reach a minimum of %d counts per bin' % (minc))
 
     if snr is not None:
         print('We will rebin the profile to reach a minimum S/N of %g' % (snr))
-        is_minc = False
 
-    prof_new, eprof_new, counts_new, bins_new, ebins_new = np.array([]), np.array([]), np.array([]), np.array(
-        []), np.array([])
-
-    back_new, area_new, exp_new, bkgcounts_new = np.array([]), np.array([]), np.array([]), np.array([])
+    if blocks:
+        print('We will rebin the profile into Bayesian blocks with a false positive rate of %g' % (p0))
 
     nbin = prof.nbin
 
@@ -418,144 +944,63 @@ def Rebin(prof, minc=None, snr=None):
         skybkg = prof.bkgval
         eskybkg = prof.bkgerr
 
-    i = 0
-    while i < nbin:
-        if is_minc:
-            if prof.counts[i] >= minc:
-                prof_new = np.append(prof_new, prof.profile[i])
-                bins_new = np.append(bins_new, prof.bins[i])
-                ebins_new = np.append(ebins_new, prof.ebins[i])
-                eprof_new = np.append(eprof_new, prof.eprof[i])
-                back_new = np.append(back_new, prof.bkgprof[i])
-                area_new = np.append(area_new, prof.area[i])
-                exp_new = np.append(exp_new, prof.effexp[i])
-                bkgcounts_new = np.append(bkgcounts_new, prof.bkgcounts[i])
-                counts_new = np.append(counts_new, prof.counts[i])
-                i = i + 1
-
-            else:
-                if i < nbin - 1:
-                    l = 1
-                    tcounts = prof.counts[i]
-                    tarea = prof.area[i]
-                    texp = prof.effexp[i]
-                    tbkgc = prof.bkgcounts[i]
-                    bin_low = prof.bins[i] - prof.ebins[i]
-                    bin_high = prof.bins[i] + prof.ebins[i]
-
-                    while tcounts < minc and i + l < nbin:
-                        tcounts = tcounts + prof.counts[i + l]
-                        tarea = tarea + prof.area[i + l]
-                        texp = texp + prof.effexp[i + l]
-                        tbkgc = tbkgc + prof.bkgcounts[i + l]
-                        bin_high = prof.bins[i + l] + prof.ebins[i + l]
-                        l = l + 1
-
-                    # if i + l < nbin:
-                    bins_new = np.append(bins_new, (bin_low + bin_high) / 2.)
-                    ten = texp / (l + 1)
-                    exp_new = np.append(exp_new, ten)
-                    counts_new = np.append(counts_new, tcounts)
-                    area_new = np.append(area_new, tarea)
-                    bkgcounts_new = np.append(bkgcounts_new, tbkgc)
-                    ebins_new = np.append(ebins_new, (bin_high - bin_low) / 2.)
-                    sb_new = (tcounts - tbkgc) / tarea / ten - skybkg
-                    prof_new = np.append(prof_new, sb_new)
-                    bnew = tbkgc / tarea / ten
-                    back_new = np.append(back_new, bnew)
-                    epnew = np.sqrt(tcounts / (ten * tarea) ** 2 + eskybkg ** 2)
-                    eprof_new = np.append(eprof_new, epnew)
-
-                    i = i + l
-                if i == nbin - 1:
-                    prof_new = np.append(prof_new, prof.profile[i])
-                    bins_new = np.append(bins_new, prof.bins[i])
-                    ebins_new = np.append(ebins_new, prof.ebins[i])
-                    eprof_new = np.append(eprof_new, prof.eprof[i])
-                    back_new = np.append(back_new, prof.bkgprof[i])
-                    area_new = np.append(area_new, prof.area[i])
-                    exp_new = np.append(exp_new, prof.effexp[i])
-                    bkgcounts_new = np.append(bkgcounts_new, prof.bkgcounts[i])
-                    counts_new = np.append(counts_new, prof.counts[i])
-                    i = i + 1
-
-
-
-        else:
-            if prof.profile[i] / prof.eprof[i] >= snr:
-                prof_new = np.append(prof_new, prof.profile[i])
-                bins_new = np.append(bins_new, prof.bins[i])
-                ebins_new = np.append(ebins_new, prof.ebins[i])
-                eprof_new = np.append(eprof_new, prof.eprof[i])
-                back_new = np.append(back_new, prof.bkgprof[i])
-                area_new = np.append(area_new, prof.area[i])
-                exp_new = np.append(exp_new, prof.effexp[i])
-                bkgcounts_new = np.append(bkgcounts_new, prof.bkgcounts[i])
-                counts_new = np.append(counts_new, prof.counts[i])
-                i = i + 1
-
+    counts = np.asarray(prof.counts[:nbin], dtype=float)
+    area = prof.area[:nbin]
+    if blocks:
+        starts = bayesian_blocks(counts, area * prof.effexp[:nbin], p0=p0)
+    else:
+        # Cumulative sums giving the total of any group of consecutive bins in constant time
+        ccounts = np.append(0., np.cumsum(counts))
+        cbkg = np.append(0., np.cumsum(prof.bkgcounts[:nbin]))
+        carea = np.append(0., np.cumsum(area))
+        cexp = np.append(0., np.cumsum(area * prof.effexp[:nbin]))
+        starts = []
+        i = 0
+        while i < nbin:
+            starts.append(i)
+            if i == nbin - 1:
+                break
+            if minc is not None:
+                # First group reaching the target number of counts
+                end = max(np.searchsorted(ccounts, ccounts[i] + minc, side='left'), i + 1)
+            elif prof.profile[i] / prof.eprof[i] >= snr:
+                end = i + 1
             else:
-                if i < nbin - 1:
-                    l = 1
-                    tcounts = prof.counts[i]
-                    tarea = prof.area[i]
-                    texp = prof.effexp[i]
-                    tbkgc = prof.bkgcounts[i]
-                    bin_low = prof.bins[i] - prof.ebins[i]
-                    bin_high = prof.bins[i] + prof.ebins[i]
-                    tsn = prof.profile[i] / prof.eprof[i]
-
-                    while tsn < snr and i + l < nbin:
-                        tcounts = tcounts + prof.counts[i + l]
-                        tarea = tarea + prof.area[i + l]
-                        texp = texp + prof.effexp[i + l]
-                        tbkgc = tbkgc + prof.bkgcounts[i + l]
-                        bin_high = prof.bins[i + l] + prof.ebins[i + l]
-                        l = l + 1
-                        ten = texp / l
-                        tprof = (tcounts - tbkgc) / tarea / ten - skybkg
-                        terr = np.sqrt(tcounts / (tarea * ten) ** 2 + eskybkg ** 2)
-                        tsn = tprof / terr
-
-                    # if i + l < nbin:
-                    bins_new = np.append(bins_new, (bin_low + bin_high) / 2.)
-                    exp_new = np.append(exp_new, ten)
-                    counts_new = np.append(counts_new, tcounts)
-                    area_new = np.append(area_new, tarea)
-                    bkgcounts_new = np.append(bkgcounts_new, tbkgc)
-                    ebins_new = np.append(ebins_new, (bin_high - bin_low) / 2.)
-                    sb_new = (tcounts - tbkgc) / tarea / ten - skybkg
-                    prof_new = np.append(prof_new, sb_new)
-                    bnew = tbkgc / tarea / ten
-                    back_new = np.append(back_new, bnew)
-                    epnew = np.sqrt(tcounts / (ten * tarea) ** 2 + eskybkg ** 2)
-                    eprof_new = np.append(eprof_new, epnew)
-
-                    i = i + l
-
-                if i == nbin - 1:
-                    prof_new = np.append(prof_new, prof.profile[i])
-                    bins_new = np.append(bins_new, prof.bins[i])
-                    ebins_new = np.append(ebins_new, prof.ebins[i])
-                    eprof_new = np.append(eprof_new, prof.eprof[i])
-                    back_new = np.append(back_new, prof.bkgprof[i])
-                    area_new = np.append(area_new, prof.area[i])
-                    exp_new = np.append(exp_new, prof.effexp[i])
-                    bkgcounts_new = np.append(bkgcounts_new, prof.bkgcounts[i])
-                    counts_new = np.append(counts_new, prof.counts[i])
-                    i = i + 1
+                # S/N of all the groups starting at bin i and including at least two bins
+                tcounts = ccounts[i + 2:] - ccounts[i]
+                tarea = carea[i + 2:] - carea[i]
+                ten = (cexp[i + 2:] - cexp[i]) / tarea
+                tprof = (tcounts - (cbkg[i + 2:] - cbkg[i])) / tarea / ten - skybkg
+                terr = np.sqrt(tcounts / (tarea * ten) ** 2 + eskybkg ** 2)
+                with np.errstate(divide='ignore', invalid='ignore'):
+                    reached = np.flatnonzero(tprof / terr >= snr)
+                end = i + 2 + reached[0] if len(reached) > 0 else nbin
+            i = min(end, nbin)
+        starts = np.array(starts)
 
     prof_out = copy.copy(prof)
-    prof_out.nbin = len(prof_new)
-    prof_out.profile = prof_new
-    prof_out.bins = bins_new
-    prof_out.ebins = ebins_new
-    prof_out.eprof = eprof_new
-    prof_out.area = area_new
-    prof_out.effexp = exp_new
-    prof_out.counts = counts_new
-    prof_out.bkgcounts = bkgcounts_new
-    prof_out.bkgprof = back_new
+    res = _group_bins(prof, starts, skybkg, eskybkg)
+    for key in res:
+        setattr(prof_out, key, res[key])
+    prof_out.nbin = len(starts)
+
+    if prof.psfmat is not None:
+        # Flux of a group redistributed as the sum of the flux of its bins weighted by the number of pixels of the
+        # circular annuli used to compute the matrix
+        annulus = prof.GetProjection(circular=True).npix
+        psfmat = np.add.reduceat(prof.psfmat[:nbin, :nbin] * annulus[:, np.newaxis], starts, axis=0) / np.add.reduceat(annulus, starts)[:, np.newaxis]
+        prof_out.psfmat = np.add.reduceat(psfmat, starts, axis=1)
+
+    if prof.bands is not None:
+        bands = []
+        for band in prof.bands:
+            band_out = copy.copy(band)
+            res = _group_bins(band, starts, 0., 0.)
+            for key in res:
+                setattr(band_out, key, res[key])
+            band_out.nbin = len(starts)
+            bands.append(band_out)
+        prof_out.bands = bands
 
     return prof_out
 
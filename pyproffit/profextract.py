@@ -1,11 +1,15 @@
 from astropy.io import fits
-from scipy.signal import convolve
+import copy
 from .miscellaneous import *
 from scipy.ndimage.filters import gaussian_filter
 import matplotlib.pyplot as plt
 import matplotlib.gridspec as gridspec
 from scipy.optimize import brentq
 from .emissivity import *
+from .geometry import PixelGeometry, ProjectionOperator
+from .cache import DiskCache, cache_key
+import hashlib
+from scipy.sparse import csr_matrix
 from astropy.cosmology import FlatLambdaCDM
 
 def plot_multi_profiles(profs, labels=None, outfile=None, axes=None, figsize=(13, 10), fontsize=40, xscale='log', yscale='log', fmt='o', markersize=7):
@@ -104,13 +108,17 @@ class Profile(object):
     :type binning: str
     :param centroid_region: If center_choice='centroid', this option defines the radius of the region (in arcmin), centered on the center of the image, within which the centroid will be calculated. If centroid_region=None the entire image is used. Defaults to None.
     :type centroid_region: float
+    :param centroid_niter: If center_choice='centroid', maximum number of iterations of the centroid calculation. At each iteration the region is moved to the current centroid and its radius is multiplied by centroid_shrink, until the centroid moves by less than 0.1 pixel. Defaults to 1, i.e. a single calculation within centroid_region
+    :type centroid_niter: int
+    :param centroid_shrink: If center_choice='centroid' and centroid_niter>1, factor by which the radius of the region is reduced at each iteration. Defaults to 0.8
+    :type centroid_shrink: float
     :param bins: in case binning is set to 'custom', a numpy array containing the binning definition. For an input array of length N, the binning will contain N-1 bins with boundaries set as the values of the input array.
     :type bins: class:`numpy.ndarray`
     :param cosmo: An :class:`astropy.cosmology` object containing the definition of the cosmological model. If cosmo=None, Planck 2015 cosmology is used.
     :type cosmo: class:`astropy.cosmology`
     """
     def __init__(self, data=None, center_choice=None, maxrad=None, binsize=None, center_ra=None, center_dec=None,
-                 binning='linear', centroid_region=None, bins=None, cosmo=None):
+                 binning='linear', centroid_region=None, bins=None, cosmo=None, centroid_niter=1, centroid_shrink=0.8):
         """
         Constructor of class Profile
         """
@@ -163,7 +171,6 @@ class Profile(object):
                 img = np.copy(data.filth).astype(int)
             else:
                 img = np.copy(data.img).astype(int)
-            yp, xp = np.indices(img.shape)
             if centroid_region is not None:
                 regrad = centroid_region / data.pixsize
             else:
@@ -178,8 +185,9 @@ class Profile(object):
                 x = data.wcs_inp.wcs_world2pix(wc, 1)
                 xc_temp = x[0][0] - 1.
                 yc_temp = x[0][1] - 1.
+            # Work on the coordinates of the pixels with counts, weighted by the number of counts in each pixel
             if data.exposure is None or data.filth is not None:
-                region = np.where(np.logical_and(np.hypot(xc_temp - xp, yc_temp - yp) < regrad, img > 0))
+                yp, xp = np.nonzero(img > 0)
                 #print('No exposure map given, proceeding with no weights')
                 print('Denoising image...')
                 if data.exposure is None:
@@ -188,21 +196,18 @@ class Profile(object):
                     nonzero = np.where(data.exposure > 0.0)
                     bkg = np.mean(img[nonzero])
                 imgc = clean_bkg(img, bkg)
-                x = np.repeat(xp[region], imgc[region])
-                y = np.repeat(yp[region], imgc[region])
-                print('Running PCA...')
-                x_c, y_c, sig_x, sig_y, r_cluster, ellangle, pos_err = get_bary(x, y)
+                weights = None
             else:
-                region = np.where(np.logical_and(np.logical_and(np.hypot(xc_temp - xp, yc_temp - yp) < regrad, img > 0),data.exposure>0.))
+                yp, xp = np.nonzero(np.logical_and(img > 0, data.exposure > 0.))
                 nonzero = np.where(data.exposure > 0.0)
                 print('Denoising image...')
                 bkg = np.mean(img[nonzero])
                 imgc = clean_bkg(img, bkg)
-                x = np.repeat(xp[region], imgc[region])
-                y = np.repeat(yp[region], imgc[region])
-                weights = np.repeat(1. / data.exposure[region], img[region])
-                print('Running PCA...')
-                x_c, y_c, sig_x, sig_y, r_cluster, ellangle, pos_err = get_bary(x, y, weight=weights, wdist=True)
+                weights = 1. / data.exposure[yp, xp]
+            print('Running PCA...')
+            x_c, y_c, sig_x, sig_y, r_cluster, ellangle, pos_err = iterative_bary(xp, yp, imgc[yp, xp], xc_temp, yc_temp, regrad,
+                                                                                 weight=weights, wdist=weights is not None,
+                                                                                 niter=centroid_niter, shrink=centroid_shrink)
             print('Centroid position:', x_c + 1, y_c + 1)
             self.cx = x_c
             self.cy = y_c
@@ -269,11 +274,11 @@ class Profile(object):
             print('Available methods: "centroid", "peak", "custom_fk5", "custom_ima" ')
             return
 
-        pixsize = data.header['CDELT2'] * 60  # 1 pix = pixsize arcmin
-        yima, xima = np.indices(data.img.shape)
-        rads = np.hypot(xima - self.cx, yima - self.cy)
+        self.geometry = None
+        self.projections = {}
+        rads = self.GetGeometry().rcirc()
         ii = np.where(data.exposure > 0)
-        mrad = np.max(rads[ii])*pixsize
+        mrad = np.max(rads[ii])
         if maxrad is None and binning!='custom':
             maxrad=mrad
             print("Maximum radius is %.4f arcmin"%maxrad)
@@ -326,49 +331,133 @@ class Profile(object):
         self.cosmo = cosmo
         self.scatter = None
         self.escat = None
+        self.bands = None
 
-    def SBprofile(self, ellipse_ratio=1.0, rotation_angle=0.0, angle_low=0., angle_high=360., minexp=0.05, box=False, width=None, show_region=False):
+    def GetGeometry(self):
         """
-        Extract a surface brightness profile and store the results in the input Profile object
+        Return the pixel geometry cache (:class:`pyproffit.geometry.PixelGeometry`) for the current center. The radius, angle and elliptical coordinate maps stored in the cache are shared by all extraction methods, and the cache is rebuilt automatically whenever the center, the pixel size or the image size change.
+
+        :return: Pixel geometry cache
+        :rtype: class:`pyproffit.geometry.PixelGeometry`
+        """
+        data = self.data
+        if self.geometry is None or not self.geometry.matches(data.axes, self.cx, self.cy, data.pixsize):
+            self.geometry = PixelGeometry(data.axes, self.cx, self.cy, data.pixsize)
+        return self.geometry
+
+    def GetProjection(self, ellipse_ratio=1.0, rotation_angle=0.0, angle_low=0., angle_high=360., box=False, width=None,
+                      mask=None, circular=False, tol=0.5e-5, subpix=1):
+        """
+        Return the sparse operator (:class:`pyproffit.geometry.ProjectionOperator`) projecting images of the size of the input data onto the current radial binning. The operator is built once for a given center, binning, annulus definition and pixel mask and is stored in the Profile object, such that extracting profiles from N images costs one construction and N sparse matrix products, e.g.
+
+        >>> proj = prof.GetProjection(mask=dat.exposure > 0)
+        >>> counts = proj(dat.img)
 
         :param ellipse_ratio: Ratio a/b of major to minor axis in the case of an elliptical annulus definition. Defaults to 1.0, i.e. circular annuli.
         :type ellipse_ratio: float
         :param rotation_angle: Rotation angle of the ellipse or box respective to the R.A. axis. Defaults 0.
         :type rotation_angle: float
-        :param angle_low: In case the surface brightness profile should be extracted across a sector instead of the whole azimuth, lower position angle of the sector respective to the R.A. axis. Defaults to 0
+        :param angle_low: Lower position angle of the sector respective to the R.A. axis. Defaults to 0
         :type angle_low: float
-        :param angle_high: In case the surface brightness profile should be extracted across a sector instead of the whole azimuth, upper position angle of the sector respective to the R.A. axis. Defaults to 360
+        :param angle_high: Upper position angle of the sector respective to the R.A. axis. Defaults to 360
         :type angle_high: float
-        :param voronoi: Set whether the input data is a Voronoi binned image (True) or a standard raw count image (False). Defaults to False.
-        :type voronoi: bool
-        :param box: Define whether the profile should be extract along an annulus or a box. The parameter definition of the box matches the DS9 definition. Defaults to False.
+        :param box: Define whether the bins are defined along an annulus or a box. Defaults to False.
         :type box: bool
-        :param width: In case box=True, set the full width of the box (in arcmin)
+        :param width: In case box=True, full width of the box (in arcmin)
         :type width: float
-        :param show_region: In case show_region=True create and show region of the corresponding used photons. Used for the user to check, especially in jupyter if the region chosen correctly corresponds to their region of interest
-        :type show_region: bool
+        :param mask: Boolean array setting which pixels can be used. If None, all pixels are used. Defaults to None
+        :type mask: class:`numpy.ndarray`
+        :param circular: If True, use circular annuli around the center irrespective of the ellipse parameters. Defaults to False
+        :type circular: bool
+        :param tol: Tolerance added to the rounded bin boundaries. Defaults to 0.5e-5
+        :type tol: float
+        :param subpix: If larger than 1, split each pixel into subpix x subpix sub-pixels and weight each pixel by the fraction of its area falling into each bin instead of assigning it as a whole to the bin containing its center. The error on the overlap area decreases as 1/subpix^2 for smooth boundaries. Defaults to 1
+        :type subpix: int
+        :return: Projection operator
+        :rtype: class:`pyproffit.geometry.ProjectionOperator`
         """
-        data = self.data
-        img = data.img
-        voronoi = self.voronoi
-
-        rmsmap = False
-        if data.rmsmap is not None:
-            rmsmap = True
-
-        if not voronoi:
-            exposure = np.copy(data.exposure)
-
-            maxexp = np.max(exposure)
-
-            lowexp = np.where(exposure <= minexp * maxexp)
-
-            exposure[lowexp] = 0.0
-
+        nbin = self.nbin
+        bins, ebins = self.bins[:nbin], self.ebins[:nbin]
+        geom = self.GetGeometry()
+        if mask is not None:
+            maskhash = hashlib.sha1(np.packbits(mask)).hexdigest()
         else:
-            exposure = data.errmap
-        bkg = data.bkg
-        pixsize = data.pixsize
+            maskhash = None
+        if circular:
+            ellipse_ratio, rotation_angle = 1.0, 0.0
+        key = (geom.shape, geom.cx, geom.cy, geom.pixsize, ellipse_ratio, rotation_angle, angle_low, angle_high, box, width,
+               circular, tol, subpix, bins.tobytes(), ebins.tobytes(), maskhash)
+        if key in self.projections:
+            return self.projections[key]
+
+        anglow, anghigh = sector_limits(angle_low, angle_high)
+        if subpix is None or subpix <= 1:
+            labels = self._annulus_labels(geom, ellipse_ratio, rotation_angle, anglow, anghigh, box, width, mask, circular, tol)
+            proj = ProjectionOperator.from_labels(labels, nbin)
+        else:
+            # Split the pixels into subpix x subpix sub-pixels and accumulate the fraction of each pixel falling into each bin,
+            # working on blocks of rows to keep the memory footprint similar to that of the original image
+            ny, nx = geom.shape
+            nrow = max(1, int(4e6 / (nx * subpix ** 2)))
+            weights = csr_matrix((nbin, ny * nx))
+            for row_start in range(0, ny, nrow):
+                row_end = min(row_start + nrow, ny)
+                sub = geom.supersample(subpix, row_start, row_end)
+                submask = None
+                if mask is not None:
+                    submask = np.repeat(np.repeat(mask[row_start:row_end], subpix, axis=0), subpix, axis=1)
+                labels = self._annulus_labels(sub, ellipse_ratio, rotation_angle, anglow, anghigh, box, width, submask, circular, tol)
+                suby, subx = np.nonzero(labels >= 0)
+                parent = (row_start + suby // subpix) * nx + subx // subpix
+                weights = weights + csr_matrix((np.full(len(parent), 1. / subpix ** 2), (labels[suby, subx], parent)),
+                                               shape=(nbin, ny * nx))
+            proj = ProjectionOperator.from_weights(weights, geom.shape)
+
+        # Keep the last few operators only
+        if len(self.projections) >= 4:
+            self.projections.pop(next(iter(self.projections)))
+        self.projections[key] = proj
+        return proj
+
+    def _annulus_labels(self, geom, ellipse_ratio, rotation_angle, anglow, anghigh, box, width, mask, circular, tol):
+        """
+        Sort the pixels of a given geometry into the current radial bins, returning -1 for pixels that are not used
+        """
+        nbin = self.nbin
+        bins, ebins = self.bins[:nbin], self.ebins[:nbin]
+        if circular:
+            return sort_pixels(geom.rcirc(), bins, ebins, mask=mask, tol=tol)
+        elif not box:
+            angles = geom.sector_angles(anglow)
+            insect = np.logical_and(angles >= 0., angles <= anghigh)
+            if mask is not None:
+                insect = np.logical_and(mask, insect)
+            return sort_pixels(geom.rads(ellipse_ratio, rotation_angle), bins, ebins, mask=insect, tol=tol)
+        else:
+            xtil = geom.xtil(ellipse_ratio, rotation_angle)
+            ytil = geom.ytil(ellipse_ratio, rotation_angle)
+            inbox = np.fabs(xtil) <= width/2.
+            if mask is not None:
+                inbox = np.logical_and(mask, inbox)
+            return sort_pixels(ytil + self.maxrad/2., bins, ebins, mask=inbox, tol=tol)
+
+    def _extraction_exposure(self, minexp):
+        """
+        Exposure map used to select pixels for profile extraction, with pixels below minexp times the maximum exposure set to zero. For Voronoi images the error map is returned instead.
+        """
+        data = self.data
+        if self.voronoi:
+            return data.errmap
+        exposure = np.copy(data.exposure)
+        maxexp = np.max(exposure)
+        lowexp = np.where(exposure <= minexp * maxexp)
+        exposure[lowexp] = 0.0
+        return exposure
+
+    def _set_binning(self):
+        """
+        Set up the radial binning according to the binning scheme and return the number of bins
+        """
         if not self.custom:
             if (self.islogbin):
                 self.bins, self.ebins = logbinning(self.binsize, self.maxrad)
@@ -382,9 +471,92 @@ class Profile(object):
                 self.nbin = nbin
         else:
             nbin = self.nbin
-        profile, eprof, counts, area, effexp, bkgprof, bkgcounts = np.empty(self.nbin), np.empty(self.nbin), np.empty(
-                self.nbin), np.empty(self.nbin), np.empty(self.nbin), np.empty(self.nbin), np.empty(self.nbin)
-        y, x = np.indices(data.axes)
+        return nbin
+
+    def _pixel_values(self, proj, exposure, img=None, bkg=None):
+        """
+        Extract the image, exposure, background and error values of the pixels used by a projection operator. By default the image and background of the input Data object are used.
+        """
+        data = self.data
+        if img is None:
+            img = data.img
+        if bkg is None:
+            bkg = data.bkg
+        vals = {'img': proj.values(img)}
+        if self.voronoi:
+            vals['err'] = proj.values(data.errmap)
+        elif data.rmsmap is not None:
+            vals['err'] = proj.values(data.rmsmap)
+        else:
+            vals['exp'] = proj.values(exposure)
+            vals['bkg'] = proj.values(bkg)
+        return vals
+
+    def _profile_sums(self, proj, vals, select=None):
+        """
+        Compute the surface brightness profile and associated quantities from the values of the pixels used by a projection operator. If select is provided, only the pixels for which select is True are used.
+        """
+        pixsize = self.data.pixsize
+        matrix, sqmatrix = proj.matrix, proj.sqmatrix
+        if select is None:
+            nv = proj.npix
+            bsum, bsum2 = matrix.dot, sqmatrix.dot
+        else:
+            nv = matrix.dot(select.astype(float))
+            bsum = lambda tv: matrix.dot(np.where(select, tv, 0.))
+            bsum2 = lambda tv: sqmatrix.dot(np.where(select, tv, 0.))
+        timg = vals['img']
+        res = {}
+        if 'err' in vals:
+            sumimg, sumerr = bsum(timg), bsum2(vals['err'] ** 2)
+            with np.errstate(divide='ignore', invalid='ignore'):
+                res['profile'] = sumimg / nv
+                res['eprof'] = np.sqrt(sumerr) / nv
+            res['area'] = nv * pixsize ** 2
+            res['effexp'] = np.ones(proj.nbin) # Dummy, but to be consistent with PSF calculation
+        else:
+            texp = vals['exp']
+            tbkg = vals['bkg']
+            counts, bkgcounts = bsum(timg), bsum(tbkg)
+            sumrate, sumbkgrate, sumvar, sumexp = bsum(timg / texp), bsum(tbkg / texp), bsum2(timg / texp ** 2), bsum(texp)
+            nonz = nv > 0
+            norm = np.where(nonz, nv, 1.)
+            bkgprof = np.where(nonz, sumbkgrate / norm / pixsize ** 2, 0.)
+            res['profile'] = np.where(nonz, sumrate / norm / pixsize ** 2 - bkgprof, 0.)
+            res['eprof'] = np.where(nonz, np.sqrt(sumvar) / norm / pixsize ** 2, 0.)
+            res['area'] = nv * pixsize ** 2
+            res['effexp'] = np.where(nonz, sumexp / norm, 0.)
+            res['counts'] = counts
+            res['bkgcounts'] = bkgcounts
+            res['bkgprof'] = bkgprof
+        return res
+
+    def SBprofile(self, ellipse_ratio=1.0, rotation_angle=0.0, angle_low=0., angle_high=360., minexp=0.05, box=False, width=None, show_region=False, subpix=1):
+        """
+        Extract a surface brightness profile and store the results in the input Profile object. If the input Data object contains an image cube, the profile is extracted from the sum of all bands and the profiles of the individual bands are stored as :class:`pyproffit.profextract.Profile` objects in the bands attribute, using the same pixel selection.
+
+        :param ellipse_ratio: Ratio a/b of major to minor axis in the case of an elliptical annulus definition. Defaults to 1.0, i.e. circular annuli.
+        :type ellipse_ratio: float
+        :param rotation_angle: Rotation angle of the ellipse or box respective to the R.A. axis. Defaults 0.
+        :type rotation_angle: float
+        :param angle_low: In case the surface brightness profile should be extracted across a sector instead of the whole azimuth, lower position angle of the sector respective to the R.A. axis. Defaults to 0
+        :type angle_low: float
+        :param angle_high: In case the surface brightness profile should be extracted across a sector instead of the whole azimuth, upper position angle of the sector respective to the R.A. axis. Defaults to 360
+        :type angle_high: float
+        :param voronoi: Set whether the input data is a Voronoi binned image (True) or a standard raw count image (False). Defaults to False.
+        :type voronoi: bool
+        :param box: Define whether the profile should be extract along an annulus or a box. The parameter definition of the box matches the DS9 definition. Defaults to False.
+        :type box: bool
+        :param width: In case box=True, set the full width of the box (in arcmin)
+        :type width: float
+        :param show_region: In case show_region=True create and show region of the corresponding used photons. Used for the user to check, especially in jupyter if the region chosen correctly corresponds to their region of interest
+        :type show_region: bool
+        :param subpix: If larger than 1, split each pixel into subpix x subpix sub-pixels to compute the fraction of each pixel overlapping with each annulus, and weight the pixels accordingly when computing counts, area and effective exposure. Pixels are then shared between neighbouring bins, which improves the accuracy of the central bins without oversampling the input images. The weights are computed once and reused for subsequent extractions with the same setup. Defaults to 1, i.e. each pixel is assigned to the bin containing its center
+        :type subpix: int
+        """
+        data = self.data
+        exposure = self._extraction_exposure(minexp)
+        self._set_binning()
         if rotation_angle is not None:
             self.ellangle = rotation_angle
         else:
@@ -398,141 +570,113 @@ class Profile(object):
         if tta < -90. or tta > 270.:
             print('Error: input angle must be between 0 and 360 degrees')
             return
-        ellang = tta * np.pi / 180.
-        xtil = np.cos(ellang) * (x - self.cx) * pixsize + np.sin(ellang) * (y - self.cy) * pixsize
-        ytil = -np.sin(ellang) * (x - self.cx) * pixsize + np.cos(ellang) * (y - self.cy) * pixsize
-        rads = ellipse_ratio * np.hypot(xtil, ytil / ellipse_ratio)
         self.anglow = angle_low
         self.anghigh = angle_high
-        # Convert degree to radian and rescale to 0-2pi
-        if angle_low != 0.0 or angle_high != 360.:
-            if angle_low < 0.0:
-                anglow = np.deg2rad(np.fmod(angle_low, 360.) + 360.)
-            else:
-                anglow = np.deg2rad(np.fmod(angle_low, 360.))
-            if angle_high < 0.0:
-                anghigh = np.deg2rad(np.fmod(angle_high, 360.) + 360.)
-            else:
-                anghigh = np.deg2rad(np.fmod(angle_high, 360.))
-        else:
-            anglow = 0.
-            anghigh = 2. * np.pi
-        # Compute angles and set them between 0 and 2pi
-        angles = np.arctan2(y - self.cy , x - self.cx)
-        aneg = np.where( angles < 0.)
-        angles[aneg] = angles[aneg] + 2. * np.pi
-        # Now set angles relative to anglow
-        if anghigh<anglow: #We cross the zero
-            anghigh = anghigh + 2.*np.pi - anglow
-        else:
-            anghigh = anghigh - anglow
-        #
-        zcross = np.where(angles < anglow)
-        zgr = np.where(angles >= anglow)
-        angles[zcross] = angles[zcross] + 2.*np.pi - anglow
-        angles[zgr] = angles[zgr] - anglow
-        #
-        tol = 0.5e-5
-        for i in range(nbin):
-            if not box:
-                if i == 0:
-                    id = np.where(
-                        np.logical_and(np.logical_and(np.logical_and(np.logical_and(rads >= 0, rads < np.round(self.bins[i] + self.ebins[i], 5) + tol),
-                                       exposure > 0.0), angles >= 0.), angles <= anghigh))
-                else:
-                    id = np.where(np.logical_and(np.logical_and(np.logical_and(np.logical_and(rads >= np.round(self.bins[i] - self.ebins[i], 5) + tol,
-                                                rads < np.round(self.bins[i] + self.ebins[i], 5) + tol), exposure > 0.0), angles >= 0.), angles <= anghigh))
-
-            else:
-                if width is None:
-                    print('Error: box width not provided')
-                    return
-                else:
-                    self.box = True
-                    if i == 0:
-                        id = np.where(
-                            np.logical_and(np.logical_and(np.logical_and(ytil + self.maxrad/2. >= 0, ytil + self.maxrad/2. < np.round(self.bins[i] + self.ebins[i], 5) + tol),
-                                           exposure > 0.0), np.fabs(xtil) <= width/2.))
-                    else:
-                        id = np.where(np.logical_and(np.logical_and(np.logical_and(ytil + self.maxrad/2. >= np.round(self.bins[i] - self.ebins[i], 5) + tol,
-                                                    ytil + self.maxrad/2. < np.round(self.bins[i] + self.ebins[i], 5) + tol), exposure > 0.0), np.fabs(xtil) <= width/2.))
-
-            #            id=np.where(np.logical_and(np.logical_and(rads>=self.bins[i]-self.ebins[i],rads<self.bins[i]+self.ebins[i]),exposure>0.0)) #left-inclusive
-            nv = len(img[id])
-            if voronoi or rmsmap:
-                if voronoi:
-                    errmap = data.errmap
-                else:
-                    errmap = data.rmsmap
-                profile[i] = np.sum(img[id]) / nv
-                eprof[i] = np.sqrt(np.sum(errmap[id] ** 2)) / nv
-                area[i] = nv * pixsize ** 2
-                effexp[i] = 1. # Dummy, but to be consistent with PSF calculation
-            else:
-                if nv > 0:
-                    bkgprof[i] = np.sum(bkg[id] / exposure[id]) / nv / pixsize ** 2
-                    profile[i] = np.sum(img[id] / exposure[id]) / nv / pixsize ** 2 - bkgprof[i]
-                    eprof[i] = np.sqrt(np.sum(img[id] / exposure[id] ** 2)) / nv / pixsize ** 2
-                    counts[i] = np.sum(img[id])
-                    bkgcounts[i] = np.sum(bkg[id])
-                    area[i] = nv * pixsize ** 2
-                    effexp[i] = np.sum(exposure[id]) / nv
-                else:
-                    bkgprof[i] = 0.
-                    profile[i] = 0.
-                    eprof[i] = 0.
-                    counts[i] = 0.
-                    bkgcounts[i] = 0.
-                    area[i] = 0.
-                    effexp[i] = 0.
-        self.profile = profile
-        self.eprof = eprof
-        self.area = area
-        self.effexp = effexp
+        if box:
+            if width is None:
+                print('Error: box width not provided')
+                return
+            self.box = True
+        # Sort all pixels into bins in a single pass
+        proj = self.GetProjection(ellipse_ratio=ellipse_ratio, rotation_angle=rotation_angle, angle_low=angle_low,
+                                  angle_high=angle_high, box=box, width=width, mask=exposure > 0.0, subpix=subpix)
+        res = self._profile_sums(proj, self._pixel_values(proj, exposure))
+        self.profile = res['profile']
+        self.eprof = res['eprof']
+        self.area = res['area']
+        self.effexp = res['effexp']
         self.bkgval = None
         self.bkgerr = None
 
-        if not voronoi:
-            self.counts = counts
-            self.bkgprof = bkgprof
-            self.bkgcounts = bkgcounts
+        if 'counts' in res:
+            self.counts = res['counts']
+            self.bkgprof = res['bkgprof']
+            self.bkgcounts = res['bkgcounts']
+
+        # Per-band profiles from the same projection operator
+        self.bands = None
+        if data.cube is not None and not self.voronoi and data.rmsmap is None:
+            bands = []
+            for band in range(data.nband):
+                bimg, bexp, bbkg = data.band(band)
+                vals = self._pixel_values(proj, bexp, img=bimg, bkg=bbkg)
+                res = self._profile_sums(proj, vals, select=vals['exp'] > 0.)
+                prof = copy.copy(self)
+                prof.bands = None
+                prof.psfmat = None
+                for key in res:
+                    setattr(prof, key, res[key])
+                bands.append(prof)
+            self.bands = bands
 
         if show_region:
             self.show_photons()
 
+    def SBprofileSectors(self, sectors, ellipse_ratio=1.0, rotation_angle=0.0, ellipses=None, minexp=0.05):
+        """
+        Extract surface brightness profiles in several sectors at once. The pixels are sorted into radial bins in a single pass for each ellipse configuration, after which the profile of each sector is computed from the selected pixels only. The content of the input Profile object is left untouched.
+
+        :param sectors: List of (angle_low, angle_high) pairs defining the sectors, with position angles in degrees respective to the R.A. axis as in :meth:`pyproffit.profextract.Profile.SBprofile`
+        :type sectors: list
+        :param ellipse_ratio: Ratio a/b of major to minor axis in the case of an elliptical annulus definition. Defaults to 1.0, i.e. circular annuli.
+        :type ellipse_ratio: float
+        :param rotation_angle: Rotation angle of the ellipse respective to the R.A. axis. Defaults 0.
+        :type rotation_angle: float
+        :param ellipses: List of (ellipse_ratio, rotation_angle) pairs. If provided, the sectors are extracted for each ellipse configuration and ellipse_ratio and rotation_angle are ignored. Defaults to None
+        :type ellipses: list , optional
+        :param minexp: Minimum exposure relative to the maximum exposure for a pixel to be used. Defaults to 0.05
+        :type minexp: float
+        :return: List of :class:`pyproffit.profextract.Profile` objects, one per sector, sharing the data and binning of the input Profile. If ellipses is provided, a list containing one such list per ellipse configuration is returned.
+        :rtype: list
+        """
+        if ellipses is None:
+            allell = [(ellipse_ratio, rotation_angle)]
+        else:
+            allell = ellipses
+        for ellrat, rotang in allell:
+            tta = rotang - 90.
+            if tta < -90. or tta > 270.:
+                print('Error: input angle must be between 0 and 360 degrees')
+                return
+
+        exposure = self._extraction_exposure(minexp)
+        nbin = self._set_binning()
+        geom = self.GetGeometry()
+        limits = [sector_limits(angle_low, angle_high) for angle_low, angle_high in sectors]
+
+        out = []
+        for ellrat, rotang in allell:
+            proj = self.GetProjection(ellipse_ratio=ellrat, rotation_angle=rotang, mask=exposure > 0.0)
+            vals = self._pixel_values(proj, exposure)
+            angles = proj.values(geom.angles())
+            profs = []
+            for (angle_low, angle_high), (anglow, anghigh) in zip(sectors, limits):
+                tang = np.where(angles < anglow, angles + 2. * np.pi - anglow, angles - anglow)
+                insect = np.logical_and(tang >= 0., tang <= anghigh)
+                res = self._profile_sums(proj, vals, select=insect)
+                prof = copy.copy(self)
+                prof.ellratio = ellrat
+                prof.ellangle = rotang
+                prof.anglow = angle_low
+                prof.anghigh = angle_high
+                prof.box = False
+                prof.bkgval = None
+                prof.bkgerr = None
+                prof.scatter = None
+                for key in res:
+                    setattr(prof, key, res[key])
+                profs.append(prof)
+            out.append(profs)
+
+        if ellipses is None:
+            return out[0]
+        return out
+
     def show_photons(self):
         data = self.data
-        y, x = np.indices(data.axes)
-        angle_low, angle_high = self.anglow, self.anghigh
-        # Convert degree to radian and rescale to 0-2pi
-        if angle_low != 0.0 or angle_high != 360.:
-            if angle_low < 0.0:
-                anglow = np.deg2rad(np.fmod(angle_low, 360.) + 360.)
-            else:
-                anglow = np.deg2rad(np.fmod(angle_low, 360.))
-            if angle_high < 0.0:
-                anghigh = np.deg2rad(np.fmod(angle_high, 360.) + 360.)
-            else:
-                anghigh = np.deg2rad(np.fmod(angle_high, 360.))
-        else:
-            anglow = 0.
-            anghigh = 2. * np.pi
-        # Compute angles and set them between 0 and 2pi
-        angles = np.arctan2(y - self.cy , x - self.cx)
-        aneg = np.where( angles < 0.)
-        angles[aneg] = angles[aneg] + 2. * np.pi
-        # Now set angles relative to anglow
-        if anghigh<anglow: #We cross the zero
-            anghigh = anghigh + 2.*np.pi - anglow
-        else:
-            anghigh = anghigh - anglow
-    
-        zcross = np.where(angles < anglow)
-        zgr = np.where(angles >= anglow)
-        angles[zcross] = angles[zcross] + 2.*np.pi - anglow
-        angles[zgr] = angles[zgr] - anglow
-    
-    
+        anglow, anghigh = sector_limits(self.anglow, self.anghigh)
+        angles = self.GetGeometry().sector_angles(anglow)
+
         mask = np.zeros(data.img.shape)
         mask[np.where(np.logical_and(np.logical_and((data.exposure > 0), (angles >= 0.)), (angles <= anghigh)))] = 1
         fig = plt.figure(figsize=(10,10))
@@ -541,7 +685,8 @@ class Profile(object):
         plt.scatter(self.cx, self.cy, color='r', marker='x')
         return
 
-    def MedianSB(self, ellipse_ratio=1.0, rotation_angle=0.0, nsim=1000, outsamples=None, fitter=None, thin=10):
+    def MedianSB(self, ellipse_ratio=1.0, rotation_angle=0.0, nsim=1000, outsamples=None, fitter=None, thin=10, maxmem=200.,
+                 workers=1, seed=None):
         """
         Extract the median surface brightness profile in circular annuli from a provided Voronoi binned image, following the method outlined in Eckert et al. 2015
 
@@ -555,19 +700,21 @@ class Profile(object):
         :type outsamples: str
         :param fitter: A :class:`pyproffit.fitter.Fitter` object containing the result of a fit to the background region, for subtraction of the background to the resulting profile
         :type fitter: class:`pyproffit.fitter.Fitter`
-        :param thin: Number of blocks into which the calculation of the bootstrap will be divided. Increasing thin reduces memory usage drastically, at the cost of a modest increase in computation time.
+        :param thin: Minimum number of blocks into which the calculation of the bootstrap will be divided. More blocks are used if needed to satisfy the memory budget.
         :type thin: int
+        :param maxmem: Approximate memory budget of the Monte Carlo simulations in MB. Defaults to 200
+        :type maxmem: float
+        :param workers: Number of threads among which the Monte Carlo simulations are distributed. Defaults to 1
+        :type workers: int
+        :param seed: Seed of the random number generators. For a given seed, number of simulations and number of workers the results are reproducible. If None, the seed is drawn from the global numpy random state. Defaults to None
+        :type seed: int
         """
         data = self.data
         img = data.img
         errmap = data.errmap
-
-        if data.rmsmap is not None:
-            errmap = data.rmsmap
-
         expo = data.exposure
         if errmap is None:
-            print('Error: No Voronoi or RMS map has been loaded')
+            print('Error: No Voronoi error map has been loaded')
             return
         pixsize = data.pixsize
         if not self.custom:
@@ -581,7 +728,6 @@ class Profile(object):
                 self.ebins = np.ones(nbin) * self.binsize / 60. / 2.
                 self.nbin = nbin
         #profile, eprof, area, effexp = np.empty(self.nbin), np.empty(self.nbin), np.empty(self.nbin), np.empty(self.nbin)
-        y, x = np.indices(data.axes)
         if rotation_angle is not None:
             self.ellangle = rotation_angle
         else:
@@ -595,10 +741,7 @@ class Profile(object):
         if tta < -90. or tta > 270.:
             print('Error: input angle must be between 0 and 360 degrees')
             return
-        ellang = tta * np.pi / 180.
-        xtil = np.cos(ellang) * (x - self.cx) * pixsize + np.sin(ellang) * (y - self.cy) * pixsize
-        ytil = -np.sin(ellang) * (x - self.cx) * pixsize + np.cos(ellang) * (y - self.cy) * pixsize
-        rads = ellipse_ratio * np.hypot(xtil, ytil / ellipse_ratio)
+        rads = self.GetGeometry().rads(ellipse_ratio, rotation_angle)
         #for i in range(self.nbin):
         #    id = np.where(np.logical_and(
         #        np.logical_and(np.logical_and(rads >= self.bins[i] - self.ebins[i], rads < self.bins[i] + self.ebins[i]),
@@ -607,7 +750,10 @@ class Profile(object):
         #    area[i] = len(img[id]) * pixsize ** 2
         #    effexp[i] = 1. # Dummy, but to be consistent with PSF calculation
 
-        all_prof, area = median_all_cov(data, self.bins, self.ebins, rads, nsim=nsim, fitter=fitter, thin=thin)
+        proj = self.GetProjection(ellipse_ratio=ellipse_ratio, rotation_angle=rotation_angle,
+                                  mask=np.logical_and(errmap > 0.0, expo > 0.0))
+        all_prof, area = median_all_cov(data, self.bins, self.ebins, rads, nsim=nsim, fitter=fitter, thin=thin, proj=proj,
+                                        maxmem=maxmem, workers=workers, seed=seed)
         profile, eprof = np.median(all_prof, axis=1), np.std(all_prof, axis=1)
         effexp = np.ones(self.nbin) # Dummy, but to be consistent with PSF calculation
         cov = np.cov(all_prof)
@@ -621,7 +767,7 @@ class Profile(object):
             hdu = fits.PrimaryHDU(all_prof)
             hdu.writeto(outsamples, overwrite=True)
 
-    def AzimuthalScatter(self, nsect=12, model=None):
+    def AzimuthalScatter(self, nsect=12, model=None, nsim=100, seed=None):
         '''
         Compute the azimuthal scatter profile around the loaded profile. The azimuthal scatter is defined as the standard deviation of the surface brightness in equispaced sectors with respect to the azimuthal mean,
 
@@ -635,6 +781,10 @@ class Profile(object):
         :type nsect: int
         :param model: A :class:`pyproffit.models.Model` object containing the background to be subtracted, in case the scatter is to be computed on background-subtracted profiles. Defaults to None (i.e. no background subtraction).
         :type model: class:`pyproffit.models.Model`
+        :param nsim: Number of Monte Carlo realizations of the sector profiles used to subtract the statistical scatter. Defaults to 100
+        :type nsim: int
+        :param seed: Seed or :class:`numpy.random.Generator` used to draw the Monte Carlo realizations. If None, the global numpy random state is used. Defaults to None
+        :type seed: int
         '''
 
         if self.profile is None:
@@ -643,20 +793,10 @@ class Profile(object):
         dat = self.data
         exposure = dat.exposure
         img = dat.img
+        nbin = self.nbin
 
-        y, x = np.indices(dat.axes)
-        # Compute angles and set them between 0 and 2pi
-        angles = np.arctan2(y - self.cy, x - self.cx)
-        aneg = np.where(angles < 0.)
-        angles[aneg] = angles[aneg] + 2. * np.pi
-
-        all_sb = np.empty((self.nbin, nsect))
-        all_err = np.empty((self.nbin, nsect))
-
-        ellang = (self.ellangle - 90.) * np.pi / 180.
-        xtil = np.cos(ellang) * (x - self.cx) * dat.pixsize + np.sin(ellang) * (y - self.cy) * dat.pixsize
-        ytil = -np.sin(ellang) * (x - self.cx) * dat.pixsize + np.cos(ellang) * (y - self.cy) * dat.pixsize
-        rads = self.ellratio * np.hypot(xtil, ytil / self.ellratio)
+        geom = self.GetGeometry()
+        rads = geom.rads(self.ellratio, self.ellangle)
 
         skybkg = 0.
         skybkg_err = 0.
@@ -668,55 +808,54 @@ class Profile(object):
             skybkg = np.power(10., model.params[tp])
             skybkg_err = skybkg * np.log(10.) * model.errors[tp]
 
-        tol = 1e-5
-        for i in range(self.nbin):
-            anglow = 0.
-            anghigh = 2. * np.pi / nsect
-            for ns in range(nsect):
-                if i == 0:
-                    id = np.where(
-                        np.logical_and(np.logical_and(np.logical_and(np.logical_and(rads >= 0, rads < np.round(self.bins[i] + self.ebins[i], 5) + tol),
-                                       exposure > 0.0), angles >= anglow), angles <= anghigh))
-                else:
-                    id = np.where(np.logical_and(np.logical_and(np.logical_and(np.logical_and(rads >= np.round(self.bins[i] - self.ebins[i], 5) + tol,
-                                                rads < np.round(self.bins[i] + self.ebins[i], 5) + tol), exposure > 0.0), angles >= anglow), angles <= anghigh))
-            #            id=np.where(np.logical_and(np.logical_and(rads>=self.bins[i]-self.ebins[i],rads<self.bins[i]+self.ebins[i]),exposure>0.0)) #left-inclusive
-                nv = len(img[id])
-                if dat.voronoi:
-                    errmap = dat.errmap
-                    all_sb[i, ns] = np.sum(img[id]) / nv
-                    all_err[i, ns] = np.sqrt(np.sum(errmap[id] ** 2)) / nv
-                else:
-                    if nv > 0:
-                        bkgprof = np.sum(dat.bkg[id] / exposure[id]) / nv / dat.pixsize ** 2
-                        all_sb[i, ns] = np.sum(img[id] / exposure[id]) / nv / dat.pixsize ** 2 - bkgprof - skybkg
-                        all_err[i, ns] = np.sqrt(np.sum(img[id] / exposure[id] ** 2)) / nv / dat.pixsize ** 2
-                        all_err[i, ns] = np.sqrt(all_err[i, ns]**2 + skybkg_err**2)
-                    else:
-                        all_sb[i, ns] = 0.
-                        all_err[i, ns] = 0.
-
-                anglow = anglow + 2. * np.pi / nsect
-                anghigh = anghigh + 2. * np.pi / nsect
-
-        prof_mul = np.repeat(self.profile, nsect).reshape(self.nbin, nsect)
+        # Label each pixel with its radial bin
+        labels = sort_pixels(rads, self.bins, self.ebins, mask=exposure > 0.0, tol=1e-5)
+        sel = labels >= 0
+        rlab = labels[sel]
+        angles = geom.angles()[sel]
+
+        # Sector boundaries, sectors include both of their boundaries
+        bounds = np.empty(nsect + 1)
+        bounds[0] = 0.
+        for ns in range(nsect):
+            bounds[ns + 1] = bounds[ns] + 2. * np.pi / nsect
+        slab = np.searchsorted(bounds, angles, side='right') - 1
+        insect = slab < nsect
+        onedge = np.logical_and(slab >= 1, angles == bounds[np.minimum(slab, nsect)])
+        pix = np.concatenate([np.where(insect)[0], np.where(onedge)[0]])
+        idx = rlab[pix] * nsect + np.concatenate([slab[insect], slab[onedge] - 1])
+
+        timg = img[sel][pix]
+        if dat.voronoi:
+            terr = dat.errmap[sel][pix]
+            nv, (sumimg, sumerr) = bin_sums(idx, nbin * nsect, timg, terr ** 2)
+            nv = nv.reshape(nbin, nsect)
+            with np.errstate(divide='ignore', invalid='ignore'):
+                all_sb = sumimg.reshape(nbin, nsect) / nv
+                all_err = np.sqrt(sumerr.reshape(nbin, nsect)) / nv
+        else:
+            texp = exposure[sel][pix]
+            tbkg = dat.bkg[sel][pix]
+            nv, (sumrate, sumbkg, sumvar) = bin_sums(idx, nbin * nsect, timg / texp, tbkg / texp, timg / texp ** 2)
+            nv = nv.reshape(nbin, nsect)
+            nonz = nv > 0
+            norm = np.where(nonz, nv, 1.) * dat.pixsize ** 2
+            bkgprof = sumbkg.reshape(nbin, nsect) / norm
+            all_sb = np.where(nonz, sumrate.reshape(nbin, nsect) / norm - bkgprof - skybkg, 0.)
+            all_err = np.sqrt(sumvar.reshape(nbin, nsect)) / norm
+            all_err = np.where(nonz, np.sqrt(all_err ** 2 + skybkg_err ** 2), 0.)
+
+        prof_mul = self.profile.reshape(nbin, 1)
         statscat = 1./nsect * np.sum(all_err**2 / prof_mul**2, axis=1)
 
-        nsim = 100
-        emul = np.repeat(all_err, nsim).reshape(self.nbin, nsect, nsim)
-        all_sb_mul = np.repeat(all_sb, nsim).reshape(self.nbin, nsect, nsim)
-
-        realiz = all_sb_mul + emul * np.random.randn(self.nbin, nsect, nsim)
+        rng = np.random.default_rng(seed) if seed is not None else np.random
+        realiz = all_sb[:, :, np.newaxis] + all_err[:, :, np.newaxis] * rng.standard_normal((nbin, nsect, nsim))
 
-        profsect = np.repeat(self.profile, nsect).reshape(self.nbin, nsect)
-
-        profmul = np.repeat(profsect, nsim).reshape(self.nbin, nsect, nsim)
+        profmul = self.profile.reshape(nbin, 1, 1)
 
         totscat_mul = 1. / nsect * np.sum((realiz - profmul) ** 2 / profmul ** 2, axis=1)
 
-        statscat_mul = np.repeat(statscat, nsim).reshape(self.nbin, nsim)
-
-        allvars = totscat_mul - statscat_mul
+        allvars = totscat_mul - statscat.reshape(nbin, 1)
         negscat = np.where(allvars < 0.)
         allvars[negscat] = 0.
 
@@ -789,6 +928,17 @@ class Profile(object):
                 hdr.comments['RMSMAP'] = 'Path to RMS file'
                 hdr['VORONOI'] = self.data.voronoi
                 hdr.comments['VORONOI'] = 'Voronoi on/off switch'
+                if self.data.cutout_radius is not None:
+                    hdr['X_OFF'] = int(self.data.offset[0])
+                    hdr['Y_OFF'] = int(self.data.offset[1])
+                    hdr.comments['X_OFF'] = 'X offset of the cutout in the original image'
+                    hdr.comments['Y_OFF'] = 'Y offset of the cutout in the original image'
+                    hdr['CUT_RA'] = self.data.cutout_ra
+                    hdr['CUT_DEC'] = self.data.cutout_dec
+                    hdr['CUT_RAD'] = self.data.cutout_radius
+                    hdr.comments['CUT_RA'] = 'Right ascension of cutout center'
+                    hdr.comments['CUT_DEC'] = 'Declination of cutout center'
+                    hdr.comments['CUT_RAD'] = 'Cutout half-size in arcmin'
                 hdr['COMMENT'] = 'Written by pyproffit (Eckert et al. 2020)'
                 hdul.append(tbhdu)
             if model is not None:
@@ -807,11 +957,14 @@ class Profile(object):
                 hdul.append(psfhdu)
             hdul.writeto(outfile, overwrite=True)
 
-    def PSF(self, psffunc=None, psffile=None, psfimage=None, psfpixsize=None, sourcemodel=None, psfmin = 0):
+    def PSF(self, psffunc=None, psffile=None, psfimage=None, psfpixsize=None, sourcemodel=None, psfmin = 0, workers=1, method='fft',
+            cachedir=None, cachesize=1000.):
         """
         Function to calculate a PSF convolution matrix given an input PSF image or function.
         To compute the PSF mixing matrix, images of each annuli are convolved with the PSF image using FFT and determine the fraction of photons leaking into neighbouring annuli. FFT-convolved images are then used to determine a mixing matrix. See Eckert et al. 2020 for more details.
 
+        For an azimuthally symmetric PSF given through psffunc, method='radial' computes the mixing matrix directly from the radial PSF with :func:`pyproffit.miscellaneous.psf_radial_matrix`, which is orders of magnitude faster. The edges of the image are then only accounted for through the fraction of each annulus covered by the image. The radial matrix ignores the pixelization of the image and agrees with the FFT method to better than 1e-2 in each element of the matrix (a few 1e-3 for bins wider than the pixels) when the core of the PSF extends over at least two pixels, the differences becoming large for PSFs narrower than a pixel.
+
         :param psffunc: Function describing the radial shape of the PSF, with the radius in arcmin
         :type psffunc: function
         :param psffile: Path to file containing an image of the PSF. The pixel size must be equal to the pixel size of the image.
@@ -822,10 +975,24 @@ class Profile(object):
         :type psfpixsize: float
         :param sourcemodel: Object of type :class:`pyproffit.models.Model` including a surface brightness model to account for surface brightness gradients across the bins. If sourcemodel=None a flat distribution is assumed across each bin. Defaults to None
         :type sourcemodel: class:`pyproffit.models.Model`
+        :param workers: Number of threads among which the convolution of the bins is distributed. Defaults to 1
+        :type workers: int
+        :param method: Method used to compute the mixing matrix, 'fft' (2D convolution of the image of each bin) or 'radial' (1D computation for circular annuli, requires psffunc). Defaults to 'fft'
+        :type method: str
+        :param cachedir: If not None, path to a directory where computed mixing matrices are stored. The matrices are indexed by a hash of the pixels of each bin, the PSF kernel, the surface brightness model and the method, the PSF and the model being sampled on the radial grid of the integration for method='radial', such that any later call with identical inputs, e.g. from another session or another process, reads the matrix from disk instead of recomputing it. Defaults to None
+        :type cachedir: str
+        :param cachesize: Maximum total size of the cached matrices in MB, the least recently used matrices being removed when the limit is exceeded. Defaults to 1000
+        :type cachesize: float
         """
         if psffile is None and psfimage is None and psffunc is None:
             print('No PSF image given')
             return
+        if method not in ('fft', 'radial'):
+            print('Unknown method ' + str(method) + ', available methods are fft and radial')
+            return
+        if method == 'radial' and psffunc is None:
+            print('Error: the radial method requires a PSF function')
+            return
         else:
             data = self.data
             if psffile is not None:
@@ -847,10 +1014,15 @@ class Profile(object):
             rad = self.bins
             erad = self.ebins
             nbin = self.nbin
-            psfout = np.zeros((nbin, nbin))
             exposure = data.exposure
-            y, x = np.indices(exposure.shape)
-            rads = np.hypot(x - self.cx, y - self.cy) * self.data.pixsize  # arcmin
+            rads = self.GetGeometry().rcirc()  # arcmin
+            cache = None
+            if cachedir is not None:
+                cache = DiskCache(cachedir, prefix='psf_', maxsize=cachesize)
+            if sourcemodel is None or sourcemodel.params is None:
+                weights = None
+            else:
+                weights = sourcemodel.model(rads, *sourcemodel.params)
             kernel = None
             if psffunc is not None:
                  # truncation radius, i.e. we exclude the regions where the PSF signal is less than this value
@@ -863,6 +1035,23 @@ class Profile(object):
                     npix = int(rmax)
                 else:
                     npix = int(exposure.shape[0] / 2)
+                if method == 'radial':
+                    proj = self.GetProjection(circular=True)
+                    inner, outer = bin_edges(rad[:nbin], erad[:nbin])
+                    area = np.pi * (outer ** 2 - inner ** 2)
+                    coverage = proj.project(np.ones(proj.shape)) * self.data.pixsize ** 2 / area
+                    psfrad = (npix + 0.5) * self.data.pixsize
+                    # The PSF function and the source model are identified by their values on the radial grids used for the
+                    # integration, which do not depend on the size of the image
+                    psfkey = psffunc(psfrad * np.logspace(-4., 0., 513))
+                    srckey = None
+                    if weights is not None:
+                        subrad = inner[:, np.newaxis] + (outer - inner)[:, np.newaxis] * np.linspace(0., 1., 17)
+                        srckey = sourcemodel.model(subrad, *sourcemodel.params)
+                    self.psfmat = self._cached_psfmat(cache, lambda: psf_radial_matrix(rad[:nbin], erad[:nbin], psffunc, psfrad,
+                                                                                       coverage=coverage, sourcemodel=sourcemodel),
+                                                      'radial', rad[:nbin], erad[:nbin], coverage, psfrad, psfkey, srckey)
+                    return
                 yp, xp = np.indices((2 * npix + 1, 2 * npix + 1))
                 rpix = np.sqrt((xp - npix) ** 2 + (yp - npix) ** 2) * self.data.pixsize
                 kernel = psffunc(rpix)
@@ -876,35 +1065,25 @@ class Profile(object):
                 return
 
             # Sort pixels into radial bins
-            tol = 0.5e-5
-            sort_list = []
-            for n in range(nbin):
-                if n == 0:
-                    sort_list.append(np.where(
-                        np.logical_and(rads >= 0, rads < np.round(rad[n] + erad[n], 5) + tol)))
-                else:
-                    sort_list.append(np.where(np.logical_and(rads >= np.round(rad[n] - erad[n], 5) + tol,
-                                                                    rads < np.round(rad[n] + erad[n], 5) + tol)))
-            # Calculate average of PSF image pixel-by-pixel and sort it by radial bins
-            for n in range(nbin):
-                # print('Working with bin',n+1)
-                region = sort_list[n]
-                npt = len(x[region])
-                imgt = np.zeros(exposure.shape)
-                if sourcemodel is None or sourcemodel.params is None:
-                    imgt[region] = 1. / npt
-                else:
-                    imgt[region] = sourcemodel.model(rads[region],*sourcemodel.params)
-                    norm = np.sum(imgt[region])
-                    imgt[region] = imgt[region]/norm
-                # FFT-convolve image with kernel
-                blurred = convolve(imgt, kernel, mode='same')
-                numnoise = np.where(blurred<1e-15)
-                blurred[numnoise]=0.0
-                for p in range(nbin):
-                    sn = sort_list[p]
-                    psfout[n, p] = np.sum(blurred[sn])
-            self.psfmat = psfout
+            proj = self.GetProjection(circular=True)
+            labels = proj.labels()
+            # Convolve the image of each bin with the kernel and compute the fraction of it falling into each bin
+            self.psfmat = self._cached_psfmat(cache, lambda: psf_mixing_matrix(labels, nbin, kernel, weights=weights, workers=workers),
+                                              'fft', labels, kernel, weights)
+
+    def _cached_psfmat(self, cache, compute, *items):
+        """
+        Read a PSF mixing matrix identified by a set of inputs from the cache, or compute it and store it in the cache
+        """
+        if cache is None:
+            return compute()
+        key = cache_key(*items)
+        stored = cache.load(key)
+        if stored is not None and stored['psfmat'].shape == (self.nbin, self.nbin):
+            return stored['psfmat']
+        psfmat = compute()
+        cache.save(key, psfmat=psfmat)
+        return psfmat
 
     def SaveModelImage(self, outfile, model=None, vignetting=True):
         """
@@ -919,17 +1098,13 @@ class Profile(object):
         """
         head = self.data.header
         pixsize = self.data.pixsize
-        y, x = np.indices(self.data.axes)
         ellipse_angle = self.ellangle
         ellipse_ratio = self.ellratio
         tta = ellipse_angle - 90.
         if tta < -90. or tta > 270.:
             print('Error: input angle must be between 0 and 360 degrees')
             return
-        ellang = tta * np.pi / 180.
-        xtil = np.cos(ellang) * (x - self.cx) * pixsize + np.sin(ellang) * (y - self.cy) * pixsize
-        ytil = -np.sin(ellang) * (x - self.cx) * pixsize + np.cos(ellang) * (y - self.cy) * pixsize
-        rads = ellipse_ratio * np.hypot(xtil, ytil / ellipse_ratio)
+        rads = self.GetGeometry().rads(ellipse_ratio, ellipse_angle)
         if model is not None:
             outmod = model(rads, *model.params)
         else:
@@ -0,0 +1,240 @@
+import re
+import numpy as np
+from astropy.coordinates import Angle
+import astropy.units as u
+from matplotlib.path import Path
+
+region_shapes = ('circle', 'ellipse', 'box', 'polygon', 'annulus')
+
+region_systems = ('fk5', 'icrs', 'j2000', 'image', 'physical', 'galactic', 'ecliptic', 'fk4', 'b1950', 'linear',
+                  'amplifier', 'detector', 'wcs')
+
+
+def read_regions(regfile):
+    """
+    Parse a DS9 region file. Circle, ellipse, box, polygon and annulus shapes defined in fk5 or image coordinates are read, shapes preceded by a '-' sign being flagged as exclusion shapes.
+
+    :param regfile: Path to region file
+    :type regfile: str
+    :return: List of dictionaries containing the shape name, the exclusion flag, the coordinate system and the list of arguments of each shape, or None if no coordinate system is defined in the file
+    :rtype: list
+    """
+    freg = open(regfile)
+    lreg = freg.readlines()
+    freg.close()
+    system = None
+    regions = []
+    for line in lreg:
+        for token in line.split('#')[0].split(';'):
+            token = token.strip()
+            if token == '':
+                continue
+            low = token.lower()
+            if low in region_systems:
+                if low in ('fk5', 'icrs', 'j2000'):
+                    system = 'fk5'
+                else:
+                    system = low
+                continue
+            match = re.match(r'^([+-]?)\s*(' + '|'.join(region_shapes) + r')\s*\((.*)\)', low)
+            if match is None:
+                continue
+            if system is None:
+                print('Error: invalid format')
+                return None
+            args = [arg.strip() for arg in token[token.index('(') + 1:token.rindex(')')].split(',')]
+            regions.append({'shape': match.group(2), 'exclude': match.group(1) == '-', 'system': system, 'args': args})
+    if system is None:
+        print('Error: invalid format')
+        return None
+    return regions
+
+
+def region_length(val, pixsize):
+    """
+    Convert a length given in a fk5 region file into image pixels. Lengths followed by " or ' are in arcsec and arcmin, respectively, and are in degrees otherwise.
+
+    :param val: Length as written in the region file
+    :type val: str
+    :param pixsize: Pixel size in arcmin
+    :type pixsize: float
+    :return: Length in pixels
+    :rtype: float
+    """
+    if '"' in val:
+        return float(val.split('"')[0]) / pixsize / 60.
+    elif '\'' in val:
+        return float(val.split('\'')[0]) / pixsize
+    else:
+        return float(val) / pixsize * 60.
+
+
+def _sky_coordinate(val, unit):
+    if ':' in val or 'h' in val or 'd' in val:
+        return Angle(val, unit=unit).deg
+    return float(val)
+
+
+def _circle(dx, dy, rad):
+    return np.hypot(dx, dy) < rad
+
+
+def _ellipse(dx, dy, rad1, rad2, angle):
+    ellang = angle * np.pi / 180. + np.pi / 2.
+    aoverb = rad1 / rad2
+    xtil = np.cos(ellang) * dx + np.sin(ellang) * dy
+    ytil = -np.sin(ellang) * dx + np.cos(ellang) * dy
+    return aoverb * np.hypot(xtil, ytil / aoverb) < rad1
+
+
+def _box(dx, dy, width, height, angle):
+    ang = angle * np.pi / 180.
+    xtil = np.cos(ang) * dx + np.sin(ang) * dy
+    ytil = -np.sin(ang) * dx + np.cos(ang) * dy
+    return np.logical_and(np.fabs(xtil) < width / 2., np.fabs(ytil) < height / 2.)
+
+
+def _annulus(dx, dy, rin, rout):
+    rads = np.hypot(dx, dy)
+    return np.logical_and(rads >= rin, rads < rout)
+
+
+def rasterize(mask, xc, yc, half, predicate, *params, maxsize=4000000):
+    """
+    Flag the pixels belonging to a set of shapes in a boolean mask. Shapes are grouped by size, and for each group the pixels of a box of half-size half around the center of each shape are tested at once, working on chunks of shapes such that no more than maxsize pixels are tested in one go.
+
+    :param mask: Boolean mask to be updated in place
+    :type mask: class:`numpy.ndarray`
+    :param xc: X coordinates of the centers of the shapes in image pixels (0-based)
+    :type xc: class:`numpy.ndarray`
+    :param yc: Y coordinates of the centers of the shapes in image pixels (0-based)
+    :type yc: class:`numpy.ndarray`
+    :param half: Half-size of the box containing each shape, in pixels
+    :type half: class:`numpy.ndarray`
+    :param predicate: Function taking the offsets dx and dy of the pixels to the center and the shape parameters and returning True for pixels inside the shape
+    :type predicate: function
+    :param params: Arrays containing the parameters of each shape
+    :param maxsize: Maximum number of pixels tested at once. Defaults to 4e6
+    :type maxsize: int
+    """
+    ny, nx = mask.shape
+    intcx = np.round(xc).astype(int)
+    intcy = np.round(yc).astype(int)
+    for boxsize in np.unique(half):
+        sel = np.where(half == boxsize)[0]
+        off = np.arange(-boxsize, boxsize + 1)
+        nchunk = max(1, int(maxsize / len(off) ** 2))
+        for i in range(0, len(sel), nchunk):
+            idx = sel[i:i + nchunk]
+            px = intcx[idx].reshape(-1, 1, 1) + off.reshape(1, 1, -1)
+            py = intcy[idx].reshape(-1, 1, 1) + off.reshape(1, -1, 1)
+            dx = px - xc[idx].reshape(-1, 1, 1)
+            dy = py - yc[idx].reshape(-1, 1, 1)
+            inside = predicate(dx, dy, *[par[idx].reshape(-1, 1, 1) for par in params])
+            inside = inside & (px >= 0) & (px < nx) & (py >= 0) & (py < ny)
+            nsh, iy, ix = np.nonzero(inside)
+            mask[py[nsh, iy, 0], px[nsh, 0, ix]] = True
+
+
+def region_mask(regions, axes, wcs_inp, pixsize):
+    """
+    Compute the mask of the pixels covered by a list of regions read with :func:`pyproffit.regions.read_regions`. All sky positions are converted to image coordinates in a single call to the WCS, and shapes of the same kind are rasterized together with :func:`pyproffit.regions.rasterize`. Pixels covered by exclusion shapes are removed from the final mask. As in previous versions, image coordinates are used as is, i.e. as 0-based pixel indices.
+
+    :param regions: List of regions
+    :type regions: list
+    :param axes: Shape of the image
+    :type axes: tuple
+    :param wcs_inp: WCS of the image
+    :type wcs_inp: class:`astropy.wcs.WCS`
+    :param pixsize: Pixel size in arcmin
+    :type pixsize: float
+    :return:
+        - mask: Boolean array set to True for masked pixels
+        - nsrc: Number of (non-exclusion) shapes used
+    """
+    # Convert all sky positions at once
+    sky = []
+    for reg in regions:
+        if reg['system'] == 'fk5':
+            args = reg['args']
+            npos = len(args) // 2 if reg['shape'] == 'polygon' else 1
+            for i in range(npos):
+                sky.append([_sky_coordinate(args[2 * i], u.hourangle), _sky_coordinate(args[2 * i + 1], u.deg)])
+    if len(sky) > 0:
+        pixcrd = wcs_inp.wcs_world2pix(np.array(sky), 1) - 1.
+    npos = 0
+
+    shapes = {}
+    for name in region_shapes:
+        shapes[name] = [[], []]
+    nsrc = 0
+    skipped = []
+    for reg in regions:
+        args = reg['args']
+        name = reg['shape']
+        if reg['system'] == 'fk5':
+            length = lambda val: region_length(val, pixsize)
+            if name == 'polygon':
+                nvert = len(args) // 2
+                pos = pixcrd[npos:npos + nvert]
+                npos = npos + nvert
+            else:
+                pos = pixcrd[npos]
+                npos = npos + 1
+        elif reg['system'] == 'image':
+            length = float
+            if name == 'polygon':
+                pos = np.array(args[:len(args) // 2 * 2], dtype=float).reshape(-1, 2)
+            else:
+                pos = np.array([float(args[0]), float(args[1])])
+        else:
+            if reg['system'] not in skipped:
+                print('Coordinate system %s is not supported, ignoring the corresponding regions' % (reg['system']))
+                skipped.append(reg['system'])
+            continue
+        if name == 'circle':
+            pars = [length(args[2])]
+        elif name == 'ellipse':
+            pars = [length(args[2]), length(args[3]), float(args[4]) if len(args) > 4 else 0.]
+        elif name == 'box':
+            pars = [length(args[2]), length(args[3]), float(args[4]) if len(args) > 4 else 0.]
+        elif name == 'annulus':
+            rads = [length(val) for val in args[2:]]
+            pars = [min(rads), max(rads)]
+        else:
+            pars = pos
+        shapes[name][int(reg['exclude'])].append((pos, pars))
+        if not reg['exclude']:
+            nsrc = nsrc + 1
+
+    masks = []
+    for excl in range(2):
+        mask = np.zeros(axes, dtype=bool)
+        for name, predicate in [('circle', _circle), ('ellipse', _ellipse), ('box', _box), ('annulus', _annulus)]:
+            allsh = shapes[name][excl]
+            if len(allsh) == 0:
+                continue
+            xc = np.array([sh[0][0] for sh in allsh])
+            yc = np.array([sh[0][1] for sh in allsh])
+            params = np.array([sh[1] for sh in allsh]).T
+            if name == 'circle' or name == 'annulus':
+                extent = params[-1]
+            elif name == 'ellipse':
+                extent = np.max(params[:2], axis=0)
+            else:
+                extent = np.hypot(params[0], params[1]) / 2.
+            half = np.round(extent + 0.5).astype(int)
+            rasterize(mask, xc, yc, half, predicate, *params)
+        for pos, verts in shapes['polygon'][excl]:
+            xmin = max(int(np.floor(np.min(verts[:, 0]))), 0)
+            xmax = min(int(np.ceil(np.max(verts[:, 0]))) + 1, axes[1])
+            ymin = max(int(np.floor(np.min(verts[:, 1]))), 0)
+            ymax = min(int(np.ceil(np.max(verts[:, 1]))) + 1, axes[0])
+            if xmin >= xmax or ymin >= ymax:
+                continue
+            y, x = np.mgrid[ymin:ymax, xmin:xmax]
+            inside = Path(verts).contains_points(np.array([x.ravel(), y.ravel()]).T).reshape(x.shape)
+            mask[ymin:ymax, xmin:xmax] |= inside
+        masks.append(mask)
+
+    return np.logical_and(masks[0], np.logical_not(masks[1])), nsrc
@@ -30,7 +30,12 @@ def Reload(infile, model=None):
             print('DATA structure found')
             head = fin[i].header
 
-            dat = Data(imglink=head['IMAGE'], explink=head['EXPMAP'], bkglink=head['BKGMAP'], voronoi=head['VORONOI'], rmsmap=head['RMSMAP'])
+            if 'CUT_RAD' in head:
+                dat = Data(imglink=head['IMAGE'], explink=head['EXPMAP'], bkglink=head['BKGMAP'], voronoi=head['VORONOI'],
+                           rmsmap=head['RMSMAP'], cutout_ra=head['CUT_RA'], cutout_dec=head['CUT_DEC'],
+                           cutout_radius=head['CUT_RAD'])
+            else:
+                dat = Data(imglink=head['IMAGE'], explink=head['EXPMAP'], bkglink=head['BKGMAP'], voronoi=head['VORONOI'], rmsmap=head['RMSMAP'])
 
             din = fin[i].data
             prof = Profile(dat, binsize=head['BINSIZE'], maxrad=head['MAXRAD'], center_choice='custom_fk5',